@@ -5,58 +5,246 @@ import os
 import argparse
 import sys
 import pickle
+import multiprocessing
+from functools import partial
 #from statsmodels.tsa.api import VAR
 from statsmodels.tsa.api import ARIMA
 sys.path.append('../')
 from utils import *
+from metrics import get_metrics
 
 
-def predict_by_samples(data, test_data, train_length, num_sample, output_steps, lag_order=1, if_sample=True):
+def fit_arima(window, lag_order, start_params=None):
+    """Fit ARIMA(lag_order, 0, 1) without trend, warm-started from start_params if given.
+
+    A warm start that does not converge is retried from scratch.
+    :return: the results, None if the fit failed.
+    """
+    for params in ([start_params, None] if start_params is not None else [None]):
+        try:
+            return ARIMA(window, order=(lag_order, 0, 1)).fit(start_params=params, trend='nc', disp=0)
+        except (ValueError, np.linalg.LinAlgError):
+            continue
+    return None
+
+
+def predict_station(task, train_length, lag_order, refit_every):
+    """Rolling one-step forecasts of one station from the windows series[t:train_length+t].
+
+    The model is refit every refit_every steps, warm-started from the previous parameters.
+    In between, the fixed parameters filter the new observations: the MA(1) error is
+    updated recursively from the last fit, so a step costs O(lag_order).
+    :param task: (series, steps), the series of the station and its sorted test steps t.
+    :return: predictions (nan if no model could be fit yet), number of fits, number of failed fits.
+    """
     warnings.filterwarnings("ignore")
+    series, steps = task
+    predictions = np.full(len(steps), np.nan)
+    params, ar, ma, eps, pos, last_fit = None, None, None, 0., 0, None
+    num_fits, num_failed = 0, 0
+    for n, t in enumerate(steps):
+        end = train_length + t
+        if params is None or t - last_fit >= refit_every:
+            results = fit_arima(series[t:end], lag_order, params)
+            num_fits += 1
+            if results is not None:
+                params, ar, ma = results.params, results.arparams, results.maparams[0]
+                eps, pos, last_fit = results.resid[-1], end - 1, t
+                predictions[n] = results.predict(train_length, train_length)[0]
+                continue
+            num_failed += 1
+            if params is None:
+                continue
+        for j in range(pos + 1, end):
+            eps = series[j] - np.dot(ar, series[j - lag_order:j][::-1]) - ma * eps
+        pos = end - 1
+        predictions[n] = np.dot(ar, series[end - lag_order:end][::-1]) + ma * eps
+    return predictions, num_fits, num_failed
+
+
+def predict_by_samples(data, test_data, train_length, num_sample, output_steps, lag_order=1, if_sample=True,
+                       refit_every=1, processes=None):
+    """One-step ARIMA forecasts of num_sample random stations at each test step.
+
+    The (test step, station) grid is grouped by station and each station runs its steps
+    in order in a process pool, so its fits can be warm-started (see predict_station).
+    :return: real, predict, index_all [num_steps, num_sample], error_all (the failed
+        samples of each step) and valid_num [num_steps].
+    """
     test_num, data_dim = test_data.shape
-    if not if_sample:
+    num_steps = test_num - output_steps
+    if if_sample:
+        index_all = np.random.randint(data_dim, size=(num_steps, num_sample)).astype(np.int32)
+    else:
         num_sample = data_dim
-    #widgets = ['Train: ', Percentage(), ' ', Bar('-'), ' ', ETA()]
-    #pbar = ProgressBar(widgets=widgets, maxval=test_data.shape[0]-output_steps).start()
-    error_all = []
-    index_all = np.zeros([test_num - output_steps, num_sample], dtype=np.int32)
-    valid_num = np.zeros(test_num - output_steps, dtype=np.int32)
-    real = np.zeros([test_num - output_steps, num_sample])
-    predict = np.zeros([test_num - output_steps, num_sample])
-    #
-    samples = np.arange(data_dim)
-    #
-    for t in range(test_num - output_steps):
-        #pbar.update(t)
-        if t%100 == 0:
-            print(t)
-        error_index = []
-        if if_sample:
-            samples = np.random.randint(data_dim, size=num_sample)
-        for r in range(num_sample):
-            # t: which time slot
-            # i: which station
-            i = samples[r]
-            train_df = data[t:train_length+t, i]
-            try:
-                results = ARIMA(train_df, order=(lag_order, 0, 1)).fit(trend='nc', disp=0)
-            except:
-                error_index.append(r)
-                continue
-            #pre, _, _ = results.forecast(output_steps)
-            #pre = results.predict(train_length, train_length+output_steps)
-            pre = results.predict(train_length, train_length)
-            test_real = test_data[t:t + output_steps, i]
-            real[t, r] = test_real
-            #print(pre)
-            predict[t, r] = pre
-        index_all[t] = samples
-        error_all.append(error_index)
-        valid_num[t] = num_sample - len(error_index)
-    #pbar.finish()
+        index_all = np.tile(np.arange(data_dim, dtype=np.int32), (num_steps, 1))
+    real = test_data[np.arange(num_steps)[:, np.newaxis], index_all]
+    predict = np.zeros([num_steps, num_sample])
+    valid = np.zeros([num_steps, num_sample], dtype=bool)
+    # flat positions t*num_sample + r of each station, t ascending
+    flat_index = index_all.ravel()
+    order = np.argsort(flat_index, kind='stable')
+    stations, starts = np.unique(flat_index[order], return_index=True)
+    groups = np.split(order, starts[1:])
+    tasks = [(data[:train_length + num_steps, i], group // num_sample) for i, group in zip(stations, groups)]
+    total_fits, total_failed = 0, 0
+    pool = multiprocessing.Pool(processes)
+    try:
+        results = pool.imap(partial(predict_station, train_length=train_length, lag_order=lag_order,
+                                    refit_every=refit_every), tasks)
+        for k, (group, (predictions, num_fits, num_failed)) in enumerate(zip(groups, results)):
+            ok = ~np.isnan(predictions)
+            predict.flat[group[ok]] = predictions[ok]
+            valid.flat[group[ok]] = True
+            total_fits += num_fits
+            total_failed += num_failed
+            if (k + 1) % 10 == 0 or k == len(groups) - 1:
+                print('%d/%d stations, %d fits, %d failed' % (k + 1, len(groups), total_fits, total_failed))
+    finally:
+        pool.close()
+        pool.join()
+    error_all = [np.nonzero(~valid[t])[0].tolist() for t in range(num_steps)]
+    valid_num = valid.sum(axis=1).astype(np.int32)
+    print('%d of %d forecasts without a model' % (valid.size - valid_num.sum(), valid.size))
     return real, predict, index_all, error_all, valid_num
 
 
+def _css_residuals(y, phi, theta):
+    """Conditional residuals of ARMA(1,1) on y [T, N] with e_0 = 0, and their derivatives.
+
+    :return: e, de/dphi, de/dtheta, each [T-1, N]
+    """
+    e = np.zeros_like(y)
+    d_phi = np.zeros_like(y)
+    d_theta = np.zeros_like(y)
+    for t in range(1, len(y)):
+        e[t] = y[t] - phi * y[t - 1] - theta * e[t - 1]
+        d_phi[t] = -y[t - 1] - theta * d_phi[t - 1]
+        d_theta[t] = -e[t - 1] - theta * d_theta[t - 1]
+    return e[1:], d_phi[1:], d_theta[1:]
+
+
+def fit_arma11(y, num_iter=20, bound=0.99, tol=1e-6):
+    """Conditional least squares fit of ARMA(1,1) without trend to all columns of y at once.
+
+    Each iteration solves the 2x2 Gauss-Newton normal equations of every series and
+    halves the step of the series whose squared error would grow.
+    :param y: [T, N]
+    :param bound: |phi| and |theta| are kept below it, stationary and invertible.
+    :return: phi, theta [N]
+    """
+    y = np.asarray(y, dtype=np.float64)
+    # lag-1 autocorrelation as the AR start, no MA
+    phi = np.sum(y[1:] * y[:-1], axis=0) / np.maximum(np.sum(np.square(y[:-1]), axis=0), 1e-12)
+    phi = np.clip(phi, -bound, bound)
+    theta = np.zeros_like(phi)
+    e, d_phi, d_theta = _css_residuals(y, phi, theta)
+    sse = np.sum(np.square(e), axis=0)
+    for _ in range(num_iter):
+        a, b, c = np.sum(d_phi * d_phi, axis=0), np.sum(d_phi * d_theta, axis=0), np.sum(d_theta * d_theta, axis=0)
+        g_phi, g_theta = np.sum(d_phi * e, axis=0), np.sum(d_theta * e, axis=0)
+        det = a * c - b * b
+        det = np.where(np.abs(det) > 1e-12, det, np.inf)
+        s_phi = -(c * g_phi - b * g_theta) / det
+        s_theta = -(a * g_theta - b * g_phi) / det
+        if max(np.max(np.abs(s_phi)), np.max(np.abs(s_theta))) < tol:
+            break
+        step = np.ones_like(phi)
+        done = np.zeros(phi.shape, dtype=bool)
+        for _ in range(4):
+            cand_phi = np.clip(phi + step * s_phi, -bound, bound)
+            cand_theta = np.clip(theta + step * s_theta, -bound, bound)
+            cand_e, cand_d_phi, cand_d_theta = _css_residuals(y, cand_phi, cand_theta)
+            cand_sse = np.sum(np.square(cand_e), axis=0)
+            better = ~done & (cand_sse <= sse)
+            phi[better], theta[better], sse[better] = cand_phi[better], cand_theta[better], cand_sse[better]
+            e[:, better], d_phi[:, better], d_theta[:, better] = \
+                cand_e[:, better], cand_d_phi[:, better], cand_d_theta[:, better]
+            done |= better
+            if done.all():
+                break
+            step[~done] *= 0.5
+    return phi, theta
+
+
+def arma11_forecasts(y, phi, theta):
+    """One-step forecasts of all columns of y [T, N] by the exact Kalman filter of ARMA(1,1).
+
+    With the state (y_t, theta*eps_t) started from its stationary distribution, only
+    the variance p of the first state component changes over time.
+    :return: [T, N], row t predicts y[t] from y[:t].
+    """
+    y = np.asarray(y, dtype=np.float64)
+    forecasts = np.zeros_like(y)
+    a = np.zeros(y.shape[1])
+    p = (1 + 2 * phi * theta + theta * theta) / (1 - phi * phi)
+    for t in range(len(y)):
+        forecasts[t] = a
+        gain = (phi * p + theta) / p
+        a = phi * a + gain * (y[t] - a)
+        p = phi * phi * p + 2 * phi * theta + theta * theta + 1 - np.square(phi * p + theta) / p
+    return forecasts
+
+
+def check_parity(data, train_length, phi, theta, forecasts, stations, param_tol=0.02, forecast_tol=0.02):
+    """Check the batched fit against statsmodels on some stations, fit on data[:train_length].
+
+    fit_arma11 is conditional least squares, so it is compared with statsmodels'
+    ARIMA(1, 0, 1) fit with trend='nc' and method='css' (not the default exact MLE of
+    fit_arima). Checked per station:
+    - phi and theta against arparams/maparams, within param_tol;
+    - the one-step forecast of y[train_length], by the CSS recursion and by the Kalman filter
+      of arma11_forecasts (which only differs by a transient decaying like theta^t), against
+      statsmodels' forecast, within forecast_tol times the std of the series.
+    :raise AssertionError: listing the stations outside the tolerances, or if no station could
+        be fit by statsmodels.
+    """
+    failures, num_checked = [], 0
+    for i in stations:
+        y = data[:train_length, i]
+        try:
+            results = ARIMA(y, order=(1, 0, 1)).fit(trend='nc', method='css', disp=0)
+        except (ValueError, np.linalg.LinAlgError):
+            print('station %d: statsmodels fit failed, skipped' % i)
+            continue
+        num_checked += 1
+        pre = results.predict(train_length, train_length)[0]
+        e = _css_residuals(y[:, np.newaxis], phi[i:i + 1], theta[i:i + 1])[0][-1, 0]
+        css_pre = phi[i] * y[-1] + theta[i] * e
+        scale = forecast_tol * max(np.std(y), 1e-8)
+        print('station %d: phi %.4f/%.4f, theta %.4f/%.4f, forecast %.4f/%.4f/%.4f (statsmodels/css/kalman)' %
+              (i, results.arparams[0], phi[i], results.maparams[0], theta[i], pre, css_pre, forecasts[0, i]))
+        if abs(results.arparams[0] - phi[i]) > param_tol or abs(results.maparams[0] - theta[i]) > param_tol:
+            failures.append('station %d: parameters' % i)
+        if abs(css_pre - pre) > scale or abs(forecasts[0, i] - pre) > scale:
+            failures.append('station %d: forecast' % i)
+    assert num_checked > 0, 'parity: no station could be fit by statsmodels'
+    assert not failures, 'parity with statsmodels CSS failed: ' + ', '.join(failures)
+    print('parity with statsmodels CSS passed on %d stations' % num_checked)
+
+
+def predict_batched(data, test_data, train_length, output_steps, parity=0):
+    """One-step ARMA(1,1) forecasts of all stations at every test step, in array form.
+
+    The parameters are fit once on data[:train_length] by fit_arma11, then one Kalman
+    filter pass over the series gives the forecasts of all test origins.
+    :param parity: number of random stations checked against statsmodels CSS, see check_parity.
+    :return: the same outputs as predict_by_samples, with every station sampled.
+    """
+    num_steps, data_dim = test_data.shape[0] - output_steps, test_data.shape[1]
+    phi, theta = fit_arma11(data[:train_length])
+    forecasts = arma11_forecasts(data[:train_length + num_steps], phi, theta)[train_length:]
+    if parity > 0:
+        warnings.filterwarnings("ignore")
+        check_parity(data, train_length, phi, theta, forecasts,
+                     np.random.choice(data_dim, min(parity, data_dim), replace=False))
+    index_all = np.tile(np.arange(data_dim, dtype=np.int32), (num_steps, 1))
+    invalid = ~np.isfinite(forecasts)
+    error_all = [np.nonzero(invalid[t])[0].tolist() for t in range(num_steps)]
+    valid_num = (data_dim - invalid.sum(axis=1)).astype(np.int32)
+    return test_data[:num_steps], np.where(invalid, 0., forecasts), index_all, error_all, valid_num
+
+
 if __name__ == '__main__':
     parse = argparse.ArgumentParser()
     # parse.add_argument('-dataset', '--dataset', type=str, default='didi')
@@ -65,11 +253,18 @@ if __name__ == '__main__':
     parse.add_argument('-predict_steps', '--predict_steps', type=int, default=1, help='prediction steps')
     parse.add_argument('-lag_order', '--lag_order', type=int, default=5, help='lag order in VAR and ARIMA models')
     parse.add_argument('-num_samples', '--num_samples', type=int, default=3, help='number of samples for ARIMA model')
+    parse.add_argument('-refit_every', '--refit_every', type=int, default=1,
+                       help='refit ARIMA every n test steps, filter with fixed parameters in between')
+    parse.add_argument('-processes', '--processes', type=int, default=None, help='number of processes, default all cpus')
+    parse.add_argument('-method', '--method', type=str, default='statsmodels',
+                       help='statsmodels (per sample) or batched (ARMA(1,1) of all stations at once)')
+    parse.add_argument('-parity', '--parity', type=int, default=0,
+                       help='number of stations checked against statsmodels CSS in the batched method, fails outside tolerance')
     #
     args = parse.parse_args()
     #
     data_folder = '../datasets/' + args.dataset + '-data/data/'
-    output_folder = 'results/ARIMA/' + args.dataset
+    output_folder = ('results/ARIMA/' if args.method == 'statsmodels' else 'results/ARMA_batched/') + args.dataset
     if not os.path.exists(output_folder):
         os.makedirs(output_folder)
     prediction_file_name = os.path.join(output_folder,'ARIMA_prediction.npy')
@@ -93,14 +288,21 @@ if __name__ == '__main__':
         test_predict = np.load(prediction_file_name)
         test_real = np.load(target_file_name)
         error_all = load_pickle(os.path.join(output_folder, 'arima_error.pkl'))
-        valid_num = np.array([args.num_samples - len(e) for e in error_all])
+        index_all = np.load(os.path.join(output_folder, 'index_all.npy'))
+        valid_num = np.array([index_all.shape[1] - len(e) for e in error_all])
     else:
         data = np.reshape(data, (data.shape[0], -1))
         test_data = np.reshape(test_data, (test_data.shape[0], -1))
         #
         print('train ARIMA model...')
         #test_data_preindex = np.vstack((train_data[-args.lag_order:], test_data))
-        test_real, test_predict, index_all, error_all, valid_num = predict_by_samples(data, test_data, split[0]+split[1], args.num_samples, args.predict_steps, lag_order=args.lag_order)
+        if args.method == 'batched':
+            test_real, test_predict, index_all, error_all, valid_num = predict_batched(
+                data, test_data, split[0]+split[1], args.predict_steps, parity=args.parity)
+        else:
+            test_real, test_predict, index_all, error_all, valid_num = predict_by_samples(
+                data, test_data, split[0]+split[1], args.num_samples, args.predict_steps, lag_order=args.lag_order,
+                refit_every=args.refit_every, processes=args.processes)
         test_predict = np.clip(test_predict, 0, None)
         test_real = np.squeeze(test_real)
         test_predict = np.squeeze(test_predict)
@@ -113,10 +315,15 @@ if __name__ == '__main__':
         dump_pickle(error_all, os.path.join(output_folder, 'arima_error.pkl'))
     #
     #rmse_test = np.sqrt(np.sum(np.square(test_real-test_predict))/np.prod(test_predict.shape))
-    rmse_test = np.sqrt(np.sum(np.square(test_real - test_predict)) / np.sum(valid_num))
-    mae_test = np.mean(np.abs(test_real-test_predict))
-    print('test in/out rmse is %.4f' % rmse_test)
-    print('test in/out mae is %.4f' % mae_test)
+    # samples whose ARIMA fit failed are masked out
+    # [num_steps, num_sample] as index_all, test_real may have lost either axis in np.squeeze
+    mask = np.ones(index_all.shape)
+    for t, error_index in enumerate(error_all):
+        mask[t, error_index] = 0
+    m = get_metrics(test_real.reshape(mask.shape + (-1,)), test_predict.reshape(mask.shape + (-1,)),
+                    mask=mask[:, :, np.newaxis])
+    print('test in/out rmse is %.4f' % m['rmse'])
+    print('test in/out mae is %.4f' % m['mae'])
     #
     # if not os.path.exists(prediction_file_name):
     #     test_predict = np.array(test_predict, dtype=np.float32)
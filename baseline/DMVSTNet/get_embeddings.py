@@ -4,47 +4,134 @@ import argparse
 from utils import *
 #from dtw import dtw
 from fastdtw import fastdtw
-from scipy.spatial.distance import euclidean
+from scipy.ndimage import maximum_filter1d, minimum_filter1d
+import multiprocessing
+from functools import partial
 import math
 import pandas as pd
 
 
-def getGraphEmbedding(data, week_length=24 * 7, output_folder='./'):
+# series [T, N] and their LB_Keogh envelopes in the worker processes
+_series, _upper, _lower = None, None, None
+
+
+def _init_worker(series, upper, lower):
+    global _series, _upper, _lower
+    _series, _upper, _lower = series, upper, lower
+
+
+def abs_distance(x, y):
+    # euclidean of two scalars, without scipy's input checks
+    return abs(x - y)
+
+
+def dtw_row(i):
+    """fastdtw distances of series i to the series i..N-1."""
+    x = _series[:, i]
+    return i, np.array([fastdtw(x, _series[:, j], dist=abs_distance)[0] for j in range(i, _series.shape[1])]), \
+        _series.shape[1] - i
+
+
+def lb_keogh_row(i):
+    """LB_Keogh lower bounds of the DTW distances of series i to all series, in both directions."""
+    x = _series[:, i:i + 1]
+    lb = np.sum(np.maximum(x - _upper, 0) + np.maximum(_lower - x, 0), axis=0)
+    lb_rev = np.sum(np.maximum(_series - _upper[:, i:i + 1], 0) + np.maximum(_lower[:, i:i + 1] - _series, 0), axis=0)
+    return np.maximum(lb, lb_rev)
+
+
+def dtw_knn_row(i, k):
+    """fastdtw distances of series i to its k nearest series, inf for the others.
+
+    Candidates are tried in increasing LB_Keogh order and the search stops once the
+    bound exceeds the k-th best distance found; fastdtw follows a valid warping path,
+    so its distance is never below the exact DTW and never below the bound.
+    """
+    x = _series[:, i]
+    lb = lb_keogh_row(i)
+    dist = np.full(_series.shape[1], np.inf)
+    dist[i] = 0.
+    best = []
+    num_computed = 0
+    for j in np.argsort(lb):
+        if j == i:
+            continue
+        if len(best) == k and lb[j] >= best[-1]:
+            break
+        dist[j] = fastdtw(x, _series[:, j], dist=abs_distance)[0]
+        num_computed += 1
+        best = sorted(best + [dist[j]])[:k]
+    dist[(dist > best[-1]) if best else slice(None)] = np.inf
+    dist[i] = 0.
+    return i, dist, num_computed
+
+
+def dtw_graph(series, knn=None, lb_window=None, processes=None):
+    """Pairwise fastdtw distances of the columns of series [T, N], computed in a process pool.
+
+    :param knn: if given, only the knn nearest series of each series are computed
+        (pruned by LB_Keogh), the other distances are inf.
+    :param lb_window: radius of the LB_Keogh envelopes, the whole series by default. Only
+        the default bounds fastdtw safely, a smaller radius bounds the DTW constrained to it.
+    :return: symmetric [N, N] float32 distances
+    """
+    num = series.shape[1]
+    if lb_window is None or lb_window >= len(series):
+        upper = np.repeat(np.max(series, axis=0, keepdims=True), len(series), axis=0)
+        lower = np.repeat(np.min(series, axis=0, keepdims=True), len(series), axis=0)
+    else:
+        upper = maximum_filter1d(series, 2 * lb_window + 1, axis=0, mode='nearest')
+        lower = minimum_filter1d(series, 2 * lb_window + 1, axis=0, mode='nearest')
+    graph = np.full((num, num), np.inf)
+    total = 0
+    pool = multiprocessing.Pool(processes, initializer=_init_worker, initargs=(series, upper, lower))
+    try:
+        if knn is None:
+            rows = pool.imap_unordered(dtw_row, range(num))
+        else:
+            rows = pool.imap_unordered(partial(dtw_knn_row, k=knn), range(num))
+        for n, (i, dist, num_computed) in enumerate(rows):
+            graph[i, num - len(dist):] = dist
+            total += num_computed
+            if (n + 1) % 20 == 0 or n == num - 1:
+                print('%d/%d rows, %d of %d pairs computed' % (n + 1, num, total, num * (num + 1) // 2))
+    finally:
+        pool.close()
+        pool.join()
+    if knn is None:
+        graph = np.triu(graph) + np.triu(graph, 1).T
+    else:
+        # a pair is kept if either series has the other among its neighbors
+        graph = np.fmin(graph, graph.T)
+    return graph.astype(np.float32)
+
+
+def write_edge_list(graph, filename):
+    """Write the finite pairs i <= j of a symmetric graph as 'i j w' and 'j i w' lines, in bulk."""
+    rows, cols = np.triu_indices(graph.shape[0])
+    weights = graph[rows, cols]
+    keep = np.isfinite(weights)
+    rows, cols, weights = rows[keep], cols[keep], weights[keep]
+    edges = np.empty((2 * len(rows), 3))
+    edges[0::2] = np.stack([rows, cols, weights], axis=1)
+    edges[1::2] = np.stack([cols, rows, weights], axis=1)
+    np.savetxt(filename, edges, fmt='%d %d %.8g')
+
+
+def getGraphEmbedding(data, week_length=24 * 7, output_folder='./', knn=None, lb_window=None, processes=None):
     """
     :param data: t x w x h x c
     :return:
     """
-    #embedding = None
-    #graph = np.zeros([data.shape[1] * data.shape[2], data.shape[1] * data.shape[2]], dtype=np.float32)
-    s = np.zeros([week_length, data.shape[1], data.shape[2]])
-    count = 0
-    for i in range(0, data.shape[0], week_length):
-        if i + week_length > data.shape[0]:
-            break
-        s += data[i:i + week_length, :, :]
-        count += 1
-    s = s / count
-    s = np.reshape(s, [s.shape[0], -1])
-#     for i in range(s.shape[1]):
-#         for j in range(i, s.shape[1]):
-#             graph[i, j], _, _, _ = dtw(s[:, i], s[:, j], dist=lambda x, y: abs(x - y))
-#             #print("at %d %d " % (i, j))
+    # mean week of each cell
+    count = data.shape[0] // week_length
+    s = np.mean(np.reshape(data[:count * week_length], (count, week_length, -1)), axis=0)
     print('fastdtw...')
-    dtw_output = [[fastdtw(s[:,i], s[:,j], dist=euclidean)[0] for j in range(i, s.shape[1])] for i in range(s.shape[1])]
+    graph = dtw_graph(s, knn=knn, lb_window=lb_window, processes=processes)
     print('save graph data...')
-    dump_pickle(dtw_output, os.path.join(output_folder, 'graph.pkl'))
-    #np.save(os.path.join(output_folder, 'graph.npy'), graph)
-    # graph = np.load("./graph.npy")
+    np.save(os.path.join(output_folder, 'graph.npy'), graph)
     print('generate graph_embedding_input.txt ')
-    with open(os.path.join(output_folder, 'graph_embedding_input.txt'), 'w') as f:
-        # for i in range(graph.shape[0]):
-        #     for j in range(i, graph.shape[1]):
-        #         f.write(str(i) + " " + str(j) + " " + str(graph[i, j]) + "\n")
-        #         f.write(str(j) + " " + str(i) + " " + str(graph[i, j]) + "\n")
-        for i in range(s.shape[1]):
-            for j in range(i, s.shape[1]):
-                f.write(str(i) + " " + str(j) + " " + str(dtw_output[i][j-i]) + "\n")
-                f.write(str(j) + " " + str(i) + " " + str(dtw_output[i][j-i]) + "\n")
+    write_edge_list(graph, os.path.join(output_folder, 'graph_embedding_input.txt'))
 
 
 def main():
@@ -55,6 +142,10 @@ def main():
     parse.add_argument('-predict_steps', '--predict_steps', type=int, default=1, help='prediction steps')
     parse.add_argument('-input_steps', '--input_steps', type=int, default=6, help='number of input steps')
     parse.add_argument('-dim', '--dim', type=int, default=0, help='dim of data to be processed')
+    parse.add_argument('-knn', '--knn', type=int, default=None, help='only compute the DTW of the k nearest cells')
+    parse.add_argument('-lb_window', '--lb_window', type=int, default=None,
+                       help='radius of the LB_Keogh envelopes for -knn, the whole series by default')
+    parse.add_argument('-processes', '--processes', type=int, default=None, help='number of processes, default all cpus')
     #
     args = parse.parse_args()
     #
@@ -79,7 +170,8 @@ def main():
         p = 24 * 7 * 4
     print(train_data.shape)
     train_emb_data = train_data[..., args.dim]
-    getGraphEmbedding(train_emb_data, week_length=p, output_folder=output_folder)
+    getGraphEmbedding(train_emb_data, week_length=p, output_folder=output_folder,
+                      knn=args.knn, lb_window=args.lb_window, processes=args.processes)
 
 
 if __name__ == '__main__':
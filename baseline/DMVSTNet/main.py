@@ -7,25 +7,24 @@ import keras.backend.tensorflow_backend as ktf
 from keras.callbacks import EarlyStopping, ModelCheckpoint
 currentPath = os.path.abspath(os.path.curdir)
 sys.path.append(currentPath)
-from model import build_model
+from model import build_model, build_fcn_model
 from utils import *
 from minMax import *
 
 
 def load_embedding(filename):
-    with open(filename, 'r') as f:
-        num, length = f.readline().strip().split(" ")
-        embedding = {}
-        for i in range(int(num)):
-            line = f.readline()
-            vector = line.strip().split(" ")
-            id = int(vector[0])
-            vector = [float(item) for item in vector[1:]]
-            embedding[id] = np.array(vector, dtype=np.float)
+    # parsed once into cached .npy sidecars, see embedding_table.load_embedding_table
+    ids, vectors = load_embedding_table(filename, dtype=np.float64)
+    embedding = dict(zip(ids.tolist(), np.array(vectors)))
     return embedding
 
 
-def prepare_data_padding(input_length, map_data, embedding_data, split, image_size=9, if_padding=False):
+def prepare_data_padding(input_length, map_data, embedding_data, split, image_size=9, if_padding=False, lazy=False):
+    """Patches, embeddings and targets of the train and test samples.
+
+    With lazy, the train and test patches are PatchSamples that keras gathers batch by
+    batch through PatchSequence, and the embeddings are held in them (None is returned).
+    """
     padding = int(image_size / 2)
     #
     if if_padding:
@@ -34,44 +33,25 @@ def prepare_data_padding(input_length, map_data, embedding_data, split, image_si
         padding_map_data[:, padding:-padding, padding:-padding, :] = map_data
         map_data = padding_map_data
     #
-    height = map_data.shape[1]
-    width = map_data.shape[2]
-    #T = map_data.shape[0]
-    train_image_x = []
-    train_y = []
-    train_embedding = []
-    test_image_x = []
-    test_y = []
-    test_embedding_x = []
-    #for t in range(input_length, splits[0] - input_length):
-    for t in range(input_length, split[0]):
-        for i in range(padding, height - padding):
-            for j in range(padding, width - padding):
-                if not embedding_data.__contains__(i * width + j):
-                    continue
-                train_image_x.append(map_data[t-input_length:t, i - padding:i + padding+1, j - padding:j + padding+1, :])
-                train_y.append(map_data[t, i, j, :])
-                train_embedding.append(embedding_data[i * width + j])
-    #for t in range(splits[0] - input_length, splits[0] + splits[1] - input_length):
-    for t in range(np.sum(split[:-1]) + input_length, np.sum(split)):
-        for i in range(padding, height - padding):
-            for j in range(padding, width - padding):
-                if not embedding_data.__contains__(i * width + j):
-                    continue
-                test_image_x.append(map_data[t-input_length:t, i - padding:i + padding+1, j - padding:j + padding+1, :])
-                test_y.append(map_data[t, i, j, :])
-                test_embedding_x.append(embedding_data[i * width + j])
-    train_image_x = np.asarray(train_image_x)
-    train_embedding = np.asarray(train_embedding)
-    train_y = np.asarray(train_y)
-    test_embedding_x = np.asarray(test_embedding_x)
-    test_image_x = np.asarray(test_image_x)
-    test_y = np.asarray(test_y)
-    print(train_image_x.shape)
-    print(train_embedding.shape)
+    train_samples = get_patch_samples(map_data, embedding_data, input_length, image_size,
+                                      np.arange(input_length, split[0]))
+    test_samples = get_patch_samples(map_data, embedding_data, input_length, image_size,
+                                     np.arange(np.sum(split[:-1]) + input_length, np.sum(split)))
+    train_y = train_samples.targets(slice(None))
+    test_y = test_samples.targets(slice(None))
+    if lazy:
+        train_image_x, test_image_x = train_samples, test_samples
+        train_embedding, test_embedding_x = None, None
+    else:
+        train_image_x = train_samples.patches(slice(None))
+        test_image_x = test_samples.patches(slice(None))
+        train_embedding = train_samples.embeddings(slice(None))
+        test_embedding_x = test_samples.embeddings(slice(None))
+        print(train_image_x.shape)
+        print(train_embedding.shape)
+        print(test_image_x.shape)
+        print(test_embedding_x.shape)
     print(train_y.shape)
-    print(test_image_x.shape)
-    print(test_embedding_x.shape)
     print(test_y.shape)
     test_y_num = [np.sum(split) - np.sum(split[:-1]) - input_length]
     return train_image_x, train_embedding, train_y, test_image_x, test_embedding_x, test_y, test_y_num
@@ -89,6 +69,15 @@ def main():
     parse.add_argument('-dim', '--dim', type=int, default=0, help='dim of data to be processed')
     parse.add_argument('-trainable', '--trainable', type=int, default=1, help='if to train (1) or to test (0)')
     parse.add_argument('-batch_size', '--batch_size', type=int, default=64)
+    parse.add_argument('-lazy', '--lazy', type=int, default=0,
+                       help='gather the patches of each batch on the fly (1) instead of building all of them (0)')
+    parse.add_argument('-fcn', '--fcn', type=int, default=0,
+                       help='run the local CNN on whole maps (1) instead of on the patch of each cell (0)')
+    parse.add_argument('-fcn_rmse_check', '--fcn_rmse_check', type=int, default=0,
+                       help='in fcn mode, fail if the test rmse is more than -fcn_rmse_tol above that of the '
+                            'trained patch network (1)')
+    parse.add_argument('-fcn_rmse_tol', '--fcn_rmse_tol', type=float, default=0.1,
+                       help='relative rmse tolerance of -fcn_rmse_check')
     #
     args = parse.parse_args()
     os.environ['CUDA_VISIBLE_DEVICES'] = args.gpu
@@ -134,7 +123,8 @@ def main():
     # prepare data
     train_image, train_embedding, train_y, test_image, test_embedding, test_y, test_num = prepare_data_padding(args.input_steps,
                                                                                              data, embedding,
-                                                                                             split, 9, if_padding=True)
+                                                                                             split, 9, if_padding=True,
+                                                                                             lazy=args.lazy or args.fcn)
     print(test_num)
     print(np.max(test_y))
     # set gpu config
@@ -142,11 +132,24 @@ def main():
     config.gpu_options.allow_growth = True
     ktf.set_session(tf.Session(config=config))
     # train model
-    prediction = build_model(train_y, test_y, train_image, test_image, train_embedding, test_embedding, 64, minMax,
-                             seq_len=args.input_steps,
-                             batch_size=args.batch_size,
-                             trainable=args.trainable,
-                             model_path=output_folder)
+    if args.fcn:
+        # one sample per time step: the whole padded maps and the targets of all cells
+        cells = train_image.cells()
+        prediction = build_fcn_model(np.reshape(train_y, (-1, len(cells), train_y.shape[-1])),
+                                     np.reshape(test_y, (-1, len(cells), test_y.shape[-1])),
+                                     train_image.maps(), test_image.maps(), cells, train_image.embedding, 64, minMax,
+                                     seq_len=args.input_steps,
+                                     batch_size=max(args.batch_size // len(cells), 1),
+                                     trainable=args.trainable,
+                                     model_path=output_folder,
+                                     testimage=test_image if args.fcn_rmse_check else None,
+                                     rmse_tol=args.fcn_rmse_tol)
+    else:
+        prediction = build_model(train_y, test_y, train_image, test_image, train_embedding, test_embedding, 64, minMax,
+                                 seq_len=args.input_steps,
+                                 batch_size=args.batch_size,
+                                 trainable=args.trainable,
+                                 model_path=output_folder)
     test_target = np.reshape(test_y, test_num+[-1])
     test_prediction = np.reshape(prediction, test_num+[-1])
     np.save(os.path.join(output_folder, 'test_target.npy'), test_target)
@@ -10,6 +10,7 @@ from keras import activations
 from keras.engine.topology import Layer, InputSpec
 from keras.utils import conv_utils
 from keras.layers import LSTM, InputLayer, Dense, Input, Flatten, concatenate, Reshape
+from keras.layers import Conv2D, Lambda, TimeDistributed
 from keras.callbacks import EarlyStopping, ModelCheckpoint
 from sklearn.preprocessing import MinMaxScaler
 from sklearn.metrics import mean_squared_error
@@ -96,34 +97,29 @@ class Local_Seq_Conv(Layer):
 def squared_error(y_true, y_pred):
     return K.sum(K.square(y_pred - y_true))
 
-def build_model(trainY, testY, trainimage, testimage, traintopo, testtopo,
-                feature_len,
-                minMax,
-                seq_len=8,
-                batch_size=64,
-                trainable=True,
-                name="MODEL",
-                model_path='./'):
-    print(testimage.shape)
+def build_patch_network(seq_len, feature_len, embedding=True):
+    """The per-cell network on local_image_size x local_image_size patches.
+    Without embedding, the network of model_2 (no topology input).
+    """
     # X_train, Y_train, X_test, Y_test = Featureset_get()
     image_input = Input(shape=(seq_len, local_image_size,
                                local_image_size, None), name='cnn_input')
     spatial = Local_Seq_Conv(output_dim=cnn_hidden_dim_first, seq_len=seq_len, feature_size=feature_len,
                              kernel_size=(3, 3, 1, cnn_hidden_dim_first), activation='relu',
                              kernel_initializer='glorot_uniform', bias_initializer='zeros', padding='same',
-                             strides=(1, 1))(image_input)
-    spatial = BatchNormalization()(spatial)
+                             strides=(1, 1), name='local_conv_1')(image_input)
+    spatial = BatchNormalization(name='local_bn_1')(spatial)
     # spatial = Local_Seq_Pooling(seq_len=seq_len)(spatial)
     spatial = Local_Seq_Conv(output_dim=cnn_hidden_dim_first, seq_len=seq_len, feature_size=feature_len,
                              kernel_size=(3, 3, cnn_hidden_dim_first, cnn_hidden_dim_first), activation='relu',
                              kernel_initializer='glorot_uniform', bias_initializer='zeros', padding='same',
-                             strides=(1, 1))(spatial)
-    spatial = BatchNormalization()(spatial)
+                             strides=(1, 1), name='local_conv_2')(spatial)
+    spatial = BatchNormalization(name='local_bn_2')(spatial)
     # spatial = Local_Seq_Pooling(seq_len=seq_len)(spatial)
     spatial = Local_Seq_Conv(output_dim=cnn_hidden_dim_first, seq_len=seq_len, feature_size=feature_len,
                              kernel_size=(3, 3, cnn_hidden_dim_first, cnn_hidden_dim_first), activation='relu',
                              kernel_initializer='glorot_uniform', bias_initializer='zeros', padding='same',
-                             strides=(1, 1))(spatial)
+                             strides=(1, 1), name='local_conv_3')(spatial)
     # spatial = Local_Seq_Pooling(seq_len=seq_len)(spatial)
     # spatial = BatchNormalization()(spatial)
     # spatial = Local_Seq_Conv(output_dim=cnn_hidden_dim_first, seq_len=seq_len, feature_size=feature_len, kernel_size=(3, 3, cnn_hidden_dim_first, cnn_hidden_dim_first), activation='relu', kernel_initializer='glorot_uniform', bias_initializer='zeros', padding='same', strides=(1, 1))(spatial)
@@ -132,7 +128,7 @@ def build_model(trainY, testY, trainimage, testimage, traintopo, testtopo,
     # spatial = Local_Seq_Conv(output_dim=cnn_hidden_dim_first, seq_len=seq_len, feature_size=feature_len, kernel_size=(3, 3, cnn_hidden_dim_first, cnn_hidden_dim_first), activation='relu', kernel_initializer='glorot_uniform', bias_initializer='zeros', padding='same', strides=(1, 1))(spatial)
     spatial = Flatten()(spatial)
     spatial = Reshape(target_shape=(seq_len, -1))(spatial)
-    spatial_out = Dense(units=64, activation='relu')(spatial)
+    spatial_out = Dense(units=64, activation='relu', name='spatial_dense')(spatial)
 
     # lstm_input = Input(shape=(seq_len, feature_len),
     #                    dtype='float32', name='lstm_input')
@@ -140,18 +136,154 @@ def build_model(trainY, testY, trainimage, testimage, traintopo, testtopo,
     # x = concatenate([lstm_input, spatial_out], axis=-1)
     x = spatial_out
     # lstm_out = Dense(units=128, activation=relu)(x)
-    lstm_out = LSTM(units=hidden_dim, return_sequences=False, dropout=0)(x)
+    lstm_out = LSTM(units=hidden_dim, return_sequences=False, dropout=0, name='lstm')(x)
+    if not embedding:
+        res = Dense(units=2, activation='sigmoid', name='output_dense')(lstm_out)
+        return Model(inputs=image_input, outputs=res)
 
     topo_input = Input(shape=(toponet_len,), dtype='float32', name='topo_input')
-    topo_emb = Dense(units=6, activation='tanh')(topo_input)
+    topo_emb = Dense(units=6, activation='tanh', name='topo_dense')(topo_input)
     static_dynamic_concate = concatenate([lstm_out, topo_emb], axis=-1)
 
     #res = Dense(units=1, activation='sigmoid')(static_dynamic_concate)
-    res = Dense(units=2, activation='sigmoid')(static_dynamic_concate)
+    res = Dense(units=2, activation='sigmoid', name='output_dense')(static_dynamic_concate)
     # model = Model(inputs=[image_input, lstm_input, topo_input],
     #               outputs=res)
     model = Model(inputs=[image_input, topo_input],
                   outputs=res)
+    return model
+
+
+def build_fcn_network(seq_len, feature_len, map_shape, cells, topo):
+    """A fully-convolutional variant of the patch network, predicting all cells at once.
+
+    The local convolutions run once on the whole map instead of on each overlapping patch,
+    and the Dense over a flattened patch of features becomes a local_image_size x
+    local_image_size valid convolution, read out at the cell centers.
+    This is a separate model, not the patch network with shared work: the 'same'
+    convolutions of a patch zero-pad at the patch border, so every cell of the patch sees
+    different features than in the map, and batch norm statistics come from whole maps.
+    It is trained and saved on its own, patch checkpoints do not load into it.
+    :param map_shape: (height, width) of the padded map.
+    :param cells: flat indices i*width+j of the cells in the padded map.
+    :param topo: [len(cells), toponet_len] embeddings of the cells, or None for the network
+        of model_2 without embeddings.
+    :return: model of [batch, seq_len, height, width, C] maps to [batch, len(cells), 2]
+    """
+    height, width = map_shape
+    padding = local_image_size // 2
+    num_cells = len(cells)
+    # centers in the output of the valid convolution
+    rows, cols = np.divmod(np.asarray(cells), width)
+    centers = K.constant((rows - padding) * (width - 2 * padding) + cols - padding, dtype='int32')
+    image_input = Input(shape=(seq_len, height, width, None), name='cnn_input')
+    spatial = Local_Seq_Conv(output_dim=cnn_hidden_dim_first, seq_len=seq_len, feature_size=feature_len,
+                             kernel_size=(3, 3, 1, cnn_hidden_dim_first), activation='relu',
+                             kernel_initializer='glorot_uniform', bias_initializer='zeros', padding='same',
+                             strides=(1, 1), name='local_conv_1')(image_input)
+    spatial = BatchNormalization(name='local_bn_1')(spatial)
+    spatial = Local_Seq_Conv(output_dim=cnn_hidden_dim_first, seq_len=seq_len, feature_size=feature_len,
+                             kernel_size=(3, 3, cnn_hidden_dim_first, cnn_hidden_dim_first), activation='relu',
+                             kernel_initializer='glorot_uniform', bias_initializer='zeros', padding='same',
+                             strides=(1, 1), name='local_conv_2')(spatial)
+    spatial = BatchNormalization(name='local_bn_2')(spatial)
+    spatial = Local_Seq_Conv(output_dim=cnn_hidden_dim_first, seq_len=seq_len, feature_size=feature_len,
+                             kernel_size=(3, 3, cnn_hidden_dim_first, cnn_hidden_dim_first), activation='relu',
+                             kernel_initializer='glorot_uniform', bias_initializer='zeros', padding='same',
+                             strides=(1, 1), name='local_conv_3')(spatial)
+    spatial = TimeDistributed(Conv2D(64, (local_image_size, local_image_size), padding='valid', activation='relu'),
+                              name='spatial_dense')(spatial)
+
+    def read_out(x):
+        # [batch, seq_len, h, w, 64] -> [batch*num_cells, seq_len, 64]
+        x = K.reshape(x, (-1, seq_len, (height - 2 * padding) * (width - 2 * padding), 64))
+        x = K.permute_dimensions(tf.gather(x, centers, axis=2), (0, 2, 1, 3))
+        return K.reshape(x, (-1, seq_len, 64))
+    x = Lambda(read_out, output_shape=(seq_len, 64))(spatial)
+    lstm_out = LSTM(units=hidden_dim, return_sequences=False, dropout=0, name='lstm')(x)
+    lstm_out = Lambda(lambda x: K.reshape(x, (-1, num_cells, hidden_dim)),
+                      output_shape=(num_cells, hidden_dim))(lstm_out)
+    if topo is None:
+        res = Dense(units=2, activation='sigmoid', name='output_dense')(lstm_out)
+        return Model(inputs=image_input, outputs=res)
+    # the same embeddings for every map of the batch
+    topo_input = Lambda(lambda x: K.tile(K.expand_dims(K.constant(topo), 0), (K.shape(x)[0], 1, 1)),
+                        output_shape=(num_cells, toponet_len))(image_input)
+    topo_emb = Dense(units=6, activation='tanh', name='topo_dense')(topo_input)
+    static_dynamic_concate = concatenate([lstm_out, topo_emb], axis=-1)
+    res = Dense(units=2, activation='sigmoid', name='output_dense')(static_dynamic_concate)
+    return Model(inputs=image_input, outputs=res)
+
+
+def build_fcn_model(trainY, testY, trainmap, testmap, cells, topo,
+                    feature_len,
+                    minMax,
+                    seq_len=8,
+                    batch_size=8,
+                    trainable=True,
+                    name="MODEL",
+                    model_path='./',
+                    testimage=None,
+                    rmse_tol=0.1):
+    """build_model in fully-convolutional mode, one sample per time step.
+
+    :param trainmap: [num_train, seq_len, height, width, C] padded input maps.
+    :param trainY: [num_train, len(cells), 2]
+    :param topo: embeddings of the cells, None for the network of model_2.
+    :param testimage: PatchSamples of the held-out test set; if given, the patch network
+        trained by build_model (DMVSTNet.best.h5) predicts it too, and an AssertionError is
+        raised if the test rmse of this model is more than rmse_tol (relative) above it.
+        This guards the accuracy of the separately trained model, the predictions of the
+        two networks are not compared one by one.
+    :return: test predictions, [num_test*len(cells), 2] in the order of build_model.
+    """
+    print(testmap.shape)
+    model = build_fcn_network(seq_len, feature_len, trainmap.shape[2:4], cells, topo)
+    sgd = Adam(lr=0.0002, beta_1=0.9, beta_2=0.999, epsilon=1e-08, decay=1e-6)
+    model.compile(loss=squared_error, optimizer=sgd, metrics=[metrics.mse])
+    earlyStopping = EarlyStopping(
+        monitor='val_loss', patience=5, verbose=0, mode='min')
+    fname_param = os.path.join(model_path, 'log', name)
+    if not os.path.exists(fname_param):
+        os.makedirs(fname_param)
+    patch_param = os.path.join(fname_param, 'DMVSTNet.best.h5')
+    fname_param = os.path.join(fname_param, 'DMVSTNet_fcn.best.h5')
+    # the Lambda layers close over the cell centers and embeddings, which a full model save cannot serialize
+    model_checkpoint = ModelCheckpoint(
+        fname_param, monitor='val_loss', verbose=0, save_best_only=True, save_weights_only=True, mode='min')
+    if trainable:
+        model.fit(trainmap, trainY, batch_size=batch_size, epochs=max_epoch, validation_split=0.1,
+                  callbacks=[earlyStopping, model_checkpoint])
+    else:
+        model.load_weights(fname_param)
+    score = model.evaluate(testmap, testY, batch_size=batch_size, verbose=0)
+    print('Test score: %.6f se (norm): %.6f se (real): %.6f' %
+          (score[0], score[1], minMax.inverse(minMax.inverse(score[1]))))
+    prediction = np.reshape(model.predict(testmap, batch_size=batch_size, verbose=0), (-1, 2))
+    test_rmse = minMax.inverse(get_metrics(np.reshape(testY, (-1, 2)), prediction, clip=False)['rmse'])
+    print('test mse is %.6f, and rmse : %.6f' % (np.square(test_rmse), test_rmse))
+    if testimage is not None:
+        patch_model = build_patch_network(seq_len, feature_len, embedding=topo is not None)
+        patch_model.load_weights(patch_param)
+        patch_prediction = patch_model.predict_generator(PatchSequence(testimage, batch_size * len(cells)))
+        patch_rmse = minMax.inverse(get_metrics(np.reshape(testY, (-1, 2)), patch_prediction, clip=False)['rmse'])
+        print('test rmse of the patch network: %.6f, of the fcn network: %.6f' % (patch_rmse, test_rmse))
+        if test_rmse > patch_rmse * (1 + rmse_tol):
+            raise AssertionError('fcn test rmse %.6f is more than %.1f%% above the patch network (%.6f)'
+                                 % (test_rmse, rmse_tol * 100, patch_rmse))
+    return prediction
+
+
+def build_model(trainY, testY, trainimage, testimage, traintopo, testtopo,
+                feature_len,
+                minMax,
+                seq_len=8,
+                batch_size=64,
+                trainable=True,
+                name="MODEL",
+                model_path='./'):
+    print(testimage.shape)
+    model = build_patch_network(seq_len, feature_len)
     #sgd = Adam(lr=0.001, beta_1=0.9, beta_2=0.999, epsilon=1e-08, decay=1e-6)
     sgd = Adam(lr=0.0002, beta_1=0.9, beta_2=0.999, epsilon=1e-08, decay=1e-6)
     #model.compile(loss=losses.mse, optimizer=sgd, metrics=[metrics.mse])
@@ -168,6 +300,10 @@ def build_model(trainY, testY, trainimage, testimage, traintopo, testtopo,
     # early_stopping = EarlyStopping(monitor='val_rmse', patience=5, mode='min')
     model_checkpoint = ModelCheckpoint(
         fname_param, monitor='val_loss', verbose=0, save_best_only=True, mode='min')
+    if isinstance(trainimage, PatchSamples):
+        # patches are gathered batch by batch
+        return fit_lazy(model, PatchSequence, trainimage, testimage, testY, minMax, batch_size, max_epoch,
+                        [earlyStopping, model_checkpoint], fname_param, trainable)
     if trainable:
         model.fit([trainimage, traintopo], trainY, batch_size=batch_size, epochs=max_epoch, validation_split=0.1,
                   callbacks=[earlyStopping, model_checkpoint])
@@ -190,8 +326,9 @@ def build_model(trainY, testY, trainimage, testimage, traintopo, testtopo,
 
     prediction = model.predict([testimage, testtopo], batch_size=batch_size, verbose=0)
     print(prediction.shape)
-    test_mse = minMax.inverse(minMax.inverse(np.mean(np.square(prediction - testY))))
-    print('test mse is %.6f, and rmse : %.6f' % (test_mse, np.sqrt(test_mse)))
+    # errors of normalized values, scaled back by minMax
+    test_rmse = minMax.inverse(get_metrics(testY, prediction, clip=False)['rmse'])
+    print('test mse is %.6f, and rmse : %.6f' % (np.square(test_rmse), test_rmse))
     return prediction
 
     # return model
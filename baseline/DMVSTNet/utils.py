@@ -1,9 +1,17 @@
+import sys
+import os
 import pickle
 import numpy as np
 import scipy.io as sio
 import scipy.sparse as sp
 from scipy.sparse import linalg
 from sklearn import preprocessing
+from keras.utils import Sequence
+# the shared metrics, embedding cache and lazy fit modules live at the top of the repo
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from metrics import get_metrics
+from embedding_table import load_embedding_table
+from lazy_fit import fit_lazy
 
 class StrToBytes:
     def __init__(self, fileobj):
@@ -138,52 +146,123 @@ def batch_data(d_data, f_data, batch_size=32, input_steps=10, output_steps=10):
     return x, y, f
 
 def get_embedding_from_file(file, num):
-    with open(file, 'r') as df:
-        lines = df.readlines()
-        _, dim = lines[0].split(' ', 1)
-        #num = int(num)
-        dim = int(dim)
-        embeddings = np.zeros((num, dim), dtype=np.float32)
-        for line in lines[1:]:
-            label, v_str = line.split(' ', 1)
-            v = [float(e) for e in v_str.split()]
-            embeddings[int(label)] = v
+    ids, vectors = load_embedding_table(file)
+    embeddings = np.zeros((num, vectors.shape[1]), dtype=np.float32)
+    embeddings[ids] = vectors
     return embeddings
 
+class PatchSamples(object):
+    """Local CNN samples: the (input_length, image_size, image_size) patch around each valid
+    cell at each time, with its target and embedding, gathered only when indexed.
+
+    The patches come from a sliding_window_view of map_data, a strided view, so the
+    [num_samples, input_length, image_size, image_size, C] tensor is never materialized
+    unless asked for with patches(np.arange(len(samples))).
+    :param map_data: [T, H, W, C], padded so that the patches of all cells fit.
+    :param times: the times t of the targets, t major order of the samples.
+    :param cells: flat indices i*W+j of the valid cells.
+    :param embedding: [len(cells), dim] embeddings of the cells, or None.
+    """
+    def __init__(self, map_data, input_length, image_size, times, cells, embedding=None):
+        self.map_data = map_data
+        self.input_length = input_length
+        self.padding = image_size // 2
+        self.embedding = embedding
+        # [T-input_length+1, H-image_size+1, W-image_size+1, C, input_length, image_size, image_size]
+        self.windows = np.lib.stride_tricks.sliding_window_view(
+            map_data, (input_length, image_size, image_size), axis=(0, 1, 2))
+        self.t = np.repeat(np.asarray(times), len(cells))
+        self.cell = np.tile(np.arange(len(cells)), len(times))
+        self.i, self.j = np.divmod(np.asarray(cells), map_data.shape[2])
+
+    def __len__(self):
+        return len(self.t)
+
+    @property
+    def shape(self):
+        # shape of the patch tensor the samples stand for
+        return (len(self.t),) + self.windows.shape[4:] + self.windows.shape[3:4]
+
+    def subset(self, index):
+        samples = object.__new__(PatchSamples)
+        samples.__dict__.update(self.__dict__)
+        samples.t, samples.cell = self.t[index], self.cell[index]
+        return samples
+
+    def patches(self, index):
+        t, cell = self.t[index], self.cell[index]
+        patches = self.windows[t - self.input_length, self.i[cell] - self.padding, self.j[cell] - self.padding]
+        return np.transpose(patches, (0, 2, 3, 4, 1))
+
+    def targets(self, index):
+        cell = self.cell[index]
+        return self.map_data[self.t[index], self.i[cell], self.j[cell]]
+
+    def embeddings(self, index):
+        return self.embedding[self.cell[index]]
+
+    def maps(self):
+        """Whole input maps of the times of the samples, [num_times, input_length, H, W, C],
+        for the fully-convolutional mode of the local CNN.
+        """
+        times = np.unique(self.t)
+        return self.map_data[times[:, np.newaxis] - self.input_length + np.arange(self.input_length)]
+
+    def cells(self):
+        return self.i * self.map_data.shape[2] + self.j
+
+
+def get_patch_samples(map_data, embedding_data, input_length, image_size, times):
+    """PatchSamples of the cells with an embedding (all cells if embedding_data is None),
+    in the order of the former loops over t, i and j.
+
+    :param embedding_data: dict of flat cell index i*W+j to its embedding.
+    """
+    padding = image_size // 2
+    height, width = map_data.shape[1:3]
+    rows, cols = np.meshgrid(np.arange(padding, height - padding), np.arange(padding, width - padding), indexing='ij')
+    cells = (rows * width + cols).ravel()
+    embedding = None
+    if embedding_data is not None:
+        cells = cells[np.array([c in embedding_data for c in cells.tolist()], dtype=bool)]
+        embedding = np.asarray([embedding_data[c] for c in cells.tolist()])
+    return PatchSamples(map_data, input_length, image_size, times, cells, embedding)
+
+
+class PatchSequence(Sequence):
+    """Keras batches of PatchSamples: ([patches, embeddings], targets), or (patches, targets)
+    without embeddings. Only one batch of patches is copied at a time.
+    """
+    def __init__(self, samples, batch_size, shuffle=False):
+        self.samples = samples
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.order = np.arange(len(samples))
+        self.on_epoch_end()
+
+    def __len__(self):
+        return int(np.ceil(len(self.samples) / float(self.batch_size)))
+
+    def __getitem__(self, idx):
+        index = self.order[idx * self.batch_size:(idx + 1) * self.batch_size]
+        x = self.samples.patches(index)
+        if self.samples.embedding is not None:
+            x = [x, self.samples.embeddings(index)]
+        return x, self.samples.targets(index)
+
+    def on_epoch_end(self):
+        if self.shuffle:
+            np.random.shuffle(self.order)
+
+
 def get_loss(y, y_out):
     # y, y_out: [num_station, 2]
-    # check-in loss
-    # y = np.transpose(y)
-    # y_out = np.transpose(y_out)
-    y = np.clip(y, 0, None)
-    y_out = np.clip(y_out, 0, None)
-    in_rmse = np.sqrt(np.mean(np.square(y_out[:,0]-y[:,0])))
-    out_rmse = np.sqrt(np.mean(np.square(y_out[:,1]-y[:,1])))
-    in_rmlse = np.sqrt(np.mean(np.square(np.log(y_out[:,0] + 1)-np.log(y[:,0] + 1))))
-    out_rmlse = np.sqrt(np.mean(np.square(np.log(y_out[:,1] + 1)-np.log(y[:,1] + 1))))
-    in_sum = np.max((np.sum(y[:,0]), 1))
-    out_sum = np.max((np.sum(y[:,1]), 1))
-    #print in_sum.shape
-    in_er = np.sum(np.abs(y_out[:,0]-y[:,0]))/in_sum
-    out_er = np.sum(np.abs(y_out[:,1]-y[:,1]))/out_sum
-    #print in_sum
-    #print in_er
-    return [in_rmse, out_rmse, in_rmlse, out_rmlse, in_er, out_er]
+    # in_rmse, out_rmse, in_rmlse, out_rmlse, in_er, out_er
+    m = get_metrics(y, y_out, keep_axes=(1,))
+    return [v for name in ('rmse', 'rmlse', 'er') for v in m[name]]
 
 def get_loss_by_batch(y, y_out):
     # y, y_out: [batch_size, num_station, 2]
-    # check-in loss
-    y = np.clip(y, 0, None)
-    y_out = np.clip(y_out, 0, None)
-    in_rmse = np.sum(np.sqrt(np.mean(np.square(y_out[:,:,0]-y[:,:,0]), -1)))
-    out_rmse = np.sum(np.sqrt(np.mean(np.square(y_out[:,:,1]-y[:,:,1]), -1)))
-    in_rmlse = np.sum(np.sqrt(np.mean(np.square(np.log(y_out[:,:,0] + 1)-np.log(y[:,:,0] + 1)), -1)))
-    out_rmlse = np.sum(np.sqrt(np.mean(np.square(np.log(y_out[:,:,1] + 1)-np.log(y[:,:,1] + 1)), -1)))
-    in_sum = np.clip(np.sum(y[:,:,0], -1), 1, None)
-    out_sum = np.clip(np.sum(y[:,:,1], -1), 1, None)
-    #print in_sum.shape
-    in_er = np.sum(np.sum(np.abs(y_out[:,:,0]-y[:,:,0]), axis=-1)/in_sum)
-    out_er = np.sum(np.sum(np.abs(y_out[:,:,1]-y[:,:,1]), axis=-1)/out_sum)
-    #print in_sum
-    #print in_er
-    return [in_rmse, out_rmse, in_rmlse, out_rmlse, in_er, out_er]
+    # metrics of each sample, summed over the batch
+    m = get_metrics(y, y_out, keep_axes=(0, 2))
+    return [v for name in ('rmse', 'rmlse', 'er') for v in np.sum(m[name], axis=0)]
@@ -13,55 +13,24 @@ from minMax import *
 
 
 
-def prepare_data_padding(input_length, map_data, flow_data, split, nb_size=7):
-    padding = int(nb_size / 2)
-    #
-    raw_map_shape = map_data.shape
-    padding_map_data = np.zeros((raw_map_shape[0], raw_map_shape[1]+2*padding, raw_map_shape[2]+2*padding, raw_map_shape[3]), dtype=np.float32)
-    padding_map_data[:, padding:-padding, padding:-padding, :] = map_data
-    #
-    height = padding_map_data.shape[1]
-    width = padding_map_data.shape[2]
-    #
-    index = np.ones((height, width), dtype=np.int32) * (-1)
-    index[padding:-padding, padding:-padding] = np.reshape(np.arange(raw_map_shape[1]*raw_map_shape[2]), (raw_map_shape[1], raw_map_shape[2]))
-    #
-    train_image_x = []
-    train_y = []
-    train_flow = []
-    test_image_x = []
-    test_y = []
-    test_flow = []
-    for t in range(input_length, split[0]):
-        for i in range(padding, height - padding):
-            for j in range(padding, width - padding):
-                train_image_x.append(padding_map_data[t-input_length:t, i - padding:i + padding+1, j - padding:j + padding+1, :])
-                train_y.append(padding_map_data[t, i, j, :])
-                #
-                ij_index = (i-padding) * raw_map_shape[2] + (j-padding)
-                nb_index = index[i-padding: i+padding+1, j-padding:j+padding+1].flatten()
-                ij_flow = flow_data[t-input_length:t, ij_index, nb_index]
-                ij_flow[:, np.nonzero(nb_index<0)[0]] = 0
-                ij_flow = np.expand_dims(np.reshape(ij_flow, (-1, nb_size, nb_size)), -1)
-                train_flow.append(ij_flow)
-    for t in range(np.sum(split[:-1]) + input_length, np.sum(split)):
-        for i in range(padding, height - padding):
-            for j in range(padding, width - padding):
-                test_image_x.append(padding_map_data[t-input_length:t, i - padding:i + padding+1, j - padding:j + padding+1, :])
-                test_y.append(padding_map_data[t, i, j, :])
-                #
-                ij_index = (i-padding) * raw_map_shape[2] + (j-padding)
-                nb_index = index[i - padding: i + padding + 1, j - padding:j + padding + 1].flatten()
-                ij_flow = flow_data[t-input_length:t, ij_index, nb_index]
-                ij_flow[:, np.nonzero(nb_index<0)[0]] = 0
-                ij_flow = np.expand_dims(np.reshape(ij_flow, (-1, nb_size, nb_size)), -1)
-                test_flow.append(ij_flow)
-    train_image_x = np.asarray(train_image_x)
-    train_flow = np.asarray(train_flow)
-    train_y = np.asarray(train_y)
-    test_flow = np.asarray(test_flow)
-    test_image_x = np.asarray(test_image_x)
-    test_y = np.asarray(test_y)
+def prepare_data_padding(input_length, map_data, flow_data, split, nb_size=7, lazy=False):
+    """Neighborhood maps, flows and targets of the train and test samples.
+
+    With lazy, the train and test inputs are NeighborSamples (flows None) that keras
+    gathers batch by batch through NeighborSequence.
+    """
+    train_samples = NeighborSamples(map_data, flow_data, input_length, nb_size, np.arange(input_length, split[0]))
+    test_samples = NeighborSamples(map_data, flow_data, input_length, nb_size,
+                                   np.arange(np.sum(split[:-1]) + input_length, np.sum(split)))
+    train_y = train_samples.targets(slice(None))
+    test_y = test_samples.targets(slice(None))
+    if lazy:
+        return train_samples, None, train_y, test_samples, None, test_y, \
+               [np.sum(split) - np.sum(split[:-1]) - input_length]
+    train_image_x = train_samples.images(slice(None))
+    train_flow = train_samples.flows(slice(None))
+    test_image_x = test_samples.images(slice(None))
+    test_flow = test_samples.flows(slice(None))
     print(train_image_x.shape)
     print(train_flow.shape)
     print(train_y.shape)
@@ -84,6 +53,8 @@ def main():
     parse.add_argument('-dim', '--dim', type=int, default=0, help='dim of data to be processed')
     parse.add_argument('-trainable', '--trainable', type=int, default=1, help='if to train (1) or to test (0)')
     parse.add_argument('-batch_size', '--batch_size', type=int, default=64)
+    parse.add_argument('-lazy', '--lazy', type=int, default=0,
+                       help='gather the inputs of each batch on the fly (1) instead of building all of them (0)')
     #
     args = parse.parse_args()
     os.environ['CUDA_VISIBLE_DEVICES'] = args.gpu
@@ -130,7 +101,8 @@ def main():
     # prepare data
     train_x, train_flow, train_y, test_x, test_flow, test_y, test_num = prepare_data_padding(args.input_steps,
                                                                                              data, f_data,
-                                                                                             split, 7)
+                                                                                             split, 7,
+                                                                                             lazy=args.lazy)
     print(test_num)
     # set gpu config
     config = tf.ConfigProto()
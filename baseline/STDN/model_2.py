@@ -194,6 +194,10 @@ def build_model(trainY, testY, trainX, testX, train_flow, test_flow,
     # early_stopping = EarlyStopping(monitor='val_rmse', patience=5, mode='min')
     model_checkpoint = ModelCheckpoint(
         fname_param, monitor='val_loss', verbose=0, save_best_only=True, mode='min')
+    if isinstance(trainX, NeighborSamples):
+        # inputs are gathered batch by batch
+        return fit_lazy(model, NeighborSequence, trainX, testX, testY, minMax, batch_size, max_epoch,
+                        [earlyStopping, model_checkpoint], fname_param, trainable)
     if trainable:
         model.fit([trainX, train_flow], trainY, batch_size=batch_size, epochs=max_epoch, validation_split=0.1,
                   callbacks=[earlyStopping, model_checkpoint])
@@ -216,8 +220,9 @@ def build_model(trainY, testY, trainX, testX, train_flow, test_flow,
 
     prediction = model.predict([testX, test_flow], batch_size=batch_size, verbose=0)
     print(prediction.shape)
-    test_mse = minMax.inverse(minMax.inverse(np.mean(np.square(prediction - testY))))
-    print('test mse is %.6f, and rmse : %.6f' % (test_mse, np.sqrt(test_mse)))
+    # errors of normalized values, scaled back by minMax
+    test_rmse = minMax.inverse(get_metrics(testY, prediction, clip=False)['rmse'])
+    print('test mse is %.6f, and rmse : %.6f' % (np.square(test_rmse), test_rmse))
     return prediction
 
     # return model
@@ -1,9 +1,16 @@
+import sys
+import os
 import pickle
 import numpy as np
 import scipy.io as sio
 import scipy.sparse as sp
 from scipy.sparse import linalg
 from sklearn import preprocessing
+from keras.utils import Sequence
+# the shared metrics and lazy fit modules live at the top of the repo
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from metrics import get_metrics
+from lazy_fit import fit_lazy
 
 class StrToBytes:
     def __init__(self, fileobj):
@@ -150,40 +157,109 @@ def get_embedding_from_file(file, num):
             embeddings[int(label)] = v
     return embeddings
 
+def get_neighbor_index(height, width, nb_size):
+    """Flat index r*W+c of the nb_size x nb_size neighbors of each cell, row major, -1 off the map.
+
+    :return: [height*width, nb_size*nb_size]
+    """
+    padding = nb_size // 2
+    d_row, d_col = np.meshgrid(np.arange(-padding, padding + 1), np.arange(-padding, padding + 1), indexing='ij')
+    rows = np.arange(height)[:, np.newaxis, np.newaxis, np.newaxis] + d_row
+    cols = np.arange(width)[np.newaxis, :, np.newaxis, np.newaxis] + d_col
+    valid = (rows >= 0) & (rows < height) & (cols >= 0) & (cols < width)
+    return np.where(valid, rows * width + cols, -1).reshape(height * width, nb_size * nb_size)
+
+
+class NeighborSamples(object):
+    """STDN samples: for each cell at each time, the last input_length maps of its
+    nb_size x nb_size neighborhood and the flows from the cell to those neighbors.
+
+    Samples are (t, cell) indices in t major order. Neighborhoods come from a
+    sliding_window_view of the zero-padded map and flows from one gather with the
+    neighbor index table, so any index set is built in a single batched gather.
+    :param map_data: [T, H, W, C]
+    :param flow_data: [T, H*W, H*W], may be a memmap.
+    :param times: the times t of the targets.
+    """
+    def __init__(self, map_data, flow_data, input_length, nb_size, times):
+        padding = nb_size // 2
+        num_slots, height, width, channels = map_data.shape
+        self.map_data = np.zeros((num_slots, height + 2 * padding, width + 2 * padding, channels), dtype=np.float32)
+        self.map_data[:, padding:-padding, padding:-padding, :] = map_data
+        self.flow_data = flow_data
+        self.input_length = input_length
+        self.nb_size = nb_size
+        self.padding = padding
+        # [T-input_length+1, H, W, C, input_length, nb_size, nb_size]
+        self.windows = np.lib.stride_tricks.sliding_window_view(
+            self.map_data, (input_length, nb_size, nb_size), axis=(0, 1, 2))
+        nb_index = get_neighbor_index(height, width, nb_size)
+        self.nb_valid = nb_index >= 0
+        self.nb_index = np.maximum(nb_index, 0)
+        self.t = np.repeat(np.asarray(times), height * width)
+        self.cell = np.tile(np.arange(height * width), len(times))
+        self.i, self.j = np.divmod(np.arange(height * width), width)
+
+    def __len__(self):
+        return len(self.t)
+
+    @property
+    def shape(self):
+        # shape of the neighborhood map tensor the samples stand for
+        return (len(self.t),) + self.windows.shape[4:] + self.windows.shape[3:4]
+
+    def subset(self, index):
+        samples = object.__new__(NeighborSamples)
+        samples.__dict__.update(self.__dict__)
+        samples.t, samples.cell = self.t[index], self.cell[index]
+        return samples
+
+    def images(self, index):
+        t, cell = self.t[index], self.cell[index]
+        images = self.windows[t - self.input_length, self.i[cell], self.j[cell]]
+        return np.transpose(images, (0, 2, 3, 4, 1))
+
+    def flows(self, index):
+        t, cell = self.t[index], self.cell[index]
+        steps = (t - self.input_length)[:, np.newaxis, np.newaxis] + np.arange(self.input_length)[:, np.newaxis]
+        flows = self.flow_data[steps, cell[:, np.newaxis, np.newaxis], self.nb_index[cell][:, np.newaxis, :]]
+        flows = flows * self.nb_valid[cell][:, np.newaxis, :]
+        return np.reshape(flows, (len(t), self.input_length, self.nb_size, self.nb_size, 1))
+
+    def targets(self, index):
+        cell = self.cell[index]
+        return self.map_data[self.t[index], self.i[cell] + self.padding, self.j[cell] + self.padding]
+
+
+class NeighborSequence(Sequence):
+    """Keras batches ([images, flows], targets) of NeighborSamples, one batch gathered at a time."""
+    def __init__(self, samples, batch_size, shuffle=False):
+        self.samples = samples
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.order = np.arange(len(samples))
+        self.on_epoch_end()
+
+    def __len__(self):
+        return int(np.ceil(len(self.samples) / float(self.batch_size)))
+
+    def __getitem__(self, idx):
+        index = self.order[idx * self.batch_size:(idx + 1) * self.batch_size]
+        return [self.samples.images(index), self.samples.flows(index)], self.samples.targets(index)
+
+    def on_epoch_end(self):
+        if self.shuffle:
+            np.random.shuffle(self.order)
+
+
 def get_loss(y, y_out):
     # y, y_out: [num_station, 2]
-    # check-in loss
-    # y = np.transpose(y)
-    # y_out = np.transpose(y_out)
-    y = np.clip(y, 0, None)
-    y_out = np.clip(y_out, 0, None)
-    in_rmse = np.sqrt(np.mean(np.square(y_out[:,0]-y[:,0])))
-    out_rmse = np.sqrt(np.mean(np.square(y_out[:,1]-y[:,1])))
-    in_rmlse = np.sqrt(np.mean(np.square(np.log(y_out[:,0] + 1)-np.log(y[:,0] + 1))))
-    out_rmlse = np.sqrt(np.mean(np.square(np.log(y_out[:,1] + 1)-np.log(y[:,1] + 1))))
-    in_sum = np.max((np.sum(y[:,0]), 1))
-    out_sum = np.max((np.sum(y[:,1]), 1))
-    #print in_sum.shape
-    in_er = np.sum(np.abs(y_out[:,0]-y[:,0]))/in_sum
-    out_er = np.sum(np.abs(y_out[:,1]-y[:,1]))/out_sum
-    #print in_sum
-    #print in_er
-    return [in_rmse, out_rmse, in_rmlse, out_rmlse, in_er, out_er]
+    # in_rmse, out_rmse, in_rmlse, out_rmlse, in_er, out_er
+    m = get_metrics(y, y_out, keep_axes=(1,))
+    return [v for name in ('rmse', 'rmlse', 'er') for v in m[name]]
 
 def get_loss_by_batch(y, y_out):
     # y, y_out: [batch_size, num_station, 2]
-    # check-in loss
-    y = np.clip(y, 0, None)
-    y_out = np.clip(y_out, 0, None)
-    in_rmse = np.sum(np.sqrt(np.mean(np.square(y_out[:,:,0]-y[:,:,0]), -1)))
-    out_rmse = np.sum(np.sqrt(np.mean(np.square(y_out[:,:,1]-y[:,:,1]), -1)))
-    in_rmlse = np.sum(np.sqrt(np.mean(np.square(np.log(y_out[:,:,0] + 1)-np.log(y[:,:,0] + 1)), -1)))
-    out_rmlse = np.sum(np.sqrt(np.mean(np.square(np.log(y_out[:,:,1] + 1)-np.log(y[:,:,1] + 1)), -1)))
-    in_sum = np.clip(np.sum(y[:,:,0], -1), 1, None)
-    out_sum = np.clip(np.sum(y[:,:,1], -1), 1, None)
-    #print in_sum.shape
-    in_er = np.sum(np.sum(np.abs(y_out[:,:,0]-y[:,:,0]), axis=-1)/in_sum)
-    out_er = np.sum(np.sum(np.abs(y_out[:,:,1]-y[:,:,1]), axis=-1)/out_sum)
-    #print in_sum
-    #print in_er
-    return [in_rmse, out_rmse, in_rmlse, out_rmlse, in_er, out_er]
+    # metrics of each sample, summed over the batch
+    m = get_metrics(y, y_out, keep_axes=(0, 2))
+    return [v for name in ('rmse', 'rmlse', 'er') for v in np.sum(m[name], axis=0)]
@@ -7,6 +7,7 @@
 
 from utils.math_utils import z_score
 
+import os
 import numpy as np
 import pandas as pd
 import tensorflow as tf
@@ -19,6 +20,7 @@ class Dataset(object):
         self.std = stats['std']
 
     def get_data(self, type):
+        # raw sequence units, z-scored per batch by gen_batch(..., stats=get_stats())
         return self.__data[type]
 
     def get_stats(self):
@@ -28,7 +30,54 @@ class Dataset(object):
         return len(self.__data[type])
 
     def z_inverse(self, type):
-        return self.__data[type] * self.std + self.mean
+        return self.__data[type][:]
+
+
+class SeqWindows(object):
+    '''
+    Standard sequence units as a strided view of the source series, nothing is copied
+    until a batch is indexed.
+    Indexing works like on the [len_seq, n_frame, n_route, C_0] array it stands for,
+    e.g. windows[idx] or windows[0:len_seq, step_idx + n_his, :, :].
+    :param data_seq: np.ndarray, [len_data, n_route, C_0], source data / time-series.
+    :param starts: np.ndarray, [len_seq], index of the first frame of each unit in data_seq.
+    :param n_frame: int, the number of frame within a standard sequence unit.
+    '''
+    def __init__(self, data_seq, starts, n_frame):
+        self.data_seq = data_seq
+        self.starts = np.asarray(starts, dtype=np.int64)
+        self.n_frame = n_frame
+        # [len_data - n_frame + 1, n_frame, n_route, C_0]
+        self.windows = np.moveaxis(np.lib.stride_tricks.sliding_window_view(data_seq, n_frame, axis=0), -1, 1)
+
+    def __len__(self):
+        return len(self.starts)
+
+    @property
+    def shape(self):
+        return (len(self.starts),) + self.windows.shape[1:]
+
+    def __getitem__(self, key):
+        key = key if isinstance(key, tuple) else (key,)
+        starts = self.starts[key[0]]
+        if len(key) > 1 and np.ndim(starts) > 0 and np.ndim(key[1]) > 0:
+            # outer indexing of units and frames, as for a slice followed by an index array
+            starts = starts[:, None]
+        return self.windows[(starts,) + key[1:]]
+
+    def get_stats(self):
+        '''
+        Mean and standard deviation over all units, each frame weighted by the number
+        of units it appears in, without materializing the units.
+        :return: dict, the value of mean and standard deviation.
+        '''
+        frames = (self.starts[:, None] + np.arange(self.n_frame)).reshape(-1)
+        counts = np.bincount(frames, minlength=len(self.data_seq)).astype(np.float64)
+        counts = counts.reshape((-1,) + (1,) * (self.data_seq.ndim - 1))
+        total = counts.sum() * np.prod(self.data_seq.shape[1:])
+        mean = np.sum(counts * self.data_seq) / total
+        std = np.sqrt(np.sum(counts * np.square(self.data_seq - mean)) / total)
+        return {'mean': float(mean), 'std': float(std)}
 
 
 def seq_gen(len_seq, data_seq, offset, n_frame, n_route, day_slot, C_0=1):
@@ -42,17 +91,27 @@ def seq_gen(len_seq, data_seq, offset, n_frame, n_route, day_slot, C_0=1):
     :param n_route: int, the number of routes in the graph.
     :param day_slot: int, the number of time slots per day, controlled by the time window (5 min as default).
     :param C_0: int, the size of input channel.
-    :return: np.ndarray, [len_seq, n_frame, n_route, C_0].
+    :return: SeqWindows, [len_seq * n_slot, n_frame, n_route, C_0].
     '''
     n_slot = day_slot - n_frame + 1
 
-    tmp_seq = np.zeros((len_seq * n_slot, n_frame, n_route, C_0))
-    for i in range(len_seq):
-        for j in range(n_slot):
-            sta = (i + offset) * day_slot + j
-            end = sta + n_frame
-            tmp_seq[i * n_slot + j, :, :, :] = np.reshape(data_seq[sta:end, :], [n_frame, n_route, C_0])
-    return tmp_seq
+    data_seq = np.reshape(data_seq[offset * day_slot:(offset + len_seq) * day_slot], [-1, n_route, C_0])
+    # units never cross the end of a day
+    starts = (np.arange(len_seq)[:, None] * day_slot + np.arange(n_slot)).reshape(-1)
+    return SeqWindows(data_seq, starts, n_frame)
+
+
+def load_csv(file_path):
+    '''
+    Load a csv source file through a cached binary copy (.npy next to the csv),
+    which is rebuilt when the csv is newer.
+    :param file_path: str, the file path of data source.
+    :return: np.ndarray, memory-mapped source data.
+    '''
+    cache_path = os.path.splitext(file_path)[0] + '.npy'
+    if not os.path.isfile(cache_path) or os.path.getmtime(cache_path) < os.path.getmtime(file_path):
+        np.save(cache_path, pd.read_csv(file_path, header=None).values)
+    return np.load(cache_path, mmap_mode='r')
 
 
 def data_gen(file_path, data_config, n_route, n_frame=21, day_slot=288):
@@ -69,7 +128,7 @@ def data_gen(file_path, data_config, n_route, n_frame=21, day_slot=288):
     n_train, n_val, n_test = data_config
     # generate training, validation and test data
     try:
-        data_seq = pd.read_csv(file_path, header=None).values
+        data_seq = load_csv(file_path)
     except FileNotFoundError:
         print(f'ERROR: input file was not found in {file_path}.')
 
@@ -78,14 +137,10 @@ def data_gen(file_path, data_config, n_route, n_frame=21, day_slot=288):
     seq_test = seq_gen(n_test, data_seq, n_train + n_val, n_frame, n_route, day_slot)
 
     # x_stats: dict, the stats for the train dataset, including the value of mean and standard deviation.
-    x_stats = {'mean': np.mean(seq_train), 'std': np.std(seq_train)}
+    x_stats = seq_train.get_stats()
 
-    # x_train, x_val, x_test: np.array, [sample_size, n_frame, n_route, channel_size].
-    x_train = z_score(seq_train, x_stats['mean'], x_stats['std'])
-    x_val = z_score(seq_val, x_stats['mean'], x_stats['std'])
-    x_test = z_score(seq_test, x_stats['mean'], x_stats['std'])
-
-    x_data = {'train': x_train, 'val': x_val, 'test': x_test}
+    # x_train, x_val, x_test: SeqWindows, [sample_size, n_frame, n_route, channel_size], z-scored per batch.
+    x_data = {'train': seq_train, 'val': seq_val, 'test': seq_test}
     dataset = Dataset(x_data, x_stats)
     return dataset
 
@@ -138,10 +193,8 @@ def get_rescaled_W(w, delta=1e7, epsilon=0.8):
 
 def seq_gen_2(data_seq, n_frame, n_route, channels):
     num = len(data_seq) - n_frame + 1
-    tmp_seq = np.zeros((num, n_frame, n_route, channels))
-    for i in range(num):
-        tmp_seq[i] = data_seq[i: i+n_frame]
-    return tmp_seq
+    data_seq = np.reshape(data_seq, [-1, n_route, channels])
+    return SeqWindows(data_seq, np.arange(num), n_frame)
 
 def data_gen_2(filename, split, n_frame=21):
     # generate training, validation and test data
@@ -163,24 +216,21 @@ def data_gen_2(filename, split, n_frame=21):
     seq_test = seq_gen_2(test, n_frame, n_route, test.shape[-1])
 
     # x_stats: dict, the stats for the train dataset, including the value of mean and standard deviation.
-    x_stats = {'mean': np.mean(seq_train), 'std': np.std(seq_train)}
-
-    # x_train, x_val, x_test: np.array, [sample_size, n_frame, n_route, channel_size].
-    x_train = z_score(seq_train, x_stats['mean'], x_stats['std'])
-    x_val = z_score(seq_val, x_stats['mean'], x_stats['std'])
-    x_test = z_score(seq_test, x_stats['mean'], x_stats['std'])
+    x_stats = seq_train.get_stats()
 
-    x_data = {'train': x_train, 'val': x_val, 'test': x_test}
+    # x_train, x_val, x_test: SeqWindows, [sample_size, n_frame, n_route, channel_size], z-scored per batch.
+    x_data = {'train': seq_train, 'val': seq_val, 'test': seq_test}
     dataset = Dataset(x_data, x_stats)
     return dataset, n_route
 
-def gen_batch(inputs, batch_size, dynamic_batch=False, shuffle=False):
+def gen_batch(inputs, batch_size, dynamic_batch=False, shuffle=False, stats=None):
     '''
     Data iterator in batch.
-    :param inputs: np.ndarray, [len_seq, n_frame, n_route, C_0], standard sequence units.
+    :param inputs: np.ndarray or SeqWindows, [len_seq, n_frame, n_route, C_0], standard sequence units.
     :param batch_size: int, the size of batch.
     :param dynamic_batch: bool, whether changes the batch size in the last batch if its length is less than the default.
     :param shuffle: bool, whether shuffle the batches.
+    :param stats: dict, paras of z-scores (mean & std) applied to each batch, None for raw batches.
     '''
     len_inputs = len(inputs)
 
@@ -200,4 +250,7 @@ def gen_batch(inputs, batch_size, dynamic_batch=False, shuffle=False):
         else:
             slide = slice(start_idx, end_idx)
 
-        yield inputs[slide]
+        if stats is None:
+            yield inputs[slide]
+        else:
+            yield z_score(inputs[slide], stats['mean'], stats['std'])
@@ -32,6 +32,8 @@ parser.add_argument('-model_save', '--model_save', type=str, default='', help='p
 parser.add_argument('-trained_adj_mx', '--trained_adj_mx', type=int, default=0, help='if training adjacent matrix')
 parser.add_argument('-delta', '--delta', type=int, default=1e7, help='delta to calculate rescaled weighted matrix')
 parser.add_argument('-epsilon', '--epsilon', type=float, default=0.8, help='epsilon to calculate rescaled weighted matrix')
+parser.add_argument('-sparse_graph', '--sparse_graph', type=int, default=1,
+                    help='if applying the Chebyshev polynomials recursively on a sparse Laplacian')
 #
 parser.add_argument('--n_route', type=int, default=0)
 parser.add_argument('--n_his', type=int, default=6)
@@ -85,9 +87,12 @@ else:
     W = get_rescaled_W(w, delta=args.delta, epsilon=args.epsilon)
     # Calculate graph kernel
     L = scaled_laplacian(W)
-    # Alternative approximation method: 1st approx - first_approx(W, n).
-    Lk = cheb_poly_approx(L, Ks, n)
-    tf.add_to_collection(name='graph_kernel', value=tf.cast(tf.constant(Lk), tf.float32))
+    if args.sparse_graph:
+        tf.add_to_collection(name='graph_laplacian', value=sparse_laplacian_tf(L))
+    else:
+        # Alternative approximation method: 1st approx - first_approx(W, n).
+        Lk = cheb_poly_approx(L, Ks, n)
+        tf.add_to_collection(name='graph_kernel', value=tf.cast(tf.constant(Lk), tf.float32))
 
 
 
@@ -10,18 +10,17 @@ from os.path import join as pjoin
 import tensorflow as tf
 
 
-def build_model(inputs, n_his, Ks, Kt, blocks, keep_prob):
+def build_network(x, n_his, Ks, Kt, blocks, keep_prob):
     '''
-    Build the base model.
-    :param inputs: placeholder.
+    ST-Blocks and the output layer, mapping n_his frames to a single-step prediction.
+    :param x: tensor, [batch_size, n_his, n_route, C_0].
     :param n_his: int, size of historical records for training.
     :param Ks: int, kernel size of spatial convolution.
     :param Kt: int, kernel size of temporal convolution.
     :param blocks: list, channel configs of st_conv blocks.
     :param keep_prob: placeholder.
+    :return: tensor, [batch_size, 1, n_route, C_0].
     '''
-    x = inputs[:, 0:n_his, :, :]
-
     # Ko>0: kernel size of temporal convolution in the output layer.
     Ko = n_his
     # ST-Block
@@ -31,16 +30,57 @@ def build_model(inputs, n_his, Ks, Kt, blocks, keep_prob):
 
     # Output Layer
     if Ko > 1:
-        y = output_layer(x, Ko, 'output_layer')
+        return output_layer(x, Ko, 'output_layer')
     else:
         raise ValueError(f'ERROR: kernel size Ko must be greater than 1, but received "{Ko}".')
 
+
+def build_rollout(inputs, n_his, Ks, Kt, blocks, keep_prob):
+    '''
+    Autoregressive multi-step prediction in one session call: a while_loop feeds each
+    prediction back as the latest frame, reusing the variables of build_network.
+    The number of steps is the placeholder 'n_pred' (1 by default).
+    :param inputs: placeholder.
+    :return: tensor, [n_pred, batch_size, n_route, C_0].
+    '''
+    n_pred = tf.placeholder_with_default(1, [], name='n_pred')
+    # the network in the loop only reuses variables, keep its summaries and decay terms out of the collections
+    summaries = list(tf.get_collection(tf.GraphKeys.SUMMARIES))
+    weight_decay = list(tf.get_collection('weight_decay'))
+
+    def step(i, x, preds):
+        y = build_network(x, n_his, Ks, Kt, blocks, keep_prob)
+        return i + 1, tf.concat([x[:, 1:n_his, :, :], y], axis=1), preds.write(i, y[:, 0, :, :])
+
+    with tf.variable_scope(tf.get_variable_scope(), reuse=True):
+        _, _, preds = tf.while_loop(lambda i, x, preds: i < n_pred, step,
+                                    [tf.constant(0), inputs[:, 0:n_his, :, :], tf.TensorArray(tf.float32, size=n_pred)])
+    tf.get_collection_ref(tf.GraphKeys.SUMMARIES)[:] = summaries
+    tf.get_collection_ref('weight_decay')[:] = weight_decay
+    return preds.stack()
+
+
+def build_model(inputs, n_his, Ks, Kt, blocks, keep_prob):
+    '''
+    Build the base model.
+    :param inputs: placeholder.
+    :param n_his: int, size of historical records for training.
+    :param Ks: int, kernel size of spatial convolution.
+    :param Kt: int, kernel size of temporal convolution.
+    :param blocks: list, channel configs of st_conv blocks.
+    :param keep_prob: placeholder.
+    :return: train loss, and the multi-step prediction of build_rollout.
+    '''
+    y = build_network(inputs[:, 0:n_his, :, :], n_his, Ks, Kt, blocks, keep_prob)
+
     tf.add_to_collection(name='copy_loss',
                          value=tf.nn.l2_loss(inputs[:, n_his - 1:n_his, :, :] - inputs[:, n_his:n_his + 1, :, :]))
     train_loss = tf.nn.l2_loss(y - inputs[:, n_his:n_his + 1, :, :])
     single_pred = y[:, 0, :, :]
     tf.add_to_collection(name='y_pred', value=single_pred)
-    return train_loss, single_pred
+    multi_pred = build_rollout(inputs, n_his, Ks, Kt, blocks, keep_prob)
+    tf.add_to_collection(name='y_rollout', value=multi_pred)
+    return train_loss, multi_pred
 
 
 def model_save(sess, global_steps, model_name, save_path='./output/models/'):
@@ -6,7 +6,7 @@
 # @Github   : https://github.com/VeritasYin/Project_Orion
 
 from data_loader.data_utils import gen_batch
-from utils.math_utils import evaluation
+from utils.math_utils import evaluation, z_score
 from os.path import join as pjoin
 
 import tensorflow as tf
@@ -14,34 +14,29 @@ import numpy as np
 import time
 
 
-def multi_pred(sess, y_pred, seq, batch_size, n_his, n_pred, step_idx, dynamic_batch=True):
+def multi_pred(sess, y_pred, seq, batch_size, n_his, n_pred, step_idx, dynamic_batch=True, stats=None):
     '''
     Multi_prediction function.
     :param sess: tf.Session().
-    :param y_pred: placeholder.
-    :param seq: np.ndarray, [len_seq, n_frame, n_route, C_0].
+    :param y_pred: tensor, the in-graph rollout of build_model, [n_pred, batch_size, n_route, C_0].
+    :param seq: np.ndarray or SeqWindows, [len_seq, n_frame, n_route, C_0].
     :param batch_size: int, the size of batch.
     :param n_his: int, size of historical records for training.
     :param n_pred: int, the length of prediction.
     :param step_idx: int or list, index for prediction slice.
     :param dynamic_batch: bool, whether changes the batch size in the last one if its length is less than the default.
+    :param stats: dict, paras of z-scores (mean & std) applied to each batch of seq, None if seq is normalized.
     :return y_ : tensor, 'sep' [len_inputs, n_route, 1]; 'merge' [step_idx, len_inputs, n_route, 1].
             len_ : int, the length of prediction.
     '''
     pred_list = []
-    for i in gen_batch(seq, min(batch_size, len(seq)), dynamic_batch=dynamic_batch):
-        # Note: use np.copy() to avoid the modification of source data.
-        test_seq = np.copy(i[:, 0:n_his + 1, :, :])
-        step_list = []
-        for j in range(n_pred):
-            pred = sess.run(y_pred,
-                            feed_dict={'data_input:0': test_seq, 'keep_prob:0': 1.0})
-            if isinstance(pred, list):
-                pred = np.array(pred[0])
-            test_seq[:, 0:n_his - 1, :, :] = test_seq[:, 1:n_his, :, :]
-            test_seq[:, n_his - 1, :, :] = pred
-            step_list.append(pred)
-        pred_list.append(step_list)
+    for i in gen_batch(seq, min(batch_size, len(seq)), dynamic_batch=dynamic_batch, stats=stats):
+        # the rollout feeds each step back in the graph, one run returns all n_pred steps.
+        pred = sess.run(y_pred, feed_dict={'data_input:0': i[:, 0:n_his + 1, :, :], 'keep_prob:0': 1.0,
+                                           'n_pred:0': n_pred})
+        if isinstance(pred, list):
+            pred = np.array(pred[0])
+        pred_list.append(pred)
     #  pred_array -> [n_pred, batch_size, n_route, C_0)
     pred_array = np.concatenate(pred_list, axis=1)
     return pred_array[step_idx], pred_array.shape[1]
@@ -65,16 +60,18 @@ def model_inference(sess, pred, inputs, batch_size, n_his, n_pred, step_idx, min
     if n_his + n_pred > x_val.shape[1]:
         raise ValueError('ERROR: the value of n_pred "{0}" exceeds the length limit.'.format(n_pred))
 
-    y_val, len_val = multi_pred(sess, pred, x_val, batch_size, n_his, n_pred, step_idx)
-    evl_val = evaluation(x_val[0:len_val, step_idx + n_his, :, :], y_val, x_stats)
+    y_val, len_val = multi_pred(sess, pred, x_val, batch_size, n_his, n_pred, step_idx, stats=x_stats)
+    evl_val = evaluation(z_score(x_val[0:len_val, step_idx + n_his, :, :], x_stats['mean'], x_stats['std']),
+                         y_val, x_stats)
 
     # chks: indicator that reflects the relationship of values between evl_val and min_va_val.
     chks = evl_val < min_va_val
     # update the metric on test set, if model's performance got improved on the validation.
     if sum(chks):
         min_va_val[chks] = evl_val[chks]
-        y_pred, len_pred = multi_pred(sess, pred, x_test, batch_size, n_his, n_pred, step_idx)
-        evl_pred = evaluation(x_test[0:len_pred, step_idx + n_his, :, :], y_pred, x_stats)
+        y_pred, len_pred = multi_pred(sess, pred, x_test, batch_size, n_his, n_pred, step_idx, stats=x_stats)
+        evl_pred = evaluation(z_score(x_test[0:len_pred, step_idx + n_his, :, :], x_stats['mean'], x_stats['std']),
+                              y_pred, x_stats)
         min_val = evl_pred
     return min_va_val, min_val
 
@@ -101,7 +98,7 @@ def model_test(inputs, batch_size, n_his, n_pred, inf_mode, load_path='./output/
         saver.restore(test_sess, tf.train.latest_checkpoint(load_path))
         print('>> Loading saved model from {0} ...'.format(model_path))
 
-        pred = test_graph.get_collection('y_pred')
+        pred = test_graph.get_collection('y_rollout')
 
         if inf_mode == 'sep':
             # for inference mode 'sep', the type of step index is int.
@@ -115,8 +112,9 @@ def model_test(inputs, batch_size, n_his, n_pred, inf_mode, load_path='./output/
 
         x_test, x_stats = inputs.get_data('test'), inputs.get_stats()
 
-        y_test, len_test = multi_pred(test_sess, pred, x_test, batch_size, n_his, n_pred, step_idx)
-        evl = evaluation(x_test[0:len_test, step_idx + n_his, :, :], y_test, x_stats)
+        y_test, len_test = multi_pred(test_sess, pred, x_test, batch_size, n_his, n_pred, step_idx, stats=x_stats)
+        evl = evaluation(z_score(x_test[0:len_test, step_idx + n_his, :, :], x_stats['mean'], x_stats['std']),
+                         y_test, x_stats)
 
         for ix in tmp_idx:
             #te = evl[ix - 2:ix + 1]
@@ -8,6 +8,7 @@
 import numpy as np
 import pandas as pd
 import tensorflow as tf
+from scipy import sparse
 from scipy.sparse.linalg import eigs
 
 
@@ -56,6 +57,19 @@ def cheb_poly_approx(L, Ks, n):
 
 
 
+def sparse_laplacian_tf(L):
+    '''
+    Graph Laplacian as a sparse tensor for the recursive Chebyshev graph convolution,
+    keeping only the edges of the graph instead of the dense Chebyshev kernel.
+    :param L: np.matrix, [n_route, n_route], scaled graph Laplacian.
+    :return: tf.SparseTensor, [n_route, n_route], the transpose of L.
+    '''
+    # coo from a dense array lists entries in row-major order, as tf.SparseTensor requires.
+    L_t = sparse.coo_matrix(np.asarray(L, dtype=np.float32).T)
+    return tf.SparseTensor(indices=np.stack([L_t.row, L_t.col], axis=1).astype(np.int64),
+                           values=L_t.data, dense_shape=L_t.shape)
+
+
 def first_approx(W, n):
     '''
     1st-order approximation function.
@@ -5,8 +5,14 @@
 # @IDE      : PyCharm
 # @Github   : https://github.com/VeritasYin/Project_Orion
 
+import os
+import sys
 import numpy as np
 
+# the shared metrics module lives at the top of the repo
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', '..'))
+from metrics import get_metrics
+
 
 def z_score(x, mean, std):
     '''
@@ -39,7 +45,7 @@ def MAPE(v, v_):
     :param v_: np.ndarray or int, prediction.
     :return: int, MAPE averages on all elements of input.
     '''
-    return np.mean(np.abs(v_ - v) / (v + 1e-5))
+    return get_metrics(v, v_, clip=False, mape_eps=1e-5)['mape']
 
 
 def RMSE(v, v_):
@@ -49,7 +55,7 @@ def RMSE(v, v_):
     :param v_: np.ndarray or int, prediction.
     :return: int, RMSE averages on all elements of input.
     '''
-    return np.sqrt(np.mean((v_ - v) ** 2))
+    return get_metrics(v, v_, clip=False)['rmse']
 
 
 def MAE(v, v_):
@@ -59,33 +65,24 @@ def MAE(v, v_):
     :param v_: np.ndarray or int, prediction.
     :return: int, MAE averages on all elements of input.
     '''
-    return np.mean(np.abs(v_ - v))
+    return get_metrics(v, v_, clip=False)['mae']
 
 
 def evaluation(y, y_, x_stats):
     '''
     Evaluation function: interface to calculate MAPE, MAE and RMSE between ground truth and prediction.
-    Extended version: multi-step prediction can be calculated by self-calling.
+    Extended version: multi-step prediction is evaluated per time step in one pass.
     :param y: np.ndarray or int, ground truth.
     :param y_: np.ndarray or int, prediction.
     :param x_stats: dict, paras of z-scores (mean & std).
-    :return: np.ndarray, averaged metric values.
+    :return: np.ndarray, averaged metric values, [MAPE, MAE, RMSE] of each time step.
     '''
-    dim = len(y_.shape)
-
-    if dim == 3:
+    v = z_inverse(y, x_stats['mean'], x_stats['std'])
+    v_ = z_inverse(y_, x_stats['mean'], x_stats['std'])
+    if len(y_.shape) == 3:
         # single_step case
-        v = z_inverse(y, x_stats['mean'], x_stats['std'])
-        v_ = z_inverse(y_, x_stats['mean'], x_stats['std'])
-        return np.array([MAPE(v, v_), MAE(v, v_), RMSE(v, v_)])
+        m = get_metrics(v, v_, clip=False, mape_eps=1e-5)
     else:
-        # multi_step case
-        tmp_list = []
-        # y -> [time_step, batch_size, n_route, 1]
-        y = np.swapaxes(y, 0, 1)
-        # recursively call
-        print(y_.shape)
-        for i in range(y_.shape[0]):
-            tmp_res = evaluation(y[i], y_[i], x_stats)
-            tmp_list.append(tmp_res)
-        return np.concatenate(tmp_list, axis=-1)
+        # multi_step case, y -> [time_step, batch_size, n_route, 1]
+        m = get_metrics(np.swapaxes(v, 0, 1), v_, keep_axes=(0,), clip=False, mape_eps=1e-5)
+    return np.stack([m['mape'], m['mae'], m['rmse']], axis=-1).reshape(-1)
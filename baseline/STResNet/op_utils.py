@@ -4,18 +4,16 @@ import scipy.io as sio
 import h5py
 import time
 import os
+import sys
+# the shared metrics module lives at the top of the repo
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from metrics import get_metrics
 
 def RMSE(x_pre, x_true):
-    x_pre = np.array(x_pre)
-    x_true = np.array(x_true)
-    return np.sqrt(np.mean(np.square(x_pre - x_true)))
+    return get_metrics(x_true, x_pre, clip=False)['rmse']
 
 def MAE(x_pre, x_true):
-    x_pre = np.array(x_pre)
-    x_true = np.array(x_true)
-    return np.mean(np.abs(x_pre - x_true))
+    return get_metrics(x_true, x_pre, clip=False)['mae']
 
 def MAPE(x_pre, x_true):
-    x_pre = np.array(x_pre)
-    x_true = np.array(x_true)
-    return np.mean(np.abs((x_pre - x_true)/(x_true + 1)))
+    return get_metrics(x_true, x_pre, clip=False)['mape']
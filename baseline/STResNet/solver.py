@@ -7,6 +7,7 @@ from progressbar import *
 import tensorflow as tf
 from utils import *
 from op_utils import *
+from metrics import get_metrics
 
 class ModelSolver(object):
     def __init__(self, model, data, val_data, preprocessing, **kwargs):
@@ -133,7 +134,8 @@ class ModelSolver(object):
                 # print(np.array(y_test).shape)
                 y_true = self.preprocessing.inverse_transform(np.array(y_test))
                 y_prediction = self.preprocessing.inverse_transform(np.array(y_pre_test))
-                rmse, mae, mape = RMSE(y_prediction, y_true), MAE(y_prediction, y_true), MAPE(y_prediction, y_true)
+                m = get_metrics(y_true, y_prediction, clip=False)
+                rmse, mae, mape = m['rmse'], m['mae'], m['mape']
                 text = 'at epoch %d, test loss is %.6f, test prediction rmse/mae/mape is %.6f/%.6f/%.6f \n' % (
                     e, t_loss, rmse, mae, mape)
                 print("at epoch " + str(e) + ", train loss is " + str(curr_loss) + ' , ' + str(t_rmse) + ' , ' + str(self.preprocessing.real_loss(t_rmse)))
@@ -167,7 +169,8 @@ class ModelSolver(object):
             print(np.array(y).shape)
             y_true = self.preprocessing.inverse_transform(np.array(y_test))
             y_prediction = self.preprocessing.inverse_transform(np.array(y_pre_test))
-            rmse, mae, mape = RMSE(y_prediction, y_true), MAE(y_prediction, y_true), MAPE(y_prediction, y_true)
+            m = get_metrics(y_true, y_prediction, clip=False)
+            rmse, mae, mape = m['rmse'], m['mae'], m['mape']
             text = 'test loss is %.6f, test prediction rmse/mae/mape is %.6f/%.6f/%.6f \n' % (t_loss, rmse, mae, mape)
             print(text)
             return y_pred_all
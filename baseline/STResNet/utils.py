@@ -2,8 +2,11 @@ import numpy as np
 import pickle
 import scipy.io as sio
 import h5py
-import time
 import os
+import sys
+# the shared calendar features live at the top of the repo
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from time_features import gen_slot_times, external_features, timestamp_strings, parse_timestamps
 
 def load_data(filename, split):
     if len(filename)==2:
@@ -127,116 +130,37 @@ def batch_data_cpt_ext(data, timestamps, batch_size=32, close=3, period=4, trend
     return x, y
 
 def external_feature(timestamps):
-    vec = [time.strptime(t[:8], '%Y%m%d').tm_wday for t in timestamps]
-    ext = []
-    for j in vec:
-        v = [0 for _ in range(7)]
-        v[j] = 1
-        if j >= 5:
-            v.append(0)  # weekend
-        else:
-            v.append(1)  # weekday
-        ext.append(v)
-    ext = np.asarray(ext)
-    return ext
+    # one-hot day of week of 'YYYYMMDD...' timestamps and a weekday flag (1 on weekdays)
+    return external_features(parse_timestamps(timestamps))
+
+def _timestamp_strings(year, unit, slot_minutes):
+    # 'YYYYMMDD', 'YYYYMMDDHH' or 'YYYYMMDDHHMM' of every slot of a year
+    times = gen_slot_times(year + '-01-01', str(int(year) + 1) + '-01-01', slot_minutes)
+    return timestamp_strings(times, unit)
 
 def gen_timestamps_for_year(year):
-    month1 = ['0'+str(e) for e in range(1,10)]
-    month2 = [str(e) for e in range(10,13)]
-    month = month1+month2
-    day1 = ['0'+str(e) for e in range(1,10)]
-    day2 = [str(e) for e in range(10,32)]
-    day = day1+day2
-    if year=='2012' or year=='2016':
-        day_sum = [31, 29, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31]
-    else:
-        day_sum = [31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31]
-    timestamps = []
-    for m in range(len(month)):
-        for d in range(day_sum[m]):
-            t = [year+month[m]+day[d]]
-            t_d = t*24
-            timestamps.append(t_d[:])
-    timestamps = np.hstack(np.array(timestamps))
-    return timestamps
+    return np.repeat(_timestamp_strings(year, 'D', 24*60), 24)
 
 def gen_timestamps_intervals(year, month, intervals):
     num_repeat = int(60/intervals)*24
-    if year=='2012' or year=='2016':
-        day_sum = [31, 29, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31]
-    else:
-        day_sum = [31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31]
-    day1 = ['0' + str(e) for e in range(1, 10)]
-    day2 = [str(e) for e in range(10, 32)]
-    day = day1 + day2
-    timestamps = []
-    for d in range(day_sum[int(month)-1]):
-        t = [year+str(month)+day[d]]
-        t_d = t*num_repeat
-        timestamps.append(t_d[:])
-    timestamps = np.hstack(np.array(timestamps))
+    first = np.datetime64('%s-%02d' % (year, int(month)), 'M')
+    num_days = len(gen_slot_times(str(first), str(first + 1), 24*60))
+    day = np.char.zfill(np.arange(1, num_days + 1).astype('U2'), 2)
+    timestamps = np.repeat(np.char.add(year+str(month), day), num_repeat)
     return timestamps
 
 def gen_timestamps(years, gen_timestamps_for_year=gen_timestamps_for_year):
     timestamps = []
     for y in years:
         timestamps.append(gen_timestamps_for_year(y))
-    timestamps = np.hstack(np.array(timestamps))
+    timestamps = np.concatenate(timestamps)
     return timestamps
 
 def gen_timestamps_for_year_ymdh(year):
-    month1 = ['0'+str(e) for e in range(1,10)]
-    month2 = [str(e) for e in range(10,13)]
-    month = month1+month2
-    day1 = ['0'+str(e) for e in range(1,10)]
-    day2 = [str(e) for e in range(10,32)]
-    day = day1+day2
-    if year=='2012' or year=='2016':
-        day_sum = [31, 29, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31]
-    else:
-        day_sum = [31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31]
-    hour1 = ['0'+str(e) for e in range(0,10)]
-    hour2 = [str(e) for e in range(10,24)]
-    hour = hour1+hour2
-    timestamps = []
-    for m in range(len(month)):
-        for d in range(day_sum[m]):
-            #t = [year+month[m]+day[d]]
-            t_d = []
-            for h in range(24):
-                t_d.append(year+month[m]+day[d]+hour[h])
-            timestamps.append(t_d[:])
-    timestamps = np.hstack(np.array(timestamps))
-    return timestamps
+    return _timestamp_strings(year, 'h', 60)
 
-def gen_timestamps_for_year_ymdhm(year):
-    month1 = ['0'+str(e) for e in range(1,10)]
-    month2 = [str(e) for e in range(10,13)]
-    month = month1+month2
-    day1 = ['0'+str(e) for e in range(1,10)]
-    day2 = [str(e) for e in range(10,32)]
-    day = day1+day2
-    if year=='2012' or year=='2016':
-        day_sum = [31, 29, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31]
-    else:
-        day_sum = [31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31]
-    hour1 = ['0'+str(e) for e in range(0,10)]
-    hour2 = [str(e) for e in range(10,24)]
-    hour = hour1+hour2
-    minute = ['00', '10', '20', '30', '40', '50']
-    timestamps = []
-    for m in range(len(month)):
-        for d in range(day_sum[m]):
-            #t = [year+month[m]+day[d]]
-            t_d = []
-            for h in range(24):
-                a = [year+month[m]+day[d]+hour[h]+e for e in minute]
-                #t_d = [t_d.append(year+month[m]+day[d]+hour[h]+e) for e in minute]
-                t_d.append(a)
-            t_d = np.hstack(np.array(t_d))
-            timestamps.append(t_d[:])
-    timestamps = np.hstack(np.array(timestamps))
-    return timestamps
+def gen_timestamps_for_year_ymdhm(year, slot_minutes=10):
+    return _timestamp_strings(year, 'm', slot_minutes)
 
 def shuffle_batch_data(data, batch_size=32, input_steps=10, output_steps=10):
     num = data.shape[0]
@@ -0,0 +1,214 @@
+import os
+import argparse
+import multiprocessing
+from functools import partial
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from dataset_store import DatasetStore
+
+
+# demand[t, n, 0]: trips starting at node n in slot t, demand[t, n, 1]: trips ending at node n in slot t
+# flow[t, i, j]: trips from node i to node j starting in slot t
+
+
+def read_trip_chunks(filename, columns, chunk_size=1000000):
+    """Yield DataFrames of `columns` from a csv or parquet file, chunk by chunk."""
+    if filename.endswith('.parquet'):
+        import pyarrow.parquet as pq
+        for batch in pq.ParquetFile(filename).iter_batches(batch_size=chunk_size, columns=columns):
+            yield batch.to_pandas()
+    else:
+        for chunk in pd.read_csv(filename, usecols=columns, chunksize=chunk_size):
+            yield chunk
+
+
+def time_slots(times, start_time, interval, num_slots):
+    """Slot index of each time, -1 outside [start_time, start_time + num_slots*interval).
+
+    :param interval: slot length in seconds.
+    """
+    # unparsable times become NaT, i.e. the smallest int64, and fall before start_time
+    ns = np.asarray(pd.to_datetime(times, errors='coerce'), dtype='datetime64[ns]').astype(np.int64)
+    slots = (ns - np.datetime64(start_time, 'ns').astype(np.int64)) // (interval * 10**9)
+    slots[(slots < 0) | (slots >= num_slots)] = -1
+    return slots
+
+
+def grid_nodes(lng, lat, bounds, grid_shape):
+    """Node index row*W + col of each location on a [H, W] grid, -1 outside.
+
+    :param bounds: (min_lng, min_lat, max_lng, max_lat), rows follow latitude.
+    """
+    min_lng, min_lat, max_lng, max_lat = bounds
+    h, w = grid_shape
+    row = np.floor((np.asarray(lat, dtype=np.float64) - min_lat) / (max_lat - min_lat) * h)
+    col = np.floor((np.asarray(lng, dtype=np.float64) - min_lng) / (max_lng - min_lng) * w)
+    valid = (row >= 0) & (row < h) & (col >= 0) & (col < w)
+    return np.where(valid, row * w + col, -1).astype(np.int64)
+
+
+def station_nodes(ids, station_ids):
+    """Node index of each station id in the sorted station_ids, -1 for unknown stations."""
+    ids = np.asarray(ids)
+    pos = np.clip(np.searchsorted(station_ids, ids), 0, len(station_ids) - 1)
+    return np.where(station_ids[pos] == ids, pos, -1).astype(np.int64)
+
+
+def aggregate_chunk(trips, config):
+    """Count the trips of one chunk.
+
+    :return: demand counts [num_slots*num_nodes*2], and the sorted flat indices
+        t*N*N + i*N + j of the flows with their counts.
+    """
+    num_slots, num_nodes = config['num_slots'], config['num_nodes']
+    cols = config['columns']
+    start_slot = time_slots(trips[cols['start_time']], config['start_time'], config['interval'], num_slots)
+    end_slot = time_slots(trips[cols['end_time']], config['start_time'], config['interval'], num_slots)
+    if config['mode'] == 'grid':
+        start_node = grid_nodes(trips[cols['start_lng']], trips[cols['start_lat']], config['bounds'], config['grid_shape'])
+        end_node = grid_nodes(trips[cols['end_lng']], trips[cols['end_lat']], config['bounds'], config['grid_shape'])
+    else:
+        start_node = station_nodes(trips[cols['start_station']].values, config['station_ids'])
+        end_node = station_nodes(trips[cols['end_station']].values, config['station_ids'])
+    size = num_slots * num_nodes * 2
+    out = (start_slot >= 0) & (start_node >= 0)
+    demand = np.bincount((start_slot[out] * num_nodes + start_node[out]) * 2, minlength=size)
+    into = (end_slot >= 0) & (end_node >= 0)
+    demand += np.bincount((end_slot[into] * num_nodes + end_node[into]) * 2 + 1, minlength=size)
+    od = out & (end_node >= 0)
+    flow_index, flow_count = np.unique((start_slot[od] * num_nodes + start_node[od]) * num_nodes + end_node[od],
+                                       return_counts=True)
+    return demand, flow_index, flow_count
+
+
+def merge_flows(flow_index, flow_count):
+    # sum the counts of duplicated flat indices
+    flow_index = np.concatenate(flow_index)
+    flow_count = np.concatenate(flow_count)
+    flow_index, inverse = np.unique(flow_index, return_inverse=True)
+    return flow_index, np.bincount(inverse, weights=flow_count).astype(np.int64)
+
+
+def aggregate_file(filename, config):
+    """Count all trips of one file, reading it in chunks."""
+    demand = np.zeros(config['num_slots'] * config['num_nodes'] * 2, dtype=np.int64)
+    flow_index, flow_count = [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.int64)]
+    columns = sorted(set(config['columns'].values()))
+    for trips in read_trip_chunks(filename, columns, config['chunk_size']):
+        d, f_index, f_count = aggregate_chunk(trips, config)
+        demand += d
+        flow_index.append(f_index)
+        flow_count.append(f_count)
+    flow_index, flow_count = merge_flows(flow_index, flow_count)
+    print('%s aggregated, %d OD pairs' % (filename, len(flow_index)))
+    return demand, flow_index, flow_count
+
+
+def build_dataset(filenames, config, demand_file, flow_file, flow_format='dense', processes=None):
+    """Aggregate trip files in parallel into the demand and flow tensors.
+
+    Each process counts whole files; the demand [T, N, 2] is saved with np.save and the
+    flows [T, N, N] are added straight into an np.save-format memmap (flow_format='dense')
+    or saved as a scipy csr matrix [T, N*N] with sparse.save_npz (flow_format='sparse').
+    """
+    num_slots, num_nodes = config['num_slots'], config['num_nodes']
+    demand = np.zeros(num_slots * num_nodes * 2, dtype=np.int64)
+    if flow_format == 'dense':
+        flow = np.lib.format.open_memmap(flow_file, mode='w+', dtype=np.float32,
+                                         shape=(num_slots, num_nodes, num_nodes))
+        flow_flat = flow.reshape(-1)
+    else:
+        flow_index, flow_count = [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.int64)]
+    pool = multiprocessing.Pool(processes)
+    try:
+        for d, f_index, f_count in pool.imap_unordered(partial(aggregate_file, config=config), filenames):
+            demand += d
+            if flow_format == 'dense':
+                # indices are unique within one file
+                flow_flat[f_index] += f_count
+            else:
+                flow_index.append(f_index)
+                flow_count.append(f_count)
+    finally:
+        pool.close()
+        pool.join()
+    np.save(demand_file, demand.reshape(num_slots, num_nodes, 2).astype(np.float32))
+    if flow_format == 'dense':
+        flow.flush()
+    else:
+        flow_index, flow_count = merge_flows(flow_index, flow_count)
+        flow = sparse.csr_matrix((flow_count.astype(np.float32), (flow_index // (num_nodes * num_nodes),
+                                                                   flow_index % (num_nodes * num_nodes))),
+                                 shape=(num_slots, num_nodes * num_nodes))
+        sparse.save_npz(flow_file, flow)
+    return demand.reshape(num_slots, num_nodes, 2)
+
+
+def main():
+    parse = argparse.ArgumentParser()
+    parse.add_argument('-files', '--files', type=str, nargs='+', help='trip csv/parquet files')
+    parse.add_argument('-mode', '--mode', type=str, default='grid', help='grid or station')
+    parse.add_argument('-start_time', '--start_time', type=str, default='2015-01-01', help='start of the first slot')
+    parse.add_argument('-end_time', '--end_time', type=str, default='2016-01-01', help='end of the last slot')
+    parse.add_argument('-interval', '--interval', type=int, default=1800, help='slot length in seconds')
+    # ---------- columns of the trip records ----------
+    parse.add_argument('-start_time_col', '--start_time_col', type=str, default='tpep_pickup_datetime')
+    parse.add_argument('-end_time_col', '--end_time_col', type=str, default='tpep_dropoff_datetime')
+    parse.add_argument('-start_lng_col', '--start_lng_col', type=str, default='pickup_longitude')
+    parse.add_argument('-start_lat_col', '--start_lat_col', type=str, default='pickup_latitude')
+    parse.add_argument('-end_lng_col', '--end_lng_col', type=str, default='dropoff_longitude')
+    parse.add_argument('-end_lat_col', '--end_lat_col', type=str, default='dropoff_latitude')
+    parse.add_argument('-start_station_col', '--start_station_col', type=str, default='start station id')
+    parse.add_argument('-end_station_col', '--end_station_col', type=str, default='end station id')
+    # ---------- grid mode ----------
+    parse.add_argument('-bounds', '--bounds', type=float, nargs=4, default=[-74.02, 40.70, -73.93, 40.82],
+                       help='min_lng min_lat max_lng max_lat')
+    parse.add_argument('-grid_shape', '--grid_shape', type=int, nargs=2, default=[20, 10], help='rows (lat) cols (lng)')
+    # ---------- station mode ----------
+    parse.add_argument('-station_file', '--station_file', type=str, default=None, help='station ids, one per line')
+    # ---------- output ----------
+    parse.add_argument('-demand_file', '--demand_file', type=str, default='data.npy')
+    parse.add_argument('-flow_file', '--flow_file', type=str, default='flow_data.npy')
+    parse.add_argument('-flow_format', '--flow_format', type=str, default='dense', help='dense (.npy memmap) or sparse (.npz)')
+    parse.add_argument('-store_folder', '--store_folder', type=str, default=None,
+                       help='also append the slots to this DatasetStore, e.g. one new day (dense flows only)')
+    parse.add_argument('-chunk_size', '--chunk_size', type=int, default=1000000, help='trips read at once')
+    parse.add_argument('-processes', '--processes', type=int, default=None, help='number of processes, default all cpus')
+    args = parse.parse_args()
+    #
+    config = {'mode': args.mode,
+              'start_time': np.datetime64(args.start_time),
+              'interval': args.interval,
+              'num_slots': int((np.datetime64(args.end_time, 's') - np.datetime64(args.start_time, 's')).astype(np.int64)
+                               // args.interval),
+              'chunk_size': args.chunk_size,
+              'columns': {'start_time': args.start_time_col, 'end_time': args.end_time_col}}
+    if args.mode == 'grid':
+        config['bounds'] = args.bounds
+        config['grid_shape'] = args.grid_shape
+        config['num_nodes'] = args.grid_shape[0] * args.grid_shape[1]
+        config['columns'].update({'start_lng': args.start_lng_col, 'start_lat': args.start_lat_col,
+                                  'end_lng': args.end_lng_col, 'end_lat': args.end_lat_col})
+    else:
+        station_ids = np.unique(np.loadtxt(args.station_file, dtype=np.int64, ndmin=1))
+        config['station_ids'] = station_ids
+        config['num_nodes'] = len(station_ids)
+        config['columns'].update({'start_station': args.start_station_col, 'end_station': args.end_station_col})
+    print('%d slots, %d nodes' % (config['num_slots'], config['num_nodes']))
+    if args.store_folder and args.flow_format != 'dense':
+        raise ValueError('-store_folder needs -flow_format dense')
+    for f in (args.demand_file, args.flow_file):
+        if os.path.dirname(f) and not os.path.exists(os.path.dirname(f)):
+            os.makedirs(os.path.dirname(f))
+    demand = build_dataset(args.files, config, args.demand_file, args.flow_file,
+                           flow_format=args.flow_format, processes=args.processes)
+    if args.store_folder:
+        store = DatasetStore(args.store_folder)
+        store.append('demand', demand.astype(np.float32))
+        store.append('flow', np.load(args.flow_file, mmap_mode='r'))
+        print('store has %d slots' % store.num_slots('demand'))
+
+
+if __name__ == '__main__':
+    main()
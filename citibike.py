@@ -12,6 +12,7 @@ from solver import ModelSolver
 from preprocessing import *
 from utils import *
 from dataloader import *
+from dataset_store import DatasetStore
 # import scipy.io as sio
 
 
@@ -21,6 +22,8 @@ def main():
     parse.add_argument('-gpu', '--gpu', type=str, default='0', help='which gpu to use: 0 or 1')
     parse.add_argument('-folder_name', '--folder_name', type=str, default='datasets/citibike-data/data/')
     parse.add_argument('-output_folder_name', '--output_folder_name', type=str, default='output/citibike-data/data/')
+    parse.add_argument('-store_folder', '--store_folder', type=str, default=None,
+                       help='read demand/flow from a DatasetStore instead, training on all slots before val/test')
     # ---------- input/output settings -------
     parse.add_argument('-input_steps', '--input_steps', type=int, default=6,
                        help='number of input steps')
@@ -32,10 +35,21 @@ def main():
     parse.add_argument('-filter_type', '--filter_type', type=str, default='dual_random_walk', help='laplacian, random_walk, or dual_random_walk')
     parse.add_argument('-delta', '--delta', type=int, default=1e7, help='delta to calculate rescaled weighted matrix')
     parse.add_argument('-epsilon', '--epsilon', type=float, default=0.8, help='epsilon to calculate rescaled weighted matrix')
+    parse.add_argument('-knn', '--knn', type=int, default=None, help='keep only k nearest stations in the rescaled weighted matrix, instead of -epsilon')
     parse.add_argument('-dy_adj', '--dy_adj', type=int, default=1,
                        help='whether to use dynamic adjacent matrix for lower feature extraction layer')
     parse.add_argument('-dy_filter', '--dy_filter', type=int, default=0,
                        help='whether to use dynamic filter generate region-specific filter ')
+    parse.add_argument('-hoist_inputs', '--hoist_inputs', type=int, default=0,
+                       help='whether to batch input-to-hidden transforms over all input steps (needs dy_adj=0)')
+    parse.add_argument('-recompute', '--recompute', type=int, default=0,
+                       help='number of lower layers recomputed in backprop to save memory (GCN, Coupled_GCN, Coupled_ConvGRU)')
+    parse.add_argument('-report_memory', '--report_memory', type=int, default=0,
+                       help='whether to report the peak memory of the first training batch')
+    parse.add_argument('-accum_steps', '--accum_steps', type=int, default=1,
+                       help='number of batches whose gradients are accumulated before each update')
+    parse.add_argument('-feed_dtype', '--feed_dtype', type=str, default='float32',
+                       help='dtype to store and feed data/flows in: float32, float16 or bfloat16 (compute stays float32)')
     #parse.add_argument('-att_dynamic_adj', '--att_dynamic_adj', type=int, default=1, help='whether to use dynamic adjacent matrix in attention parts')
     parse.add_argument('-model_save', '--model_save', type=str, default='gcn', help='folder name to save model')
     parse.add_argument('-pretrained_model', '--pretrained_model_path', type=str, default=None,
@@ -67,43 +81,62 @@ def main():
     # test: 20140911 - 20140930
     split = [3672, 240, 480]
     #split = [3912, 480]
-    data, train_data, val_data, test_data = load_npy_data(
-        filename=[args.folder_name+'d_station.npy', args.folder_name+'p_station.npy'], split=split)
-    # data: [num, station_num, 2]
-    #f_data, train_f_data, val_f_data, test_f_data = load_pkl_data(args.folder_name + 'f_data_list.pkl', split=split)
-    f_data, train_f_data, val_f_data, test_f_data = load_npy_data(filename=[args.folder_name + 'citibike_flow_data.npy'], split=split)
+    if args.store_folder:
+        # appended days extend the training range, val/test stay the last slots
+        store = DatasetStore(args.store_folder)
+        num_slots = store.num_slots('demand')
+        split = [num_slots - split[1] - split[2], split[1], split[2]]
+        data, f_data = store.load('demand'), store.load('flow')
+        train_data, val_data, test_data = data[:split[0]], data[split[0]:-split[2]], data[-split[2]:]
+        train_f_data, val_f_data, test_f_data = f_data[:split[0]], f_data[split[0]:-split[2]], f_data[-split[2]:]
+    else:
+        data, train_data, val_data, test_data = load_npy_data(
+            filename=[args.folder_name+'d_station.npy', args.folder_name+'p_station.npy'], split=split)
+        # data: [num, station_num, 2]
+        #f_data, train_f_data, val_f_data, test_f_data = load_pkl_data(args.folder_name + 'f_data_list.pkl', split=split)
+        f_data, train_f_data, val_f_data, test_f_data = load_npy_data(filename=[args.folder_name + 'citibike_flow_data.npy'], split=split, mmap_mode='c')
     print(len(f_data))
     print('preprocess train/val/test flow data...')
     #f_preprocessing = StandardScaler()
     f_preprocessing = MinMaxNormalization01()
     f_preprocessing.fit(train_f_data)
-    train_f_data = f_preprocessing.transform(train_f_data)
+    train_f_data = f_preprocessing.transform(train_f_data, inplace=True)
     if val_f_data is not None:
-        val_f_data = f_preprocessing.transform(val_f_data)
-    test_f_data = f_preprocessing.transform(test_f_data)
+        val_f_data = f_preprocessing.transform(val_f_data, inplace=True)
+    test_f_data = f_preprocessing.transform(test_f_data, inplace=True)
     print('preprocess train/val/test data...')
     pre_process = MinMaxNormalization01()
     #pre_process = StandardScaler()
     pre_process.fit(train_data)
-    train_data = pre_process.transform(train_data)
+    train_data = pre_process.transform(train_data, inplace=True)
     if val_data is not None:
-        val_data = pre_process.transform(val_data)
-    test_data = pre_process.transform(test_data)
+        val_data = pre_process.transform(val_data, inplace=True)
+    test_data = pre_process.transform(test_data, inplace=True)
     #
+    # store and feed in the reduced precision, [B, T, N, N] flows dominate the memory traffic
+    feed_dtype = tf.as_dtype(args.feed_dtype)
+    np_dtype = feed_dtype.as_numpy_dtype
+    train_data, test_data = train_data.astype(np_dtype, copy=False), test_data.astype(np_dtype, copy=False)
+    train_f_data, test_f_data = train_f_data.astype(np_dtype, copy=False), test_f_data.astype(np_dtype, copy=False)
+    if val_data is not None:
+        val_data, val_f_data = val_data.astype(np_dtype, copy=False), val_f_data.astype(np_dtype, copy=False)
     num_station = data.shape[1]
     print('number of station: %d' % num_station)
     #
     train_loader = DataLoader_graph(train_data, train_f_data,
-                              args.input_steps, flow_format='identity')
+                              args.input_steps, flow_format='identity', dtype=np_dtype)
     if val_data is not None:
         val_loader = DataLoader_graph(val_data, val_f_data,
-                                  args.input_steps, flow_format='identity')
+                                  args.input_steps, flow_format='identity', dtype=np_dtype)
     else:
         val_loader = None
     test_loader = DataLoader_graph(test_data, test_f_data,
-                            args.input_steps, flow_format='identity')
+                            args.input_steps, flow_format='identity', dtype=np_dtype)
     # f_adj_mx = None
-    if os.path.isfile(args.folder_name + 'f_adj_mx.npy'):
+    if args.store_folder:
+        # only the slots appended since the last run are read
+        f_adj_mx = store.flow_adj_mx('flow', f_preprocessing, end=split[0])
+    elif os.path.isfile(args.folder_name + 'f_adj_mx.npy'):
         f_adj_mx = np.load(args.folder_name + 'f_adj_mx.npy')
     else:
         f_adj_mx = train_loader.get_flow_adj_mx()
@@ -113,9 +146,9 @@ def main():
     if args.filter_type == 'laplacian':
         w = np.load(args.folder_name + 'w.npy')
         # w = np.array(w, dtype=np.float32)
-        W = get_rescaled_W(w, delta=args.delta, epsilon=args.epsilon)
+        W = get_rescaled_W(w, delta=args.delta, epsilon=args.epsilon, knn=args.knn, sparse=True)
         # Calculate graph kernel
-        L = scaled_laplacian(W)
+        L = scaled_laplacian(W, cache_file=args.folder_name + 'lambda_max.npz').toarray()
         #
         f_adj_mx = L
 
@@ -133,6 +166,9 @@ def main():
                     dy_adj=args.dy_adj, dy_filter=args.dy_filter,
                     f_adj_mx=f_adj_mx, trained_adj_mx=args.trained_adj_mx,
                     filter_type=args.filter_type,
+                    hoist_inputs=args.hoist_inputs,
+                    recompute=args.recompute,
+                    feed_dtype=feed_dtype,
                     batch_size=args.batch_size)
     if args.model == 'flow_GCN':
         model = flow_GCN(num_station, args.input_steps,
@@ -145,6 +181,8 @@ def main():
                             num_layers=args.num_layers, num_units=args.num_units,
                             f_adj_mx=f_adj_mx, trained_adj_mx=args.trained_adj_mx,
                             filter_type=args.filter_type,
+                            recompute=args.recompute,
+                            feed_dtype=feed_dtype,
                             batch_size=args.batch_size)
     #
     model_path = os.path.join(args.output_folder_name, 'model_save', args.model_save)
@@ -159,6 +197,8 @@ def main():
                          update_rule=args.update_rule,
                          learning_rate=args.learning_rate,
                          model_path=model_path,
+                         report_memory=args.report_memory,
+                         accum_steps=args.accum_steps,
                          )
     results_path = os.path.join(model_path, 'results')
     if not os.path.exists(results_path):
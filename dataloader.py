@@ -4,16 +4,52 @@ import numpy as np
 from scipy.sparse import csr_matrix
 import math
 import random
+from dataset_store import SlotSegments
 # from sklearn.model_selection import train_test_split
 # import re
 # import copy
 
+def append_slots(slots, new_slots, scaler=None):
+    '''
+    Append new slots to loaded ones as a segment of a SlotSegments, the loaded slots are not copied.
+    :param slots: loaded slots, an array, SlotSegments, list or utils.FlowLists.
+    :param new_slots: slots that follow them.
+    :param scaler: MinMaxNormalization01 the loaded slots were normalized with, or None. If given,
+        new_slots are raw: the scaler is partial_fit on them and they are normalized. When that widens
+        [min, max], the loaded slots are mapped to the new range in place.
+    '''
+    if isinstance(slots, list):
+        if scaler is not None:
+            raise ValueError('scalers are not supported for flow lists')
+        return slots + list(new_slots)
+    if not isinstance(slots, SlotSegments):
+        slots = SlotSegments([slots])
+    if scaler is not None:
+        if not all(isinstance(segment, np.ndarray) for segment in slots.segments):
+            raise ValueError('scalers are only supported for array slots')
+        old_min, old_max = scaler._min, scaler._max
+        scaler.partial_fit(new_slots)
+        if (scaler._min, scaler._max) != (old_min, old_max):
+            # old normalized x -> raw -> new normalized, x * mul + add
+            mul = (old_max - old_min) / (scaler._max - scaler._min)
+            add = (old_min - scaler._min) / (scaler._max - scaler._min)
+            for segment in slots.segments:
+                np.multiply(segment, mul, out=segment, casting='unsafe')
+                np.add(segment, add, out=segment, casting='unsafe')
+        new_slots = scaler.transform(new_slots).astype(slots.segments[0].dtype, copy=False)
+    slots.append(new_slots)
+    return slots
+
+
 class DataLoader_graph():
     def __init__(self, d_data, f_data,
                  input_steps,
-                 flow_format='identity'):
+                 flow_format='identity',
+                 dtype=np.float32):
         self.d_data = d_data
         self.f_data = f_data
+        # dtype of the fed batches, e.g. np.float16 to halve the flow traffic
+        self.dtype = dtype
         # d_data: [num, num_station, 2]
         # f_data: [num, {num_station, num_station}]
         self.input_steps = input_steps
@@ -27,6 +63,8 @@ class DataLoader_graph():
             self.get_flow_map_from_list = self.get_flow_map_from_list_index
         elif flow_format == 'identity':
             self.get_flow_map_from_list = self.get_flow_map_from_identity
+        elif flow_format == 'coo':
+            self.get_flow_map_from_list = self.get_flow_map_from_list_coo
         #self.reset_data()
 
     def get_flow_adj_mx(self):
@@ -63,6 +101,13 @@ class DataLoader_graph():
             f_map[rows, cols] = values
         return f_map
 
+    def get_flow_map_from_list_coo(self, f_list):
+        # (rows, cols, values) arrays, e.g. one slot of utils.FlowLists
+        f_map = np.zeros((self.num_station, self.num_station), dtype=np.float32)
+        rows, cols, values = f_list
+        f_map[rows, cols] = values
+        return f_map
+
     def get_flow_map_from_identity(self, f_list):
         return f_list
 
@@ -84,7 +129,7 @@ class DataLoader_graph():
                 f_map = [self.get_flow_map_from_list(self.f_data[j]) for j in range(i, i + self.input_steps)]
                 batch_f.append(f_map)
                 batch_index.append(np.arange(i+1, i+self.input_steps+1))
-            return np.array(batch_x,dtype=np.float32), np.array(batch_f,dtype=np.float32), np.array(batch_y), np.array(batch_index)
+            return np.array(batch_x, dtype=self.dtype), np.array(batch_f, dtype=self.dtype), np.array(batch_y), np.array(batch_index)
 
     def next_batch_for_test(self, start, end):
         padding_len = 0
@@ -109,7 +154,15 @@ class DataLoader_graph():
             batch_y = np.concatenate((np.array(batch_y), np.zeros((padding_len, self.input_steps, self.num_station, 2))), axis=0)
             batch_f = np.concatenate((np.array(batch_f), np.zeros((padding_len, self.input_steps, self.num_station, self.num_station))), axis=0)
             batch_index = np.concatenate((np.array(batch_index), np.zeros((padding_len, self.input_steps))), axis=0)
-        return np.array(batch_x,dtype=np.float32), np.array(batch_f,dtype=np.float32), np.array(batch_y), np.array(batch_index, dtype=np.int32), padding_len
+        return np.array(batch_x, dtype=self.dtype), np.array(batch_f, dtype=self.dtype), np.array(batch_y), np.array(batch_index, dtype=np.int32), padding_len
+
+    def append(self, d_data, f_data, d_scaler=None, f_scaler=None):
+        # slots following the loaded ones, e.g. read from DatasetStore.load(name, start, end),
+        # see append_slots for the scalers
+        self.d_data = append_slots(self.d_data, d_data, d_scaler)
+        self.f_data = append_slots(self.f_data, f_data, f_scaler)
+        self.num_data = len(self.d_data)
+        self.data_index = np.arange(self.num_data - self.input_steps)
 
     def reset_data(self):
         np.random.shuffle(self.data_index)
@@ -118,9 +171,12 @@ class DataLoader_graph():
 class DataLoader_map():
     def __init__(self, d_data, f_data,
                  input_steps,
-                 flow_format='identity'):
+                 flow_format='identity',
+                 dtype=np.float32):
         self.d_data = d_data
         self.f_data = f_data
+        # dtype of the fed batches, e.g. np.float16 to halve the flow traffic
+        self.dtype = dtype
         # d_data: [num, height, width, 2]
         # f_data: [num, height*width, height*width]
         self.input_steps = input_steps
@@ -183,7 +239,7 @@ class DataLoader_map():
                 f_map = [self.get_flow_map_from_list(self.f_data[j]) for j in range(i, i + self.input_steps)]
                 batch_f.append(f_map)
                 batch_index.append(np.arange(i+1, i+self.input_steps+1))
-            return np.array(batch_x), np.array(batch_f, dtype=np.float32), np.array(batch_y), np.array(batch_index)
+            return np.array(batch_x), np.array(batch_f, dtype=self.dtype), np.array(batch_y), np.array(batch_index)
 
     def next_batch_for_test(self, start, end):
         padding_len = 0
@@ -208,7 +264,15 @@ class DataLoader_map():
             batch_y = np.concatenate((np.array(batch_y), np.zeros((padding_len, self.input_steps, self.map_size[0], self.map_size[1], self.input_dim))), axis=0)
             batch_f = np.concatenate((np.array(batch_f), np.zeros((padding_len, self.input_steps, self.f_data_shape[1], self.f_data_shape[-1]))), axis=0)
             batch_index = np.concatenate((np.array(batch_index), np.zeros((padding_len, self.input_steps))), axis=0)
-        return np.array(batch_x), np.array(batch_f), np.array(batch_y), np.array(batch_index, dtype=np.int32), padding_len
+        return np.array(batch_x, dtype=self.dtype), np.array(batch_f, dtype=self.dtype), np.array(batch_y), np.array(batch_index, dtype=np.int32), padding_len
+
+    def append(self, d_data, f_data, d_scaler=None, f_scaler=None):
+        # slots following the loaded ones, e.g. read from DatasetStore.load(name, start, end),
+        # see append_slots for the scalers
+        self.d_data = append_slots(self.d_data, d_data, d_scaler)
+        self.f_data = append_slots(self.f_data, f_data, f_scaler)
+        self.num_data = len(self.d_data)
+        self.data_index = np.arange(self.num_data - self.input_steps)
 
     def reset_data(self):
         np.random.shuffle(self.data_index)
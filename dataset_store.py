@@ -0,0 +1,146 @@
+import os
+import json
+import numpy as np
+
+
+class DatasetStore(object):
+    """Append-only store of time-slot arrays such as demand [T, N, 2] and flows [T, N, N].
+
+    Each array is kept as npy segments of consecutive slots, listed in manifest.json:
+    {name: [{'file': ..., 'start': ..., 'end': ...}, ...]}. Appending a day writes one
+    segment and rewrites only the manifest; reads map the segments and copy only the
+    requested slots.
+    """
+    def __init__(self, folder):
+        self.folder = folder
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        self.manifest_path = os.path.join(folder, 'manifest.json')
+        if os.path.isfile(self.manifest_path):
+            with open(self.manifest_path) as f:
+                self.manifest = json.load(f)
+        else:
+            self.manifest = {}
+
+    def _save_manifest(self):
+        # replace the manifest atomically, readers never see a partial one
+        tmp_path = self.manifest_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.manifest, f, indent=1)
+        os.replace(tmp_path, self.manifest_path)
+
+    def num_slots(self, name):
+        segments = self.manifest.get(name, [])
+        return segments[-1]['end'] if segments else 0
+
+    def append(self, name, data):
+        """Append the slots of data [num_new, ...] after the last stored slot."""
+        data = np.asarray(data)
+        start = self.num_slots(name)
+        segments = self.manifest.setdefault(name, [])
+        if segments:
+            shape = np.load(os.path.join(self.folder, segments[0]['file']), mmap_mode='r').shape[1:]
+            if data.shape[1:] != shape:
+                raise ValueError('%s slots have shape %s, got %s' % (name, shape, data.shape[1:]))
+        filename = '%s_%08d_%08d.npy' % (name, start, start + len(data))
+        np.save(os.path.join(self.folder, filename), data)
+        segments.append({'file': filename, 'start': start, 'end': start + len(data)})
+        self._save_manifest()
+        return start + len(data)
+
+    def load(self, name, start=0, end=None):
+        """Slots [start, end) of an array, reading only the segments that overlap them."""
+        end = self.num_slots(name) if end is None else end
+        parts = []
+        for segment in self.manifest.get(name, []):
+            if segment['end'] <= start or segment['start'] >= end:
+                continue
+            data = np.load(os.path.join(self.folder, segment['file']), mmap_mode='r')
+            parts.append(np.array(data[max(start - segment['start'], 0):min(end, segment['end']) - segment['start']]))
+        if not parts:
+            raise ValueError('no slots of %s in [%d, %d)' % (name, start, end))
+        return np.concatenate(parts, axis=0)
+
+    def running_sum(self, name, end=None):
+        """Sum over the raw slots [0, end) of an array.
+
+        The sum is cached with the number of slots it covers, so only slots appended
+        since the last call are read.
+        """
+        end = self.num_slots(name) if end is None else end
+        cache_path = os.path.join(self.folder, '%s_sum.npz' % name)
+        if os.path.isfile(cache_path):
+            with np.load(cache_path) as cache:
+                total, covered = cache['sum'], int(cache['end'])
+        else:
+            total, covered = None, 0
+        if covered > end:
+            total, covered = None, 0
+        if covered < end:
+            new_sum = self.load(name, covered, end).sum(axis=0, dtype=np.float64)
+            total = new_sum if total is None else total + new_sum
+            np.savez(cache_path, sum=total, end=end)
+        return total
+
+    def flow_adj_mx(self, name, scaler=None, end=None, mean=False):
+        """Flow adjacency over slots [0, end) from the cached running_sum.
+
+        Matches get_flow_adj_mx of the data loaders, which add up the normalized flow maps
+        (DataLoader_graph) or average them (mean=True, DataLoader_multi_graph). The scaler
+        must be affine, e.g. MinMaxNormalization01, so that the sum of the normalized slots
+        is end * scaler.transform(mean of the raw slots).
+        """
+        end = self.num_slots(name) if end is None else end
+        mean_map = self.running_sum(name, end) / end
+        if scaler is not None:
+            mean_map = scaler.transform(mean_map)
+        return np.asarray(mean_map if mean else mean_map * end, dtype=np.float32)
+
+
+class SlotSegments(object):
+    """Consecutive slot arrays read as one sequence of slots, without concatenating them.
+
+    s[t] gives slot t of whichever segment holds it, s[a:b] the slots [a, b), copied only
+    when the range spans several segments. Segments may also be utils.FlowLists, which
+    are only indexed slot by slot.
+    """
+    def __init__(self, segments):
+        self.segments = []
+        self.ends = np.zeros(0, dtype=np.int64)
+        for segment in segments:
+            self.append(segment)
+
+    def append(self, segment):
+        self.segments.append(segment)
+        self.ends = np.append(self.ends, len(self) + len(segment))
+
+    def __len__(self):
+        return int(self.ends[-1]) if len(self.ends) else 0
+
+    @property
+    def shape(self):
+        return (len(self),) + tuple(self.segments[0].shape[1:])
+
+    def _locate(self, index):
+        # segment holding slot index and the position in it
+        k = int(np.searchsorted(self.ends, index, side='right'))
+        return k, index - (int(self.ends[k - 1]) if k else 0)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, end, step = index.indices(len(self))
+            assert step == 1, 'only contiguous slot ranges are supported'
+            if end <= start:
+                return self.segments[0][0:0]
+            k, a = self._locate(start)
+            k_end, b = self._locate(end - 1)
+            if k == k_end:
+                return self.segments[k][a:b + 1]
+            parts = [self.segments[k][a:]] + self.segments[k + 1:k_end] + [self.segments[k_end][:b + 1]]
+            return np.concatenate(parts, axis=0)
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('slot %d out of range' % index)
+        k, a = self._locate(index)
+        return self.segments[k][a]
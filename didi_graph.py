@@ -46,6 +46,16 @@ def main():
                        help='whether to use dynamic adjacent matrix for lower feature extraction layer')
     parse.add_argument('-dy_filter', '--dy_filter', type=int, default=0,
                        help='whether to use dynamic filter generate region-specific filter ')
+    parse.add_argument('-hoist_inputs', '--hoist_inputs', type=int, default=0,
+                       help='whether to batch input-to-hidden transforms over all input steps (needs dy_adj=0)')
+    parse.add_argument('-recompute', '--recompute', type=int, default=0,
+                       help='number of lower layers recomputed in backprop to save memory (GCN, Coupled_GCN, Coupled_ConvGRU)')
+    parse.add_argument('-report_memory', '--report_memory', type=int, default=0,
+                       help='whether to report the peak memory of the first training batch')
+    parse.add_argument('-accum_steps', '--accum_steps', type=int, default=1,
+                       help='number of batches whose gradients are accumulated before each update')
+    parse.add_argument('-feed_dtype', '--feed_dtype', type=str, default='float32',
+                       help='dtype to store and feed data/flows in: float32, float16 or bfloat16 (compute stays float32)')
     parse.add_argument('-att_dynamic_adj', '--att_dynamic_adj', type=int, default=0, help='whether to use dynamic adjacent matrix in attention parts')
     #
     parse.add_argument('-model_save', '--model_save', type=str, default='gcn', help='folder name to save model')
@@ -98,32 +108,37 @@ def main():
     input_dim = data.shape[-1]
     num_station = np.prod(data.shape[1:-1])
     #
-    f_data, train_f_data, val_f_data, test_f_data = load_npy_data([args.folder_name + 'cd_didi_flow_in.npy'], split=split)
+    f_data, train_f_data, val_f_data, test_f_data = load_npy_data([args.folder_name + 'cd_didi_flow_in.npy'], split=split, mmap_mode='c')
     print(len(f_data))
     print('preprocess train/val/test flow data...')
     #f_preprocessing = StandardScaler()
     f_preprocessing = MinMaxNormalization01()
     f_preprocessing.fit(train_f_data)
-    train_f_data = f_preprocessing.transform(train_f_data)
-    val_f_data = f_preprocessing.transform(val_f_data)
-    test_f_data = f_preprocessing.transform(test_f_data)
+    train_f_data = f_preprocessing.transform(train_f_data, inplace=True)
+    val_f_data = f_preprocessing.transform(val_f_data, inplace=True)
+    test_f_data = f_preprocessing.transform(test_f_data, inplace=True)
     print('preprocess train/val/test data...')
     # pre_process = StandardScaler()
     pre_process = MinMaxNormalization01()
     pre_process.fit(train_data)
-    train_data = pre_process.transform(train_data)
-    val_data = pre_process.transform(val_data)
-    test_data = pre_process.transform(test_data)
+    train_data = pre_process.transform(train_data, inplace=True)
+    val_data = pre_process.transform(val_data, inplace=True)
+    test_data = pre_process.transform(test_data, inplace=True)
     #
+    # store and feed in the reduced precision, [B, T, N, N] flows dominate the memory traffic
+    feed_dtype = tf.as_dtype(args.feed_dtype)
+    np_dtype = feed_dtype.as_numpy_dtype
+    train_data, val_data, test_data = [d.astype(np_dtype, copy=False) for d in (train_data, val_data, test_data)]
+    train_f_data, val_f_data, test_f_data = [d.astype(np_dtype, copy=False) for d in (train_f_data, val_f_data, test_f_data)]
 
     print('number of station: %d' % num_station)
     #
     train_loader = dataloader(train_data, train_f_data,
-                              args.input_steps, flow_format='identity')
+                              args.input_steps, flow_format='identity', dtype=np_dtype)
     val_loader = dataloader(val_data, val_f_data,
-                              args.input_steps, flow_format='identity')
+                              args.input_steps, flow_format='identity', dtype=np_dtype)
     test_loader = dataloader(test_data, test_f_data,
-                            args.input_steps, flow_format='identity')
+                            args.input_steps, flow_format='identity', dtype=np_dtype)
     # f_adj_mx = None
     if os.path.isfile(args.folder_name + 'f_adj_mx.npy'):
         f_adj_mx = np.load(args.folder_name + 'f_adj_mx.npy')
@@ -144,19 +159,28 @@ def main():
                     num_layers=args.num_layers, num_units=args.num_units,
                     dy_adj=args.dy_adj, dy_filter=args.dy_filter,
                     f_adj_mx=f_adj_mx,
+                    hoist_inputs=args.hoist_inputs,
+                    recompute=args.recompute,
+                    feed_dtype=feed_dtype,
                     batch_size=args.batch_size)
     if args.model == 'ConvGRU':
         model = ConvGRU(input_shape=[map_size[0], map_size[1], input_dim], input_steps=args.input_steps,
                          num_layers=args.num_layers, num_units=args.num_units, kernel_shape=[args.kernel_size, args.kernel_size],
+                         hoist_inputs=args.hoist_inputs,
+                         feed_dtype=feed_dtype,
                          batch_size=args.batch_size)
     if args.model == 'ConvLSTM':
         model = ConvGRU(input_shape=[map_size[0], map_size[1], input_dim], input_steps=args.input_steps,
                          num_layers=args.num_layers, num_units=args.num_units, kernel_shape=[args.kernel_size, args.kernel_size],
+                         hoist_inputs=args.hoist_inputs,
+                         feed_dtype=feed_dtype,
                          batch_size=args.batch_size)
     if args.model == 'Coupled_ConvGRU':
         model = CoupledConvGRU(input_shape=[20, 20, input_dim], input_steps=args.input_steps,
                                num_layers=args.num_layers, num_units=args.num_units, kernel_shape=[args.kernel_size, args.kernel_size],
                                dy_temporal=args.dy_temporal, att_units=args.att_units,
+                               recompute=args.recompute,
+                               feed_dtype=feed_dtype,
                                batch_size=args.batch_size)
     '''
     # bad results...
@@ -195,6 +219,8 @@ def main():
                          update_rule=args.update_rule,
                          learning_rate=args.learning_rate,
                          model_path=model_path,
+                         report_memory=args.report_memory,
+                         accum_steps=args.accum_steps,
                          )
     results_path = os.path.join(model_path, 'results')
     if not os.path.exists(results_path):
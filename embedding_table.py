@@ -0,0 +1,50 @@
+import os
+import glob
+import hashlib
+import numpy as np
+
+
+def load_embedding_table(file, mmap_mode='r', dtype=np.float32):
+    '''
+    Node ids and vectors of a LINE/node2vec text file ("num dim" header, then "id v1 ... vdim").
+    The text is parsed once into .npy sidecars named by its sha1 and the vector dtype, later
+    runs map them. The sha1 is kept in a .stamp sidecar with the size and mtime of the file,
+    so the text is only read and hashed again when those change.
+    :param dtype: dtype of the stored vectors, np.float64 keeps the parsed values exactly.
+    :return: ids, np.ndarray [num]; vectors, np.ndarray [num, dim].
+    '''
+    stat = os.stat(file)
+    stamp_file = file + '.stamp'
+    stamp = '%d %d' % (stat.st_size, stat.st_mtime_ns)
+    content = None
+    key = None
+    if os.path.isfile(stamp_file):
+        with open(stamp_file) as f:
+            cached_stamp, _, cached_key = f.read().strip().rpartition(' ')
+        if cached_stamp == stamp:
+            key = cached_key
+    if key is None:
+        with open(file, 'rb') as f:
+            content = f.read()
+        key = hashlib.sha1(content).hexdigest()[:16]
+        with open(stamp_file, 'w') as f:
+            f.write('%s %s' % (stamp, key))
+    ids_file = '%s.%s.ids.npy' % (file, key)
+    vectors_file = '%s.%s.%s.vectors.npy' % (file, key, np.dtype(dtype).name)
+    if os.path.isfile(ids_file) and os.path.isfile(vectors_file):
+        return np.load(ids_file, mmap_mode=mmap_mode), np.load(vectors_file, mmap_mode=mmap_mode)
+    if content is None:
+        with open(file, 'rb') as f:
+            content = f.read()
+    header, body = content.split(b'\n', 1)
+    dim = int(header.split()[1])
+    table = np.array(body.split(), dtype=np.float64).reshape(-1, dim + 1)
+    ids = table[:, 0].astype(np.int64)
+    vectors = table[:, 1:].astype(dtype)
+    # drop sidecars of older versions of the file
+    for old_file in glob.glob(glob.escape(file) + '.*.ids.npy') + glob.glob(glob.escape(file) + '.*.vectors.npy'):
+        if '.%s.' % key not in old_file[len(file):]:
+            os.remove(old_file)
+    np.save(ids_file, ids)
+    np.save(vectors_file, vectors)
+    return ids, vectors
@@ -0,0 +1,36 @@
+import numpy as np
+from metrics import get_metrics
+
+
+def fit_lazy(model, make_sequence, train_samples, test_samples, testY, minMax, batch_size, epochs,
+             callbacks, fname_param, trainable=True):
+    """Train and test a keras baseline on samples gathered batch by batch.
+
+    The last 10% of train_samples validate, as validation_split does for arrays. Without
+    trainable the weights are loaded from fname_param. Prints the train and test scores
+    like the build_model functions of the keras baselines.
+    :param make_sequence: keras Sequence of the samples, e.g. PatchSequence or NeighborSequence,
+        called as make_sequence(samples, batch_size, shuffle=False).
+    :param train_samples: samples with len() and subset(index), e.g. PatchSamples.
+    :return: predictions of test_samples.
+    """
+    num_val = int(len(train_samples) * 0.1)
+    if trainable:
+        model.fit_generator(make_sequence(train_samples.subset(slice(0, len(train_samples) - num_val)), batch_size,
+                                          shuffle=True),
+                            epochs=epochs,
+                            validation_data=make_sequence(train_samples.subset(slice(len(train_samples) - num_val, None)),
+                                                          batch_size),
+                            callbacks=callbacks)
+    else:
+        model.load_weights(fname_param)
+    score = model.evaluate_generator(make_sequence(train_samples, batch_size))
+    print('Train score: %.6f se (norm): %.6f se (real): %.6f' %
+          (score[0], score[1], minMax.inverse(minMax.inverse(score[1]))))
+    score = model.evaluate_generator(make_sequence(test_samples, batch_size))
+    print('Test score: %.6f se (norm): %.6f se (real): %.6f' %
+          (score[0], score[1], minMax.inverse(minMax.inverse(score[1]))))
+    prediction = model.predict_generator(make_sequence(test_samples, batch_size))
+    test_rmse = minMax.inverse(get_metrics(testY, prediction, clip=False)['rmse'])
+    print('test mse is %.6f, and rmse : %.6f' % (np.square(test_rmse), test_rmse))
+    return prediction
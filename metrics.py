@@ -0,0 +1,89 @@
+import numpy as np
+
+
+# rows of metric_sums: squared errors, squared log errors, absolute errors,
+# absolute percentage errors, ground truth and number of valid values
+SUM_NAMES = ('se', 'sle', 'ae', 'ape', 'true', 'count')
+METRIC_NAMES = ('rmse', 'rmlse', 'mae', 'mape', 'er')
+
+
+def _reduced_axes(ndim, keep_axes):
+    keep_axes = [axis % ndim for axis in keep_axes]
+    return tuple(axis for axis in range(ndim) if axis not in keep_axes)
+
+
+def metric_sums(y, y_out, mask=None, keep_axes=(), clip=True, mape_eps=1.):
+    """Sums behind RMSE, RMLSE, MAE, MAPE and ER, computed in one pass over the errors.
+
+    All terms are stacked and weighted by the mask once, then reduced with a single sum,
+    so sums of several batches can be added up and turned into metrics at the end.
+    :param y: ground truth, e.g. [batch_size, output_steps, num_station, 2]
+    :param y_out: prediction of the same shape.
+    :param mask: 0/1 weights broadcastable to y, e.g. for padded rows or missing records.
+    :param keep_axes: axes of y that are not reduced, e.g. (1,) for a per-horizon,
+        (2,) for a per-station or (-1,) for a per-channel breakdown.
+    :param clip: clip negative values to 0 first, demands are never negative.
+    :param mape_eps: added to the ground truth in the denominator of MAPE.
+    :return: [6] + kept dims, rows as in SUM_NAMES.
+    """
+    y = np.asarray(y, dtype=np.float64)
+    y_out = np.asarray(y_out, dtype=np.float64)
+    if clip:
+        y = np.maximum(y, 0.)
+        y_out = np.maximum(y_out, 0.)
+    abs_err = np.abs(y_out - y)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        # unclipped values below -1 leave RMLSE undefined, not the other metrics
+        log_err = np.log1p(y_out) - np.log1p(y)
+    terms = np.stack([np.square(abs_err), np.square(log_err), abs_err, abs_err / (y + mape_eps), y, np.ones_like(y)])
+    if mask is not None:
+        terms *= np.asarray(mask, dtype=np.float64)
+    return np.sum(terms, axis=tuple(axis + 1 for axis in _reduced_axes(y.ndim, keep_axes)))
+
+
+def metrics_from_sums(sums):
+    """Metrics from (accumulated) metric_sums, as a dict of METRIC_NAMES.
+
+    ER is the absolute error relative to the total demand, at least 1.
+    """
+    se, sle, ae, ape, true, count = sums
+    count = np.maximum(count, 1)
+    return {'rmse': np.sqrt(se / count),
+            'rmlse': np.sqrt(sle / count),
+            'mae': ae / count,
+            'mape': ape / count,
+            'er': ae / np.maximum(true, 1)}
+
+
+def get_metrics(y, y_out, mask=None, keep_axes=(), clip=True, mape_eps=1.):
+    """All metrics of one prediction, see metric_sums for the arguments."""
+    return metrics_from_sums(metric_sums(y, y_out, mask, keep_axes, clip, mape_eps))
+
+
+class MetricAccumulator(object):
+    """Streaming metrics over batches.
+
+    e.g. keep_axes=(-2, -1) on [batch_size, num_station, 2] keeps per-station and
+    per-channel sums; result() gives those, result(reduce_axes=(1,)) the per-station
+    and result(reduce_axes=(0, 1)) the overall metrics.
+    """
+    def __init__(self, keep_axes=(), clip=True, mape_eps=1.):
+        self.keep_axes = keep_axes
+        self.clip = clip
+        self.mape_eps = mape_eps
+        self.sums = None
+
+    def reset(self):
+        self.sums = None
+
+    def update_sums(self, sums):
+        # sums computed elsewhere, e.g. in the graph, in the layout of metric_sums
+        self.sums = np.array(sums, dtype=np.float64) if self.sums is None else self.sums + sums
+
+    def update(self, y, y_out, mask=None):
+        self.update_sums(metric_sums(y, y_out, mask, self.keep_axes, self.clip, self.mape_eps))
+
+    def result(self, reduce_axes=()):
+        """:param reduce_axes: axes among the kept ones that are summed before the metrics."""
+        sums = np.sum(self.sums, axis=tuple(axis % (self.sums.ndim - 1) + 1 for axis in reduce_axes))
+        return metrics_from_sums(sums)
@@ -7,6 +7,7 @@ sys.path.append('./util/')
 from utils import *
 from model.dcrnn_cell import DCGRUCell
 from model.convlstm_cell import Dy_Conv2DLSTMCell
+from model.layerwise_rnn import layerwise_rnn
 
 
 class ConvLSTM():
@@ -14,6 +15,8 @@ class ConvLSTM():
                  num_layers=3, num_units=64, kernel_shape=[3,3],
                  dy_adj=0,
                  dy_filter=0,
+                 hoist_inputs=0,
+                 feed_dtype=tf.float32,
                  batch_size=32):
         self.input_shape = input_shape
         self.input_steps = input_steps
@@ -22,8 +25,15 @@ class ConvLSTM():
         self.kernel_shape = kernel_shape
         self.dy_adj = dy_adj
         self.dy_filter = dy_filter
+        # run layer by layer with input-to-hidden convs batched over all input_steps
+        self.hoist_inputs = hoist_inputs
+        if self.hoist_inputs and self.dy_adj:
+            print('hoist_inputs needs dy_adj=0, use static_rnn instead.')
+            self.hoist_inputs = 0
 
         self.batch_size = batch_size
+        # dtype of the fed x/f/y, e.g. tf.float16 to halve the flow traffic; compute stays float32
+        self.feed_dtype = feed_dtype
 
         self.weight_initializer = tf.contrib.layers.xavier_initializer()
         self.const_initializer = tf.constant_initializer()
@@ -51,24 +61,29 @@ class ConvLSTM():
         else:
             cells = [first_cell, last_cell]
 
+        self.cell_list = cells
         self.cells = tf.contrib.rnn.MultiRNNCell(cells, state_is_tuple=True)
 
-        self.x = tf.placeholder(tf.float32, [self.batch_size, self.input_steps, self.input_shape[0], self.input_shape[1], self.input_shape[2]])
-        self.f = tf.placeholder(tf.float32,
+        self.x = tf.placeholder(self.feed_dtype, [self.batch_size, self.input_steps, self.input_shape[0], self.input_shape[1], self.input_shape[2]])
+        self.f = tf.placeholder(self.feed_dtype,
                                 [self.batch_size, self.input_steps, self.input_shape[0] * self.input_shape[1],
                                  self.input_shape[0] * self.input_shape[1]])
-        self.y = tf.placeholder(tf.float32, [self.batch_size, self.input_steps, self.input_shape[0], self.input_shape[1], self.input_shape[2]])
+        self.y = tf.placeholder(self.feed_dtype, [self.batch_size, self.input_steps, self.input_shape[0], self.input_shape[1], self.input_shape[2]])
+        self._x, self._f, self._y = [tf.cast(t, tf.float32) for t in (self.x, self.f, self.y)]
 
 
     def build_easy_model(self):
-        x = tf.transpose(tf.reshape(self.x, (self.batch_size, self.input_steps, self.input_shape[0], self.input_shape[1], -1)), [1, 0, 2, 3, 4])
+        x = tf.transpose(tf.reshape(self._x, (self.batch_size, self.input_steps, self.input_shape[0], self.input_shape[1], -1)), [1, 0, 2, 3, 4])
         inputs = tf.unstack(x, axis=0)
         #f_all = tf.transpose(tf.reshape(self.f, (self.batch_size, self.input_steps, self.input_shape[0], self.input_shape[1], self.input_shape[0] * self.input_shape[1])), [1, 0, 2, 3, 4])
         #inputs = tf.concat([x, f_all], axis=-1)
         #inputs = tf.unstack(inputs, axis=0)
         #
-        outputs, _ = tf.contrib.rnn.static_rnn(self.cells, inputs, dtype=tf.float32)
-        outputs = tf.stack(outputs)
+        if self.hoist_inputs:
+            outputs = layerwise_rnn(self.cell_list, x)
+        else:
+            outputs, _ = tf.contrib.rnn.static_rnn(self.cells, inputs, dtype=tf.float32)
+            outputs = tf.stack(outputs)
         #
         #print(outputs.get_shape().as_list())
         # projection
@@ -78,7 +93,7 @@ class ConvLSTM():
         #print(outputs.get_shape().as_list())
         outputs = tf.reshape(outputs, (self.input_steps, self.batch_size, self.input_shape[0], self.input_shape[1], -1))
         outputs = tf.transpose(outputs, [1, 0, 2, 3, 4])
-        loss = 2 * tf.nn.l2_loss(self.y - outputs)
+        loss = 2 * tf.nn.l2_loss(self._y - outputs)
         return outputs, loss
 
 
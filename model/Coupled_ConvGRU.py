@@ -7,6 +7,7 @@ sys.path.append('./util/')
 from utils import *
 from model.dcrnn_cell import DCGRUCell
 from model.coupled_convgru_cell import Coupled_Conv2DGRUCell
+from model.recompute_wrapper import wrap_recompute
 
 
 class CoupledConvGRU():
@@ -15,6 +16,8 @@ class CoupledConvGRU():
                  dy_temporal=0, att_units=64,
                  dy_adj=0,
                  dy_filter=0,
+                 recompute=0,
+                 feed_dtype=tf.float32,
                  batch_size=32):
         self.input_shape = input_shape
         self.input_steps = input_steps
@@ -27,8 +30,12 @@ class CoupledConvGRU():
         self.att_units = att_units
         # self.dy_adj = dy_adj
         # self.dy_filter = dy_filter
+        # number of lower layers whose step internals are recomputed in backprop
+        self.recompute = recompute
 
         self.batch_size = batch_size
+        # dtype of the fed x/f/y, e.g. tf.float16 to halve the flow traffic; compute stays float32
+        self.feed_dtype = feed_dtype
 
         self.weight_initializer = tf.contrib.layers.xavier_initializer()
         self.const_initializer = tf.constant_initializer()
@@ -67,20 +74,21 @@ class CoupledConvGRU():
         if num_layers == 1:
             cells = [one_cell]
 
-        self.cells = tf.contrib.rnn.MultiRNNCell(cells, state_is_tuple=True)
+        self.cells = tf.contrib.rnn.MultiRNNCell(wrap_recompute(cells, self.recompute), state_is_tuple=True)
 
-        self.x = tf.placeholder(tf.float32, [self.batch_size, self.input_steps, self.input_shape[0], self.input_shape[1], self.input_shape[2]])
-        self.f = tf.placeholder(tf.float32,
+        self.x = tf.placeholder(self.feed_dtype, [self.batch_size, self.input_steps, self.input_shape[0], self.input_shape[1], self.input_shape[2]])
+        self.f = tf.placeholder(self.feed_dtype,
                                 [self.batch_size, self.input_steps, self.input_shape[0] * self.input_shape[1],
                                  self.input_shape[0] * self.input_shape[1]])
-        self.y = tf.placeholder(tf.float32, [self.batch_size, self.input_steps, self.input_shape[0], self.input_shape[1], self.input_shape[2]])
+        self.y = tf.placeholder(self.feed_dtype, [self.batch_size, self.input_steps, self.input_shape[0], self.input_shape[1], self.input_shape[2]])
+        self._x, self._f, self._y = [tf.cast(t, tf.float32) for t in (self.x, self.f, self.y)]
 
 
 
     def build_easy_model(self):
-        x = tf.transpose(tf.reshape(self.x, (self.batch_size, self.input_steps, -1)), [1, 0, 2])
+        x = tf.transpose(tf.reshape(self._x, (self.batch_size, self.input_steps, -1)), [1, 0, 2])
         #inputs = tf.unstack(x, axis=0)
-        f_all = tf.transpose(tf.reshape(self.f, (self.batch_size, self.input_steps, -1)), [1, 0, 2])
+        f_all = tf.transpose(tf.reshape(self._f, (self.batch_size, self.input_steps, -1)), [1, 0, 2])
         inputs = tf.concat([x, f_all], axis=-1)
         inputs = tf.unstack(inputs, axis=0)
         #
@@ -98,7 +106,7 @@ class CoupledConvGRU():
             output = outputs[-1]
         # projection
         output = tf.layers.dense(output, units=self.input_shape[-1], activation=None, kernel_initializer=self.weight_initializer)
-        loss = 2 * tf.nn.l2_loss(self.y[:, -1, :, :, :] - output)
+        loss = 2 * tf.nn.l2_loss(self._y[:, -1, :, :, :] - output)
         #output = tf.expand_dims(output, 1)
         return tf.expand_dims(output, 1), loss
         #outputs = tf.layers.dense(tf.reshape(outputs, (-1, self.num_units)), units=self.input_shape[-1], activation=None, kernel_initializer=self.weight_initializer)
@@ -139,9 +147,9 @@ class CoupledConvGRU():
 
     '''
     def build_easy_model(self):
-        x = tf.transpose(tf.reshape(self.x, (self.batch_size, self.input_steps, -1)), [1, 0, 2])
+        x = tf.transpose(tf.reshape(self._x, (self.batch_size, self.input_steps, -1)), [1, 0, 2])
         #inputs = tf.unstack(x, axis=0)
-        f_all = tf.transpose(tf.reshape(self.f, (self.batch_size, self.input_steps, -1)), [1, 0, 2])
+        f_all = tf.transpose(tf.reshape(self._f, (self.batch_size, self.input_steps, -1)), [1, 0, 2])
         inputs = tf.concat([x, f_all], axis=-1)
         inputs = tf.unstack(inputs, axis=0)
         #
@@ -154,7 +162,7 @@ class CoupledConvGRU():
         #
         outputs = tf.reshape(outputs, (self.input_steps, self.batch_size, self.input_shape[0], self.input_shape[1], -1))
         outputs = tf.transpose(outputs, [1, 0, 2, 3, 4])
-        loss = 2 * tf.nn.l2_loss(self.y - outputs)
+        loss = 2 * tf.nn.l2_loss(self._y - outputs)
         return outputs, loss
     '''
 
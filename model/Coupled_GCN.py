@@ -5,9 +5,10 @@ import tensorflow as tf
 
 sys.path.append('./util/')
 from utils import *
-from model.dcrnn_cell import DCGRUCell
+from model.dcrnn_cell import DCGRUCell, build_shared_supports
 from model.coupled_convgru_cell import Coupled_Conv2DGRUCell
 from model.coupled_dcrnn_cell import Coupled_DCGRUCell
+from model.recompute_wrapper import wrap_recompute
 
 
 class Coupled_GCN():
@@ -18,6 +19,8 @@ class Coupled_GCN():
                  dy_filter=0,
                  f_adj_mx=None, trained_adj_mx=False,
                  filter_type='dual_random_walk',
+                 recompute=0,
+                 feed_dtype=tf.float32,
                  batch_size=32):
         self.num_nodes = num_station
         self.input_steps = input_steps
@@ -31,36 +34,51 @@ class Coupled_GCN():
         # self.dy_adj = dy_adj
         # self.dy_filter = dy_filter
 
+        # number of lower layers whose step internals are recomputed in backprop
+        self.recompute = recompute
+        if self.recompute and trained_adj_mx:
+            print('recompute does not pass gradients to the trained adjacent matrix, turn it off.')
+            self.recompute = 0
+
         self.batch_size = batch_size
+        # dtype of the fed x/f/y, e.g. tf.float16 to halve the flow traffic; compute stays float32
+        self.feed_dtype = feed_dtype
 
         self.weight_initializer = tf.contrib.layers.xavier_initializer()
         self.const_initializer = tf.constant_initializer()
-        #
+        # feed for tf.local_variables_initializer() (static supports)
+        self.init_feed_dict = {}
+        supports = None
         if trained_adj_mx:
             with tf.variable_scope('trained_adj_mx', reuse=tf.AUTO_REUSE):
                 adj_mx = tf.get_variable('adj_mx', [num_station, num_station], dtype=tf.float32,
                                          initializer=self.weight_initializer)
         else:
             adj_mx = f_adj_mx
+            if adj_mx is not None:
+                supports, self.init_feed_dict = build_shared_supports(adj_mx, self.filter_type)
 
         first_cell = Coupled_DCGRUCell(num_units=self.num_units, adj_mx=adj_mx,
                                        max_diffusion_step=self.max_diffusion_steps,
                                        num_nodes=self.num_nodes, num_proj=None,
                                        input_dim=2,
                                        output_dy_adj=1,
-                                       filter_type=self.filter_type)
+                                       filter_type=self.filter_type,
+                                       supports=supports)
         cell = Coupled_DCGRUCell(num_units=self.num_units, adj_mx=adj_mx,
                                  max_diffusion_step=self.max_diffusion_steps,
                                  num_nodes=self.num_nodes, num_proj=None,
                                  input_dim=self.num_units,
                                  output_dy_adj=1,
-                                 filter_type=self.filter_type)
+                                 filter_type=self.filter_type,
+                                 supports=supports)
         last_cell = Coupled_DCGRUCell(num_units=self.num_units, adj_mx=adj_mx,
                                       max_diffusion_step=self.max_diffusion_steps,
                                       num_nodes=self.num_nodes, num_proj=None,
                                       input_dim=self.num_units,
                                       output_dy_adj=0,
-                                      filter_type=self.filter_type)
+                                      filter_type=self.filter_type,
+                                      supports=supports)
 
         if num_layers > 2:
             cells = [first_cell] + [cell] * (num_layers-2) + [last_cell]
@@ -68,17 +86,18 @@ class Coupled_GCN():
             cells = [first_cell, last_cell]
         #cells = [first_cell, last_cell]
 
-        self.cells = tf.contrib.rnn.MultiRNNCell(cells, state_is_tuple=True)
+        self.cells = tf.contrib.rnn.MultiRNNCell(wrap_recompute(cells, self.recompute), state_is_tuple=True)
 
-        self.x = tf.placeholder(tf.float32, [self.batch_size, self.input_steps, self.num_nodes, 2])
-        self.f = tf.placeholder(tf.float32, [self.batch_size, self.input_steps, self.num_nodes, self.num_nodes])
-        self.y = tf.placeholder(tf.float32, [self.batch_size, self.input_steps, self.num_nodes, 2])
+        self.x = tf.placeholder(self.feed_dtype, [self.batch_size, self.input_steps, self.num_nodes, 2])
+        self.f = tf.placeholder(self.feed_dtype, [self.batch_size, self.input_steps, self.num_nodes, self.num_nodes])
+        self.y = tf.placeholder(self.feed_dtype, [self.batch_size, self.input_steps, self.num_nodes, 2])
+        self._x, self._f, self._y = [tf.cast(t, tf.float32) for t in (self.x, self.f, self.y)]
 
 
     def build_easy_model(self):
-        x = tf.transpose(tf.reshape(self.x, (self.batch_size, self.input_steps, -1)), [1, 0, 2])
+        x = tf.transpose(tf.reshape(self._x, (self.batch_size, self.input_steps, -1)), [1, 0, 2])
         #inputs = tf.unstack(x, axis=0)
-        f_all = tf.transpose(tf.reshape(self.f, (self.batch_size, self.input_steps, -1)), [1, 0, 2])
+        f_all = tf.transpose(tf.reshape(self._f, (self.batch_size, self.input_steps, -1)), [1, 0, 2])
         inputs = tf.concat([x, f_all], axis=-1)
         inputs = tf.unstack(inputs, axis=0)
         #
@@ -91,7 +110,7 @@ class Coupled_GCN():
         #
         outputs = tf.reshape(outputs, (self.input_steps, self.batch_size, self.num_nodes, -1))
         outputs = tf.transpose(outputs, [1, 0, 2, 3])
-        loss = 2 * tf.nn.l2_loss(self.y - outputs)
+        loss = 2 * tf.nn.l2_loss(self._y - outputs)
         return outputs, loss
 
 
@@ -4,7 +4,9 @@ import pickle
 import tensorflow as tf
 sys.path.append('./util/')
 from utils import *
-from model.dcrnn_cell import DCGRUCell
+from model.dcrnn_cell import DCGRUCell, build_shared_supports
+from model.layerwise_rnn import layerwise_rnn
+from model.recompute_wrapper import wrap_recompute
 
 
 class GCN():
@@ -16,6 +18,9 @@ class GCN():
                  f_adj_mx=None,
                  trained_adj_mx=False,
                  filter_type='dual_random_walk',
+                 hoist_inputs=0,
+                 recompute=0,
+                 feed_dtype=tf.float32,
                  batch_size=32):
         self.num_station = num_station
         self.input_steps = input_steps
@@ -26,57 +31,81 @@ class GCN():
         self.dy_filter = dy_filter
         self.f_adj_mx = f_adj_mx
         self.filter_type = filter_type
+        # run layer by layer with input-to-hidden diffusions batched over all input_steps
+        self.hoist_inputs = hoist_inputs
+        if self.hoist_inputs and (self.dy_adj or self.dy_filter):
+            print('hoist_inputs needs dy_adj=0 and dy_filter=0, use static_rnn instead.')
+            self.hoist_inputs = 0
+        # number of lower layers whose step internals are recomputed in backprop
+        self.recompute = recompute
+        if self.recompute and trained_adj_mx:
+            print('recompute does not pass gradients to the trained adjacent matrix, turn it off.')
+            self.recompute = 0
+        if self.recompute and self.hoist_inputs:
+            print('recompute is only used with static_rnn, ignored with hoist_inputs.')
 
         self.batch_size = batch_size
+        # dtype of the fed x/f/y, e.g. tf.float16 to halve the flow traffic; compute stays float32
+        self.feed_dtype = feed_dtype
 
         self.weight_initializer = tf.contrib.layers.xavier_initializer()
         self.const_initializer = tf.constant_initializer()
 
 
+        # feed for tf.local_variables_initializer() (static supports)
+        self.init_feed_dict = {}
+        supports = None
         if trained_adj_mx:
             with tf.variable_scope('trained_adj_mx', reuse=tf.AUTO_REUSE):
                 adj_mx = tf.get_variable('adj_mx', [self.num_station, self.num_station], dtype=tf.float32,
                                          initializer=self.weight_initializer)
         else:
             adj_mx = self.f_adj_mx
+            if self.dy_adj == 0 and adj_mx is not None:
+                supports, self.init_feed_dict = build_shared_supports(adj_mx, self.filter_type)
         #
         first_cell = DCGRUCell(self.num_units, adj_mx=adj_mx, max_diffusion_step=self.max_diffusion_step,
                                num_nodes=self.num_station, num_proj=None,
                                input_dim=2,
                                dy_adj=self.dy_adj, dy_filter=self.dy_filter,
                                output_dy_adj=self.dy_adj,
-                               filter_type=self.filter_type)
+                               filter_type=self.filter_type,
+                               supports=supports)
         cell = DCGRUCell(self.num_units, adj_mx=adj_mx, max_diffusion_step=max_diffusion_step,
                          num_nodes=self.num_station, num_proj=None,
                          input_dim=self.num_units,
                          dy_adj=self.dy_adj, dy_filter=0,
                          output_dy_adj=self.dy_adj,
-                         filter_type=self.filter_type)
+                         filter_type=self.filter_type,
+                         supports=supports)
         cell_with_projection = DCGRUCell(self.num_units, adj_mx=adj_mx, max_diffusion_step=max_diffusion_step,
                                          num_nodes=self.num_station, num_proj=2,
                                          input_dim=self.num_units,
                                          dy_adj=self.dy_adj, dy_filter=0,
                                          output_dy_adj=False,
-                                         filter_type=self.filter_type)
+                                         filter_type=self.filter_type,
+                                         supports=supports)
         if num_layers > 2:
             cells = [first_cell] + [cell] * (num_layers-2) + [cell_with_projection]
         else:
             cells = [first_cell, cell_with_projection]
 
-        self.cells = tf.contrib.rnn.MultiRNNCell(cells, state_is_tuple=True)
+        self.cell_list = cells
+        self.cells = tf.contrib.rnn.MultiRNNCell(wrap_recompute(cells, self.recompute), state_is_tuple=True)
         #
-        self.x = tf.placeholder(tf.float32, [self.batch_size, self.input_steps, self.num_station, 2])
-        self.f = tf.placeholder(tf.float32, [self.batch_size, self.input_steps, self.num_station, self.num_station])
-        self.y = tf.placeholder(tf.float32, [self.batch_size, self.input_steps, self.num_station, 2])
+        self.x = tf.placeholder(self.feed_dtype, [self.batch_size, self.input_steps, self.num_station, 2])
+        self.f = tf.placeholder(self.feed_dtype, [self.batch_size, self.input_steps, self.num_station, self.num_station])
+        self.y = tf.placeholder(self.feed_dtype, [self.batch_size, self.input_steps, self.num_station, 2])
+        self._x, self._f, self._y = [tf.cast(t, tf.float32) for t in (self.x, self.f, self.y)]
 
 
     def build_model(self):
-        x = tf.unstack(tf.reshape(self.x, (self.batch_size, self.input_steps, self.num_station*2)), axis=1)
-        f_all = tf.unstack(tf.reshape(self.f, (self.batch_size, self.input_steps, self.num_station*self.num_station)), axis=1)
+        x = tf.unstack(tf.reshape(self._x, (self.batch_size, self.input_steps, self.num_station*2)), axis=1)
+        f_all = tf.unstack(tf.reshape(self._f, (self.batch_size, self.input_steps, self.num_station*self.num_station)), axis=1)
         #x = tf.unstack(tf.reshape(self.x, (-1, self.input_steps, self.num_station * 2)), axis=1)
         #f_all = tf.unstack(tf.reshape(self.f, (-1, self.input_steps, self.num_station*self.num_station)), axis=1)
 
-        y = self.y
+        y = self._y
         hidden_state = tf.zeros([self.batch_size, self.num_station*self.num_units])
         #current_state = tf.zeros([self.batch_size, self.num_station*self.num_unists])
         #state = hidden_state, current_state
@@ -104,24 +133,27 @@ class GCN():
     def build_easy_model(self):
         #x = tf.unstack(tf.reshape(self.x, (self.batch_size, self.input_steps, self.num_station*2)), axis=1)
         #f_all = tf.unstack(tf.reshape(self.f, (self.batch_size, self.input_steps, self.num_station*self.num_station)), axis=1)
-        x = tf.transpose(tf.reshape(self.x, (self.batch_size, self.input_steps, -1)), [1, 0, 2])
-        f_all = tf.transpose(tf.reshape(self.f, (self.batch_size, self.input_steps, -1)), [1, 0, 2])
+        x = tf.transpose(tf.reshape(self._x, (self.batch_size, self.input_steps, -1)), [1, 0, 2])
+        f_all = tf.transpose(tf.reshape(self._f, (self.batch_size, self.input_steps, -1)), [1, 0, 2])
         # x: [input_steps, batch_size, num_station*2]
         # f_all: [input_steps, batch_size, num_station*num_station]
         inputs = tf.concat([x, f_all], axis=-1)
-        inputs = tf.unstack(inputs, axis=0)
-        #inputs = list(zip(*(x, f_all)))
-        #elems = (x, f_all)
-        #inputs = tf.map_fn(lambda x: tf.tuple([x[0], x[1]]), elems, dtype=[tf.float32, tf.float32])
-        outputs, _ = tf.contrib.rnn.static_rnn(self.cells, inputs, dtype=tf.float32)
-        outputs = tf.stack(outputs)
+        if self.hoist_inputs:
+            outputs = layerwise_rnn(self.cell_list, inputs)
+        else:
+            inputs = tf.unstack(inputs, axis=0)
+            #inputs = list(zip(*(x, f_all)))
+            #elems = (x, f_all)
+            #inputs = tf.map_fn(lambda x: tf.tuple([x[0], x[1]]), elems, dtype=[tf.float32, tf.float32])
+            outputs, _ = tf.contrib.rnn.static_rnn(self.cells, inputs, dtype=tf.float32)
+            outputs = tf.stack(outputs)
         #
         #outputs = tf.nn.relu(outputs)
         #
         outputs = tf.reshape(outputs, (self.input_steps, self.batch_size, self.num_station, -1))
         outputs = tf.transpose(outputs, [1, 0, 2, 3])
         #outputs = outputs + self.x
-        loss = 2*tf.nn.l2_loss(self.y - outputs)
+        loss = 2*tf.nn.l2_loss(self._y - outputs)
         return outputs, loss
     
     
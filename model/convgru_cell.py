@@ -157,6 +157,57 @@ class Dy_Conv2DGRUCell(rnn_cell_impl.RNNCell):
             output = tf.concat([output, dy_f], axis=-1)
         return output, new_state
 
+    def input_projection(self, inputs, scope=None):
+        """Input halves of the gate and candidate convolutions, for a whole sequence.
+
+        The kernels of _conv are split along the input depth into input and state
+        parts, so the input contribution of all steps runs as one batched conv before
+        the recurrence (see state_step). Only for dy_adj=0.
+
+        Args:
+            inputs: [input_steps*batch_size, row, col, input_dim]
+
+        Returns:
+            [input_steps*batch_size, row, col, 3*output_channels]
+        """
+        self._hoisted_input_dim = inputs.get_shape().as_list()[-1]
+        # the scope __call__ opens, so the variables are those of the unhoisted cell
+        with tf.variable_scope(scope or self.name, reuse=tf.AUTO_REUSE):
+            with tf.variable_scope('gru_ru', reuse=tf.AUTO_REUSE):
+                ru = self._split_conv(inputs, 2 * self._output_channels, part='input')
+            with tf.variable_scope('gru_c', reuse=tf.AUTO_REUSE):
+                c = self._split_conv(inputs, self._output_channels, part='input')
+        return tf.concat([ru, c], axis=-1)
+
+    def state_step(self, inputs_proj, state, scope=None):
+        """One recurrent step given the output of input_projection for this step."""
+        hidden = state
+        ru_in, c_in = tf.split(inputs_proj, num_or_size_splits=[2 * self._output_channels, self._output_channels], axis=-1)
+        with tf.variable_scope(scope or self.name, reuse=tf.AUTO_REUSE):
+            with tf.variable_scope('gru_ru', reuse=tf.AUTO_REUSE):
+                new_hidden = tf.nn.sigmoid(ru_in + self._split_conv(hidden, 2 * self._output_channels, part='state'))
+                r, u = array_ops.split(value=new_hidden, num_or_size_splits=2, axis=3)
+            with tf.variable_scope('gru_c', reuse=tf.AUTO_REUSE):
+                c = c_in + self._split_conv(r * hidden, self._output_channels, part='state')
+        output = new_state = u * state + (1 - u) * c
+        return output, new_state
+
+    def _split_conv(self, x, num_features, part='input'):
+        """Convolution of x with the input or the state slice of the _conv kernel.
+        Biases are added on the input part only.
+        """
+        input_dim = self._hoisted_input_dim
+        kernel = tf.get_variable("kernel", self._kernel_shape + [input_dim + self._output_channels, num_features],
+                                 dtype=tf.float32, initializer=self.weight_initializer)
+        if part == 'input':
+            res = tf.nn.conv2d(x, kernel[:, :, :input_dim, :], [1, 1, 1, 1], padding='SAME')
+            if self._use_bias:
+                res = res + vs.get_variable("biases", [num_features], dtype=tf.float32,
+                                            initializer=init_ops.constant_initializer(0, dtype=tf.float32))
+        else:
+            res = tf.nn.conv2d(x, kernel[:, :, input_dim:, :], [1, 1, 1, 1], padding='SAME')
+        return res
+
     def _conv(self, args, filter_size, num_features, bias, bias_start=0.0,
               dy_f=None):
         """Convolution.
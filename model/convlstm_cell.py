@@ -149,6 +149,55 @@ class Dy_Conv2DLSTMCell(rnn_cell_impl.RNNCell):
             output = tf.concat([output, dy_f], axis=-1)
         return output, new_state
 
+    def input_projection(self, inputs, scope=None):
+        """Input half of the gate convolution, for a whole sequence.
+
+        The kernel of _conv is split along the input depth into input and state
+        parts, so the input contribution of all steps runs as one batched conv before
+        the recurrence (see state_step). Only for dy_adj=0.
+
+        Args:
+            inputs: [input_steps*batch_size, row, col, input_dim]
+
+        Returns:
+            [input_steps*batch_size, row, col, 4*output_channels]
+        """
+        self._hoisted_input_dim = inputs.get_shape().as_list()[-1]
+        # the scope __call__ opens, so the variables are those of the unhoisted cell
+        with tf.variable_scope(scope or self.name, reuse=tf.AUTO_REUSE):
+            return self._split_conv(inputs, 4 * self._output_channels, part='input')
+
+    def state_step(self, inputs_proj, state, scope=None):
+        """One recurrent step given the output of input_projection for this step."""
+        cell, hidden = state
+        with tf.variable_scope(scope or self.name, reuse=tf.AUTO_REUSE):
+            new_hidden = inputs_proj + self._split_conv(hidden, 4 * self._output_channels, part='state')
+        gates = array_ops.split(
+            value=new_hidden, num_or_size_splits=4, axis=3)
+
+        input_gate, new_input, forget_gate, output_gate = gates
+        new_cell = math_ops.sigmoid(forget_gate + self._forget_bias) * cell
+        new_cell += math_ops.sigmoid(input_gate) * math_ops.tanh(new_input)
+        output = math_ops.tanh(new_cell) * math_ops.sigmoid(output_gate)
+        new_state = rnn_cell_impl.LSTMStateTuple(new_cell, output)
+        return output, new_state
+
+    def _split_conv(self, x, num_features, part='input'):
+        """Convolution of x with the input or the state slice of the _conv kernel.
+        Biases are added on the input part only.
+        """
+        input_dim = self._hoisted_input_dim
+        kernel = tf.get_variable("kernel", self._kernel_shape + [input_dim + self._output_channels, num_features],
+                                 dtype=tf.float32, initializer=self.weight_initializer)
+        if part == 'input':
+            res = tf.nn.conv2d(x, kernel[:, :, :input_dim, :], [1, 1, 1, 1], padding='SAME')
+            if self._use_bias:
+                res = res + vs.get_variable("biases", [num_features], dtype=tf.float32,
+                                            initializer=init_ops.constant_initializer(0, dtype=tf.float32))
+        else:
+            res = tf.nn.conv2d(x, kernel[:, :, input_dim:, :], [1, 1, 1, 1], padding='SAME')
+        return res
+
     def _conv(self, args, filter_size, num_features, bias, bias_start=0.0,
               dy_f=None):
         """Convolution.
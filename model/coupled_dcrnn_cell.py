@@ -24,7 +24,8 @@ class Coupled_DCGRUCell(RNNCell):
 
     def __init__(self, num_units, adj_mx, max_diffusion_step, num_nodes, num_proj=None,
                  input_dim=None, dy_adj=1, dy_filter=0, output_dy_adj=False,
-                 activation=tf.nn.tanh, reuse=None, filter_type="dual_random_walk", use_gc_for_ru=True):
+                 activation=tf.nn.tanh, reuse=None, filter_type="dual_random_walk", use_gc_for_ru=True,
+                 supports=None):
         """
 
         :param num_units:
@@ -42,6 +43,7 @@ class Coupled_DCGRUCell(RNNCell):
         :param reuse:
         :param filter_type: "laplacian", "random_walk", "dual_random_walk".
         :param use_gc_for_ru: whether to use Graph convolution to calculate the reset and update gates.
+        :param supports: shared static supports from build_shared_supports, used instead of adj_mx.
         """
         super(Coupled_DCGRUCell, self).__init__(_reuse=reuse)
         self._activation = activation
@@ -66,7 +68,10 @@ class Coupled_DCGRUCell(RNNCell):
         else:
             self._len_supports = 1
 
-        if adj_mx is not None:
+        if supports is not None:
+            # for fixed adjacent matrix shared by all cells
+            self._supports = [supports[k] for k in range(self._len_supports)]
+        elif adj_mx is not None:
             # for fixed adjacent matrix
             if self.filter_type == 'laplacian':
                 self._supports.append(tf.convert_to_tensor(adj_mx, dtype=tf.float32))
@@ -120,11 +125,24 @@ class Coupled_DCGRUCell(RNNCell):
         else:
             dy_adj_mx = None
         #
+        # diffusion is linear: diffuse the inputs once over the fixed and the dynamic
+        # supports and share them between the gates and the candidate passes.
+        batch_size = inputs.get_shape()[0].value
+        if dy_adj_mx is not None:
+            dy_supports = self.get_supports(tf.reshape(dy_adj_mx, (batch_size, self._num_nodes, -1)))
+        else:
+            dy_supports = None
+        inputs = tf.reshape(inputs, (batch_size, self._num_nodes, -1))
+        inputs_diffused = self._diffusion(inputs, None)
+        if dy_supports is None:
+            f_inputs_diffused = inputs_diffused
+        else:
+            f_inputs_diffused = self._diffusion(inputs, dy_supports)
         # ------- dcgru ------
         with tf.variable_scope('dcgru', reuse=tf.AUTO_REUSE):
             with tf.variable_scope('gates', reuse=tf.AUTO_REUSE):
-                value = self._gconv(inputs=inputs, state=state, dy_adj_mx=None,
-                                    output_size=2*self._num_units)
+                value = self._gconv_shared(inputs_diffused, state, None,
+                                           output_size=2*self._num_units)
                 value = tf.reshape(value, (-1, self._num_nodes, 2*self._num_units))
                 r, u = tf.split(value=value, num_or_size_splits=2, axis=-1)
                 r = tf.reshape(r, (-1, self._num_nodes * self._num_units))
@@ -132,8 +150,8 @@ class Coupled_DCGRUCell(RNNCell):
         # ------- flow-gcn --------
         with tf.variable_scope('flow-gcn', reuse=tf.AUTO_REUSE):
             with tf.variable_scope('gates', reuse=tf.AUTO_REUSE):
-                f_value = self._gconv(inputs=inputs, state=state, dy_adj_mx=dy_adj_mx,
-                                      output_size=2*self._num_units, bias=False)
+                f_value = self._gconv_shared(f_inputs_diffused, state, dy_supports,
+                                             output_size=2*self._num_units, bias=False)
                 f_value = tf.reshape(f_value, (-1, self._num_nodes, 2*self._num_units))
                 f_r, f_u = tf.split(value=f_value, num_or_size_splits=2, axis=-1)
                 f_r = tf.reshape(f_r, (-1, self._num_nodes * self._num_units))
@@ -143,11 +161,11 @@ class Coupled_DCGRUCell(RNNCell):
         couple_u = tf.nn.sigmoid(u + f_u)
         with tf.variable_scope('candidate', reuse=tf.AUTO_REUSE):
             with tf.variable_scope('fix', reuse=tf.AUTO_REUSE):
-                c = self._gconv(inputs=inputs, state=couple_r * state, dy_adj_mx=None,
-                                output_size=self._num_units)
+                c = self._gconv_shared(inputs_diffused, couple_r * state, None,
+                                       output_size=self._num_units)
             with tf.variable_scope('dy_flow', reuse=tf.AUTO_REUSE):
-                f_c = self._gconv(inputs=inputs, state=couple_r * state, dy_adj_mx=dy_adj_mx,
-                                  output_size=self._num_units)
+                f_c = self._gconv_shared(f_inputs_diffused, couple_r * state, dy_supports,
+                                         output_size=self._num_units)
         if self._activation is not None:
             couple_c = self._activation(c + f_c)
         else:
@@ -157,7 +175,6 @@ class Coupled_DCGRUCell(RNNCell):
         if self._num_proj is not None:
             with tf.variable_scope("projection", reuse=tf.AUTO_REUSE):
                 w = tf.get_variable('w', shape=(self._num_units, self._num_proj))
-                batch_size = inputs.get_shape()[0].value
                 output = tf.reshape(new_state, shape=(-1, self._num_units))
                 output = tf.reshape(tf.matmul(output, w), shape=(batch_size, self.output_size))
         if self.output_dy_adj:
@@ -224,6 +241,63 @@ class Coupled_DCGRUCell(RNNCell):
         '''
         return supports
 
+    def _diffusion(self, x, dy_supports=None):
+        """Diffusion of x over the fixed supports, or over the dynamic supports of each sample.
+        :param x: (batch_size, num_nodes, input_size)
+        :param dy_supports: list of (batch_size, num_nodes, num_nodes), None for the fixed supports.
+        :return: (batch_size * num_nodes, input_size * num_matrices)
+        """
+        batch_size = x.get_shape()[0].value
+        input_size = x.get_shape()[2].value
+        if dy_supports is None:
+            supports = self._supports
+            x0 = tf.transpose(x, perm=[1, 2, 0])  # (num_nodes, input_size, batch_size)
+            x0 = tf.reshape(x0, shape=[self._num_nodes, input_size * batch_size])
+        else:
+            supports = dy_supports
+            x0 = x
+        x = tf.expand_dims(x0, axis=0)
+        num_matrices = 1
+        if self._max_diffusion_step > 0:
+            num_matrices += len(supports) * self._max_diffusion_step
+            for support in supports:
+                x1 = tf.matmul(support, x0)
+                x = self._concat(x, x1)
+
+                for k in range(2, self._max_diffusion_step + 1):
+                    x2 = 2 * tf.matmul(support, x1) - x0
+                    x = self._concat(x, x2)
+                    x1, x0 = x2, x1
+        if dy_supports is None:
+            x = tf.reshape(x, shape=[num_matrices, self._num_nodes, input_size, batch_size])
+            x = tf.transpose(x, perm=[3, 1, 2, 0])  # (batch_size, num_nodes, input_size, order)
+        else:
+            x = tf.reshape(x, shape=[num_matrices, batch_size, self._num_nodes, input_size])
+            x = tf.transpose(x, perm=[1, 2, 3, 0])  # (batch_size, num_nodes, input_size, order)
+        return tf.reshape(x, shape=[batch_size * self._num_nodes, input_size * num_matrices])
+
+    def _gconv_shared(self, inputs_diffused, state, dy_supports, output_size, bias=True, bias_start=0.0):
+        """_gconv with the diffusion of the inputs computed once by the caller.
+
+        Features are ordered (input_size, order), so concatenating the diffused inputs and
+        the diffused state gives the same matrix (and weights) as diffusing [inputs, state].
+        :param inputs_diffused: (batch_size * num_nodes, input_dim * num_matrices), from _diffusion.
+        :return: (batch_size, num_nodes * output_size)
+        """
+        batch_size = state.get_shape()[0].value
+        state = tf.reshape(state, (batch_size, self._num_nodes, -1))
+        x = tf.concat([inputs_diffused, self._diffusion(state, dy_supports)], axis=-1)
+        dtype = x.dtype
+        weights = tf.get_variable(
+            'weights', [x.get_shape()[-1].value, output_size], dtype=dtype,
+            initializer=tf.contrib.layers.xavier_initializer())
+        x = tf.matmul(x, weights)  # (batch_size * self._num_nodes, output_size)
+        if bias:
+            biases = tf.get_variable("biases", [output_size], dtype=dtype,
+                                     initializer=tf.constant_initializer(bias_start, dtype=dtype))
+            x = tf.nn.bias_add(x, biases)
+        return tf.reshape(x, [batch_size, self._num_nodes * output_size])
+
     def _gconv(self, inputs, state, dy_adj_mx, output_size, bias=True, bias_start=0.0):
         """Graph convolution between input and the graph matrix.
 
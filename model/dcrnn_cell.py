@@ -12,6 +12,25 @@ from tensorflow.python.ops import array_ops
 import utils
 
 
+def build_shared_supports(adj_mx, filter_type='dual_random_walk', name='static_supports'):
+    """Hold the static supports of adj_mx in one non-trainable variable shared by all cells.
+
+    The supports are computed in numpy and fed at initialization, so the
+    [num_nodes, num_nodes] matrices are not embedded in the GraphDef as constants.
+
+    :param adj_mx: np.ndarray, [num_nodes, num_nodes].
+    :param filter_type: "laplacian", "random_walk", "dual_random_walk".
+    :return:
+    - supports: tf.Variable, [num_supports, num_nodes, num_nodes], in LOCAL_VARIABLES.
+    - init_feed_dict: feed_dict for tf.local_variables_initializer().
+    """
+    supports = utils.calculate_supports(adj_mx, filter_type)
+    supports_init = tf.placeholder(tf.float32, supports.shape, name=name + '_init')
+    supports_var = tf.Variable(supports_init, trainable=False,
+                               collections=[tf.GraphKeys.LOCAL_VARIABLES], name=name)
+    return supports_var, {supports_init: supports}
+
+
 class DCGRUCell(RNNCell):
     """Graph Convolution Gated Recurrent Unit cell.
     """
@@ -25,7 +44,8 @@ class DCGRUCell(RNNCell):
     def __init__(self, num_units, adj_mx, max_diffusion_step, num_nodes, num_proj=None,
                  input_dim=None, dy_adj=1, dy_filter=0, output_dy_adj=False,
                  add_att_context=False, att_inputs=[], att_hidden_dim=64,
-                 activation=tf.nn.tanh, reuse=tf.AUTO_REUSE, filter_type="dual_random_walk", use_gc_for_ru=True):
+                 activation=tf.nn.tanh, reuse=tf.AUTO_REUSE, filter_type="dual_random_walk", use_gc_for_ru=True,
+                 supports=None):
         """
 
         :param num_units:
@@ -43,6 +63,7 @@ class DCGRUCell(RNNCell):
         :param reuse:
         :param filter_type: "laplacian", "random_walk", "dual_random_walk".
         :param use_gc_for_ru: whether to use Graph convolution to calculate the reset and update gates.
+        :param supports: shared static supports from build_shared_supports, used instead of adj_mx.
         """
         super(DCGRUCell, self).__init__(_reuse=reuse)
         self._activation = activation
@@ -69,7 +90,10 @@ class DCGRUCell(RNNCell):
             self._len_supports = 2
         else:
             self._len_supports = 1
-        if self.dy_adj==0 and adj_mx is not None:
+        if self.dy_adj==0 and supports is not None:
+            # for fixed adjacent matrix shared by all cells
+            self._supports = [supports[k] for k in range(self._len_supports)]
+        elif self.dy_adj==0 and adj_mx is not None:
             # for fixed adjacent matrix
             if self.filter_type == 'laplacian':
                 self._supports.append(tf.convert_to_tensor(adj_mx, dtype=tf.float32))
@@ -129,20 +153,36 @@ class DCGRUCell(RNNCell):
             dy_adj_mx = self.attention_layer(state, self._num_nodes * self._num_units, self.att_hidden_dim)
 
         with tf.variable_scope(scope or "dcgru_cell", reuse=tf.AUTO_REUSE):
+            if self._use_gc_for_ru and self.dy_filter == 0:
+                # diffusion is linear: diffuse the inputs once and share them between
+                # the gates and the candidate, only state and r*state are diffused per pass.
+                batch_size = inputs.get_shape()[0].value
+                if self.dy_adj == 0:
+                    dy_supports = None
+                else:
+                    dy_supports = self.get_supports(tf.reshape(dy_adj_mx, (batch_size, self._num_nodes, -1)))
+                inputs_diffused = self._diffusion(tf.reshape(inputs, (batch_size, self._num_nodes, -1)), dy_supports)
             with tf.variable_scope("gates", reuse=tf.AUTO_REUSE):  # Reset gate and update gate.
                 output_size = 2 * self._num_units
                 # We start with bias of 1.0 to not reset and not update.
-                if self._use_gc_for_ru:
-                    fn = self._gconv
+                if self._use_gc_for_ru and self.dy_filter == 0:
+                    value = self._gconv_shared(inputs_diffused, state, dy_supports, output_size, bias_start=1.0)
                 else:
-                    fn = self._fc
-                value = tf.nn.sigmoid(fn(inputs, state, dy_adj_mx, output_size, bias_start=1.0))
+                    if self._use_gc_for_ru:
+                        fn = self._gconv
+                    else:
+                        fn = self._fc
+                    value = fn(inputs, state, dy_adj_mx, output_size, bias_start=1.0)
+                value = tf.nn.sigmoid(value)
                 value = tf.reshape(value, (-1, self._num_nodes, output_size))
                 r, u = tf.split(value=value, num_or_size_splits=2, axis=-1)
                 r = tf.reshape(r, (-1, self._num_nodes * self._num_units))
                 u = tf.reshape(u, (-1, self._num_nodes * self._num_units))
             with tf.variable_scope("candidate", reuse=tf.AUTO_REUSE):
-                c = self._gconv(inputs, r * state, dy_adj_mx, self._num_units)
+                if self._use_gc_for_ru and self.dy_filter == 0:
+                    c = self._gconv_shared(inputs_diffused, r * state, dy_supports, self._num_units)
+                else:
+                    c = self._gconv(inputs, r * state, dy_adj_mx, self._num_units)
                 if self._activation is not None:
                     c = self._activation(c)
             output = new_state = u * state + (1 - u) * c
@@ -158,6 +198,135 @@ class DCGRUCell(RNNCell):
             output = tf.concat([output, dy_adj_mx], axis=-1)
         return output, new_state
 
+    def input_projection(self, inputs, scope=None):
+        """Input halves of the gate and candidate graph convolutions, for a whole sequence.
+
+        The weights of _gconv are split into input rows and state rows, so the input
+        contribution can be computed for all steps in one batched diffusion before the
+        recurrence (see state_step). Only for fixed adjacent matrix (dy_adj=0).
+        :param inputs: (input_steps * batch_size, num_nodes * input_dim)
+        :return: (input_steps * batch_size, num_nodes * 3 * num_units)
+        """
+        batch_size = inputs.get_shape()[0].value
+        inputs = tf.reshape(inputs, (batch_size, self._num_nodes, -1))
+        self._hoisted_input_size = inputs.get_shape()[2].value
+        num_rows = self._hoisted_input_size * self._num_matrices()
+        # diffusion of the inputs is shared by the gates and the candidate
+        x = self._diffusion(inputs)
+        with tf.variable_scope(scope or "dcgru_cell", reuse=tf.AUTO_REUSE):
+            with tf.variable_scope("gates", reuse=tf.AUTO_REUSE):
+                weights, biases = self._gconv_params(2 * self._num_units, bias_start=1.0)
+                ru = tf.nn.bias_add(tf.matmul(x, weights[:num_rows]), biases)
+            with tf.variable_scope("candidate", reuse=tf.AUTO_REUSE):
+                weights, biases = self._gconv_params(self._num_units)
+                c = tf.nn.bias_add(tf.matmul(x, weights[:num_rows]), biases)
+        return tf.reshape(tf.concat([ru, c], axis=-1), (batch_size, self._num_nodes * 3 * self._num_units))
+
+    def state_step(self, inputs_proj, state, scope=None):
+        """One recurrent step given the output of input_projection for this step.
+        :param inputs_proj: (B, num_nodes * 3 * num_units)
+        :param state: (B, num_nodes * num_units)
+        :return: output, new_state as in __call__.
+        """
+        batch_size = state.get_shape()[0].value
+        num_rows = self._hoisted_input_size * self._num_matrices()
+        inputs_proj = tf.reshape(inputs_proj, (batch_size * self._num_nodes, 3 * self._num_units))
+        ru_in, c_in = tf.split(inputs_proj, num_or_size_splits=[2 * self._num_units, self._num_units], axis=-1)
+        with tf.variable_scope(scope or "dcgru_cell", reuse=tf.AUTO_REUSE):
+            with tf.variable_scope("gates", reuse=tf.AUTO_REUSE):
+                weights, _ = self._gconv_params(2 * self._num_units, bias_start=1.0)
+                x = self._diffusion(tf.reshape(state, (batch_size, self._num_nodes, -1)))
+                value = tf.nn.sigmoid(ru_in + tf.matmul(x, weights[num_rows:]))
+                value = tf.reshape(value, (-1, self._num_nodes, 2 * self._num_units))
+                r, u = tf.split(value=value, num_or_size_splits=2, axis=-1)
+                r = tf.reshape(r, (-1, self._num_nodes * self._num_units))
+                u = tf.reshape(u, (-1, self._num_nodes * self._num_units))
+            with tf.variable_scope("candidate", reuse=tf.AUTO_REUSE):
+                weights, _ = self._gconv_params(self._num_units)
+                x = self._diffusion(tf.reshape(r * state, (batch_size, self._num_nodes, -1)))
+                c = tf.reshape(c_in + tf.matmul(x, weights[num_rows:]), (batch_size, self._num_nodes * self._num_units))
+                if self._activation is not None:
+                    c = self._activation(c)
+            output = new_state = u * state + (1 - u) * c
+            if self._num_proj is not None:
+                with tf.variable_scope("projection", reuse=tf.AUTO_REUSE):
+                    w = tf.get_variable('w', shape=(self._num_units, self._num_proj))
+                    output = tf.reshape(new_state, shape=(-1, self._num_units))
+                    output = tf.reshape(tf.matmul(output, w), shape=(batch_size, self.output_size))
+        return output, new_state
+
+    def _num_matrices(self):
+        return self._len_supports * self._max_diffusion_step + 1  # Adds for x itself.
+
+    def _gconv_params(self, output_size, bias_start=0.0):
+        """Weights and biases of _gconv for inputs of size self._hoisted_input_size.
+        Rows of the weights are ordered (input_dim + num_units, num_matrices), so the
+        first input_dim * num_matrices rows act on the inputs and the rest on the state.
+        """
+        input_size = self._hoisted_input_size + self._num_units
+        weights = tf.get_variable(
+            'weights', [input_size * self._num_matrices(), output_size], dtype=tf.float32,
+            initializer=tf.contrib.layers.xavier_initializer())
+        biases = tf.get_variable("biases", [output_size], dtype=tf.float32,
+                                 initializer=tf.constant_initializer(bias_start, dtype=tf.float32))
+        return weights, biases
+
+    def _diffusion(self, x, dy_supports=None):
+        """Diffusion of x over the fixed supports, or over the dynamic supports of each sample.
+        :param x: (batch_size, num_nodes, input_size)
+        :param dy_supports: list of (batch_size, num_nodes, num_nodes), None for the fixed supports.
+        :return: (batch_size * num_nodes, input_size * num_matrices)
+        """
+        batch_size = x.get_shape()[0].value
+        input_size = x.get_shape()[2].value
+        if dy_supports is None:
+            supports = self._supports
+            x0 = tf.transpose(x, perm=[1, 2, 0])  # (num_nodes, input_size, batch_size)
+            x0 = tf.reshape(x0, shape=[self._num_nodes, input_size * batch_size])
+        else:
+            supports = dy_supports
+            x0 = x
+        x = tf.expand_dims(x0, axis=0)
+        num_matrices = 1
+        if self._max_diffusion_step > 0:
+            num_matrices += len(supports) * self._max_diffusion_step
+            for support in supports:
+                x1 = tf.matmul(support, x0)
+                x = self._concat(x, x1)
+
+                for k in range(2, self._max_diffusion_step + 1):
+                    x2 = 2 * tf.matmul(support, x1) - x0
+                    x = self._concat(x, x2)
+                    x1, x0 = x2, x1
+        if dy_supports is None:
+            x = tf.reshape(x, shape=[num_matrices, self._num_nodes, input_size, batch_size])
+            x = tf.transpose(x, perm=[3, 1, 2, 0])  # (batch_size, num_nodes, input_size, order)
+        else:
+            x = tf.reshape(x, shape=[num_matrices, batch_size, self._num_nodes, input_size])
+            x = tf.transpose(x, perm=[1, 2, 3, 0])  # (batch_size, num_nodes, input_size, order)
+        return tf.reshape(x, shape=[batch_size * self._num_nodes, input_size * num_matrices])
+
+    def _gconv_shared(self, inputs_diffused, state, dy_supports, output_size, bias_start=0.0):
+        """_gconv with the diffusion of the inputs computed once by the caller.
+
+        Features are ordered (input_size, order), so concatenating the diffused inputs and
+        the diffused state gives the same matrix (and weights) as diffusing [inputs, state].
+        :param inputs_diffused: (batch_size * num_nodes, input_dim * num_matrices), from _diffusion.
+        :return: (batch_size, num_nodes * output_size)
+        """
+        batch_size = state.get_shape()[0].value
+        state = tf.reshape(state, (batch_size, self._num_nodes, -1))
+        x = tf.concat([inputs_diffused, self._diffusion(state, dy_supports)], axis=-1)
+        dtype = x.dtype
+        weights = tf.get_variable(
+            'weights', [x.get_shape()[-1].value, output_size], dtype=dtype,
+            initializer=tf.contrib.layers.xavier_initializer())
+        x = tf.matmul(x, weights)  # (batch_size * self._num_nodes, output_size)
+        biases = tf.get_variable("biases", [output_size], dtype=dtype,
+                                 initializer=tf.constant_initializer(bias_start, dtype=dtype))
+        x = tf.nn.bias_add(x, biases)
+        return tf.reshape(x, [batch_size, self._num_nodes * output_size])
+
     @staticmethod
     def _concat(x, x_):
         x_ = tf.expand_dims(x_, 0)
@@ -0,0 +1,30 @@
+import tensorflow as tf
+
+
+def layerwise_rnn(cells, inputs, scope='rnn'):
+    """Run stacked cells layer by layer with the input-to-hidden transforms hoisted.
+
+    Equivalent to static_rnn over MultiRNNCell(cells): each layer first computes
+    cell.input_projection on all input_steps at once (one batched conv/diffusion),
+    then only cell.state_step runs sequentially.
+    Variables live under the scopes of static_rnn (rnn/multi_rnn_cell/cell_%d/...), so
+    checkpoints load with or without hoisting.
+    :param cells: list of cells providing input_projection and state_step.
+    :param inputs: [input_steps, batch_size, ...]
+    :return: outputs of the last layer, [input_steps, batch_size, ...]
+    """
+    input_steps, batch_size = inputs.get_shape().as_list()[:2]
+    with tf.variable_scope(scope, reuse=tf.AUTO_REUSE), tf.variable_scope('multi_rnn_cell', reuse=tf.AUTO_REUSE):
+        for i, cell in enumerate(cells):
+            with tf.variable_scope('cell_%d' % i, reuse=tf.AUTO_REUSE):
+                input_shape = inputs.get_shape().as_list()[2:]
+                inputs_proj = cell.input_projection(tf.reshape(inputs, [input_steps * batch_size] + input_shape))
+                proj_shape = inputs_proj.get_shape().as_list()[1:]
+                inputs_proj = tf.unstack(tf.reshape(inputs_proj, [input_steps, batch_size] + proj_shape), axis=0)
+                state = cell.zero_state(batch_size, tf.float32)
+                outputs = []
+                for t in range(input_steps):
+                    output, state = cell.state_step(inputs_proj[t], state)
+                    outputs.append(output)
+                inputs = tf.stack(outputs)
+    return inputs
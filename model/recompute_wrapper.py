@@ -0,0 +1,49 @@
+import tensorflow as tf
+
+from tensorflow.contrib.rnn import RNNCell
+
+
+class RecomputeWrapper(RNNCell):
+    """Gradient checkpointing for one layer of a stacked RNN.
+
+    Only the inputs, state and outputs of each step are kept for backprop; the
+    internals of the step (diffusion orders, gate convolutions) are recomputed
+    during the backward pass with tf.contrib.layers.recompute_grad.
+    The wrapped cell must take and return single tensors as state.
+    """
+
+    def call(self, inputs, **kwargs):
+        pass
+
+    def compute_output_shape(self, input_shape):
+        pass
+
+    def __init__(self, cell, reuse=None):
+        super(RecomputeWrapper, self).__init__(_reuse=reuse)
+        self._cell = cell
+
+    @property
+    def state_size(self):
+        return self._cell.state_size
+
+    @property
+    def output_size(self):
+        return self._cell.output_size
+
+    def __call__(self, inputs, state, scope=None):
+        def step(inputs, state):
+            return self._cell(inputs, state, scope=scope)
+        # custom gradients only track resource variables
+        with tf.variable_scope(tf.get_variable_scope(), use_resource=True):
+            output, new_state = tf.contrib.layers.recompute_grad(step)(inputs, state)
+        return output, new_state
+
+
+def wrap_recompute(cells, recompute):
+    """Wrap the lowest `recompute` layers with RecomputeWrapper.
+
+    :param cells: list of cells, lowest layer first.
+    :param recompute: number of layers to recompute, 0 for none; the more layers,
+        the less memory and the more compute in the backward pass.
+    """
+    return [RecomputeWrapper(cell) if i < recompute else cell for i, cell in enumerate(cells)]
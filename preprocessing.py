@@ -1,6 +1,42 @@
 import numpy as np
 
-class MinMaxNormalization01(object):
+
+def affine_transform(data, mul, add, inplace=False, chunk_size=1024):
+    """Compute data * mul + add chunk by chunk along the first axis.
+
+    Floating data keeps its dtype (other dtypes give float64). With inplace, floating
+    data is overwritten instead of copied, e.g. an np.load(..., mmap_mode='c') array.
+    """
+    data = np.asarray(data)
+    floating = np.issubdtype(data.dtype, np.floating)
+    if inplace and floating:
+        out = data
+    else:
+        out = np.empty(data.shape, dtype=data.dtype if floating else np.float64)
+    if out.ndim == 0:
+        out[...] = data * mul + add
+        return out
+    for i in range(0, len(out), chunk_size):
+        chunk = out[i:i + chunk_size]
+        np.multiply(data[i:i + chunk_size], mul, out=chunk, casting='unsafe')
+        np.add(chunk, add, out=chunk, casting='unsafe')
+    return out
+
+
+class ScalerStatistics(object):
+    """Save/load the fitted statistics of a scaler as .npz, e.g. to resume partial_fit."""
+    def save(self, filename):
+        np.savez(filename, **dict((k, np.asarray(v)) for k, v in vars(self).items()))
+
+    def load(self, filename):
+        with np.load(filename) as stats:
+            for k in stats.files:
+                v = stats[k]
+                setattr(self, k, v[()] if v.ndim == 0 else v)
+        return self
+
+
+class MinMaxNormalization01(ScalerStatistics):
     def __init__(self, ):
         pass
 
@@ -9,58 +45,126 @@ class MinMaxNormalization01(object):
         self._max = np.amax(data)
         print("min: ", self._min, "max:", self._max)
 
-    def transform(self, data):
-        norm_data = 1. * (data - self._min) / (self._max - self._min)
+    def partial_fit(self, data):
+        # merge min/max of one chunk of a stream
+        if hasattr(self, '_min'):
+            self._min = min(self._min, np.amin(data))
+            self._max = max(self._max, np.amax(data))
+        else:
+            self._min = np.amin(data)
+            self._max = np.amax(data)
+        return self
+
+    def transform(self, data, inplace=False, chunk_size=1024):
+        scale = 1. / (self._max - self._min)
+        norm_data = affine_transform(data, scale, -scale * self._min, inplace, chunk_size)
         return norm_data
 
     def fit_transform(self, data):
         self.fit(data)
         return self.transform(data)
 
-    def inverse_transform(self, data, mean_index=0, if_add_mean=False):
-        inverse_norm_data = 1. * data * (self._max - self._min) + self._min
+    def inverse_transform(self, data, mean_index=0, if_add_mean=False, inplace=False, chunk_size=1024):
+        inverse_norm_data = affine_transform(data, self._max - self._min, self._min, inplace, chunk_size)
         return inverse_norm_data
 
+    def tf_inverse_transform(self, data, mean_index=None, if_add_mean=False):
+        # inverse_transform as graph ops
+        import tensorflow as tf
+        return data * tf.constant(self._max - self._min, dtype=data.dtype) + tf.constant(self._min, dtype=data.dtype)
+
     def real_loss(self, loss):
         # loss is rmse
         return loss*(self._max - self._min)
         #return real_loss
 
-class MinMaxNormalization01_minus_mean(object):
+class MinMaxNormalization01_minus_mean(ScalerStatistics):
+    """Min-max scaling minus the mean of each position in the period.
+
+    By default the position of a row is its row count modulo period. fit, partial_fit and
+    transform also take period_index, the position of each row, e.g.
+    time_features.calendar_features(times, slot_minutes, period_slots=period)['period_index'],
+    so series with gaps or other slot lengths use the mean of the right position.
+    """
     def __init__(self, period=24*7):
         self.period = period
         pass
 
-    def fit(self, data):
+    def fit(self, data, period_index=None):
         self._min = np.amin(data)
         self._max = np.amax(data)
         print("min: ", self._min, "max:", self._max)
         #
-        d_shape = np.array(data).shape
-        #self._mean = np.zeros((self.period, d_shape[1], d_shape[2]))
-        self._mean = np.zeros([self.period] + list(d_shape[1:]))
-        index = np.arange(d_shape[0]//self.period)
-        for i in range(self.period):
-            self._mean[i] = np.mean(data[self.period*index+i], axis=0)
-        self._mean = 1. * (self._mean - self._min) / (self._max - self._min)
-
-    def transform(self, data, pre_index=0):
-        norm_data = 1. * (data - self._min) / (self._max - self._min)
-        mean_index = (np.arange(len(norm_data)) + pre_index)%self.period
-        norm_minus_mean_data = norm_data - self._mean[mean_index]
+        data = np.asarray(data)
+        self._period_sum = np.zeros([self.period] + list(data.shape[1:]))
+        self._period_count = np.zeros(self.period, dtype=np.int64)
+        self._num_seen = 0
+        self._add_periods(data, period_index)
+
+    def partial_fit(self, data, period_index=None):
+        # merge min/max and the per-period sums of one chunk, which follows the chunks seen so far
+        data = np.asarray(data)
+        if hasattr(self, '_period_sum'):
+            self._min = min(self._min, np.amin(data))
+            self._max = max(self._max, np.amax(data))
+        else:
+            self._min = np.amin(data)
+            self._max = np.amax(data)
+            self._period_sum = np.zeros([self.period] + list(data.shape[1:]))
+            self._period_count = np.zeros(self.period, dtype=np.int64)
+            self._num_seen = 0
+        self._add_periods(data, period_index)
+        return self
+
+    def _add_periods(self, data, period_index=None):
+        # raw sums/counts per period position and rows seen; _mean is the mean of each position
+        # over all rows, positions not seen yet stay 0 before scaling
+        if period_index is None:
+            mean_index = (np.arange(len(data)) + self._num_seen)%self.period
+        else:
+            mean_index = np.asarray(period_index)%self.period
+        np.add.at(self._period_sum, mean_index, data)
+        self._period_count += np.bincount(mean_index, minlength=self.period)
+        self._num_seen += len(data)
+        count = np.maximum(self._period_count, 1).reshape([self.period] + [1] * (data.ndim - 1))
+        self._mean = 1. * (self._period_sum / count - self._min) / (self._max - self._min)
+
+    def transform(self, data, pre_index=0, period_index=None, inplace=False, chunk_size=1024):
+        scale = 1. / (self._max - self._min)
+        norm_data = affine_transform(data, scale, -scale * self._min, inplace, chunk_size)
+        for i in range(0, len(norm_data), chunk_size):
+            chunk = norm_data[i:i + chunk_size]
+            if period_index is None:
+                mean_index = (np.arange(i, i + len(chunk)) + pre_index)%self.period
+            else:
+                mean_index = np.asarray(period_index[i:i + len(chunk)])%self.period
+            chunk -= self._mean[mean_index].astype(chunk.dtype)
+        norm_minus_mean_data = norm_data
         return norm_minus_mean_data
 
-    def fit_transform(self, data):
-        self.fit(data)
-        return self.transform(data)
+    def fit_transform(self, data, period_index=None):
+        self.fit(data, period_index)
+        return self.transform(data, period_index=period_index)
 
-    def inverse_transform(self, data, mean_index=0, if_add_mean=True):
+    def inverse_transform(self, data, mean_index=0, if_add_mean=True, inplace=False, chunk_size=1024):
         if if_add_mean:
             index = mean_index%self.period
-            inverse_norm_data = 1. * (data+self._mean[index]) * (self._max - self._min) + self._min
-        else:
-            inverse_norm_data = 1. * data * (self._max - self._min) + self._min
+            # the sum is a new array, so it can always be scaled in place
+            data = data + self._mean[index]
+            inplace = True
+        inverse_norm_data = affine_transform(data, self._max - self._min, self._min, inplace, chunk_size)
         return inverse_norm_data
+
+    def tf_inverse_transform(self, data, mean_index=None, if_add_mean=True):
+        # inverse_transform as graph ops, mean_index: int tensor [batch_size] or None for index 0
+        import tensorflow as tf
+        if if_add_mean:
+            mean = tf.constant(self._mean, dtype=data.dtype)
+            if mean_index is None:
+                data = data + mean[0]
+            else:
+                data = data + tf.gather(mean, tf.mod(mean_index, self.period))
+        return data * tf.constant(self._max - self._min, dtype=data.dtype) + tf.constant(self._min, dtype=data.dtype)
     
     def real_loss(self, loss):
         # loss is rmse
@@ -73,14 +177,15 @@ class MinMaxNormalization01_by_axis(object):
     def fit(self, data):
         self._min = np.amin(data, axis=0)
         self._max = np.amax(data, axis=0)
-    def transform(self, data):
-        norm_data = 1. * (data - self._min) / (self._max - self._min)
+    def transform(self, data, inplace=False, chunk_size=1024):
+        scale = 1. / (self._max - self._min)
+        norm_data = affine_transform(data, scale, -scale * self._min, inplace, chunk_size)
         return norm_data
     def fit_transform(self, data):
         self.fit(data)
         return self.transform(data)
-    def inverse_transform(self, data):
-        inverse_norm_data = 1. * data * (self._max - self._min) + self._min
+    def inverse_transform(self, data, inplace=False, chunk_size=1024):
+        inverse_norm_data = affine_transform(data, self._max - self._min, self._min, inplace, chunk_size)
         return inverse_norm_data
     #def real_loss(self, loss):
 
@@ -93,18 +198,18 @@ class MinMaxNormalization_neg_1_pos_1(object):
         self._max = X.max()
         print("min:", self._min, "max:", self._max)
 
-    def transform(self, X):
-        X = 1. * (X - self._min) / (self._max - self._min)
-        X = X * 2. - 1.
+    def transform(self, X, inplace=False, chunk_size=1024):
+        scale = 2. / (self._max - self._min)
+        X = affine_transform(X, scale, -scale * self._min - 1., inplace, chunk_size)
         return X
 
     def fit_transform(self, X):
         self.fit(X)
         return self.transform(X)
 
-    def inverse_transform(self, X):
-        X = (X + 1.)/2.
-        X = 1. * X * (self._max - self._min) + self._min
+    def inverse_transform(self, X, inplace=False, chunk_size=1024):
+        scale = (self._max - self._min)/2.
+        X = affine_transform(X, scale, scale + self._min, inplace, chunk_size)
         return X
 
     def real_loss(self, loss):
@@ -112,24 +217,50 @@ class MinMaxNormalization_neg_1_pos_1(object):
         return loss*(self._max - self._min)/2.
     #return real_loss
 
-class StandardScaler(object):
+class StandardScaler(ScalerStatistics):
     def __init__(self):
         pass
 
     def fit(self, data):
         self.mean = np.mean(data)
         self.std = np.std(data)
+        # count and sum of squared deviations, so partial_fit can continue
+        self._count = np.size(data)
+        self._m2 = self.std ** 2 * self._count
         print("mean: ", self.mean, " std:", self.std)
 
-    def transform(self, data):
-        return (data - self.mean) / self.std
+    def partial_fit(self, data):
+        # merge mean/variance of one chunk (Welford/Chan update)
+        count = np.size(data)
+        if count == 0:
+            return self
+        mean = np.mean(data, dtype=np.float64)
+        m2 = np.sum(np.square(np.asarray(data, dtype=np.float64) - mean))
+        if hasattr(self, '_count'):
+            total = self._count + count
+            delta = mean - self.mean
+            self.mean = self.mean + delta * count / total
+            self._m2 = self._m2 + m2 + delta ** 2 * self._count * count / total
+            self._count = total
+        else:
+            self.mean, self._m2, self._count = mean, m2, count
+        self.std = np.sqrt(self._m2 / self._count)
+        return self
+
+    def transform(self, data, inplace=False, chunk_size=1024):
+        return affine_transform(data, 1. / self.std, -self.mean / self.std, inplace, chunk_size)
 
     def fit_transform(self, data):
         self.fit(data)
         return self.transform(data)
 
-    def inverse_transform(self, data, mean_index=0, if_add_mean=False):
-        return (data * self.std) + self.mean
+    def inverse_transform(self, data, mean_index=0, if_add_mean=False, inplace=False, chunk_size=1024):
+        return affine_transform(data, self.std, self.mean, inplace, chunk_size)
+
+    def tf_inverse_transform(self, data, mean_index=None, if_add_mean=False):
+        # inverse_transform as graph ops
+        import tensorflow as tf
+        return data * tf.constant(self.std, dtype=data.dtype) + tf.constant(self.mean, dtype=data.dtype)
 
     def real_loss(self, loss):
         return loss*self.std
\ No newline at end of file
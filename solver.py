@@ -11,6 +11,7 @@ import sys
 
 sys.path.append('./util/')
 from utils import *
+from metrics import MetricAccumulator, METRIC_NAMES
 
 
 class ModelSolver(object):
@@ -33,6 +34,10 @@ class ModelSolver(object):
         self.pretrained_model = kwargs.pop('pretrained_model', None)
         self.test_model = kwargs.pop('test_model', './model/lstm/model-1')
         self.partial_pretrain = kwargs.pop('partial_pretrain', 0)
+        # trace the first training batch and report the peak memory in use
+        self.report_memory = kwargs.pop('report_memory', False)
+        # number of micro-batches whose gradients are accumulated before one update
+        self.accum_steps = kwargs.pop('accum_steps', 1)
 
         if self.update_rule == 'adam':
             self.optimizer = tf.train.AdamOptimizer
@@ -59,6 +64,8 @@ class ModelSolver(object):
         tf.get_variable_scope().reuse_variables()
         with tf.Session(config=tf.ConfigProto(gpu_options=gpu_options)) as sess:
             tf.global_variables_initializer().run()
+            # shared static supports are fed once instead of embedded as graph constants
+            sess.run(tf.local_variables_initializer(), feed_dict=getattr(self.model, 'init_feed_dict', None))
             saver = tf.train.Saver(tf.global_variables())
             if self.pretrained_model is not None:
                 print('Start training with pretrained model...')
@@ -126,6 +133,7 @@ class ModelSolver(object):
         # build graphs
         y_, loss = self.model.build_easy_model()
         y_test, loss_test = y_, loss
+        eval_ops = self.build_eval_metrics(y_test) + (loss_test,)
         '''
         with tf.name_scope('train'):
             with tf.variable_scope('model', reuse=tf.AUTO_REUSE):
@@ -145,8 +153,27 @@ class ModelSolver(object):
             # grads_and_vars = list(zip(grads, tf.trainable_variables()))
             # train_op = optimizer.apply_gradients(grads_and_vars=grads_and_vars)
             gvs = optimizer.compute_gradients(loss)
-            capped_gvs = [(tf.clip_by_value(grad, -1., 1.), var) for grad, var in gvs if grad is not None]
-            train_op = optimizer.apply_gradients(capped_gvs)
+            if self.accum_steps > 1:
+                # accumulate the gradients of micro-batches in local variables (not saved),
+                # average them so one update has the scale of one batch, then clip.
+                gvs = [(grad, var) for grad, var in gvs if grad is not None]
+                accum_grads = [tf.Variable(tf.zeros(var.get_shape().as_list(), dtype=var.dtype.base_dtype),
+                                           trainable=False, collections=[tf.GraphKeys.LOCAL_VARIABLES])
+                               for _, var in gvs]
+                accum_count = tf.Variable(0., trainable=False, collections=[tf.GraphKeys.LOCAL_VARIABLES])
+                accum_op = tf.group(*([accum_grad.assign_add(grad) for accum_grad, (grad, _) in zip(accum_grads, gvs)] +
+                                      [accum_count.assign_add(1.)]))
+                capped_gvs = [(tf.clip_by_value(accum_grad / tf.maximum(accum_count, 1.), -1., 1.), var)
+                              for accum_grad, (_, var) in zip(accum_grads, gvs)]
+                train_op = optimizer.apply_gradients(capped_gvs)
+                with tf.control_dependencies([train_op]):
+                    apply_op = tf.group(*([accum_grad.assign(tf.zeros_like(accum_grad)) for accum_grad in accum_grads] +
+                                          [accum_count.assign(0.)]))
+                step_op = accum_op
+            else:
+                capped_gvs = [(tf.clip_by_value(grad, -1., 1.), var) for grad, var in gvs if grad is not None]
+                train_op = optimizer.apply_gradients(capped_gvs)
+                step_op = train_op
 
         gpu_options = tf.GPUOptions(allow_growth=True)
         tf.get_variable_scope().reuse_variables()
@@ -159,6 +186,8 @@ class ModelSolver(object):
         # summary_op = tf.summary.merge_all()
         with tf.Session(config=tf.ConfigProto(gpu_options=gpu_options)) as sess:
             tf.global_variables_initializer().run()
+            # shared static supports are fed once instead of embedded as graph constants
+            sess.run(tf.local_variables_initializer(), feed_dict=getattr(self.model, 'init_feed_dict', None))
             #summary_writer = tf.summary.FileWriter(self.log_path, graph=sess.graph)
             saver = tf.train.Saver(tf.global_variables())
             #
@@ -186,6 +215,7 @@ class ModelSolver(object):
                 train_loader.reset_data()
                 widgets = ['Train: ', Percentage(), ' ', Bar('-'), ' ', ETA()]
                 pbar = ProgressBar(widgets=widgets, maxval=num_train_batches).start()
+                t_start = time.time()
                 for i in range(num_train_batches):
                     pbar.update(i)
                     #print i
@@ -201,7 +231,18 @@ class ModelSolver(object):
                                  self.model.f: np.array(f),
                                  self.model.y: np.array(y)
                                  }
-                    _, l, y_out = sess.run([train_op, loss, y_], feed_dict)
+                    if self.report_memory and e == 0 and i == 0:
+                        run_metadata = tf.RunMetadata()
+                        _, l, y_out = sess.run([step_op, loss, y_], feed_dict,
+                                               options=tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE),
+                                               run_metadata=run_metadata)
+                        w_text_0 = self.peak_memory_text(run_metadata)
+                        print(w_text_0)
+                        o_file.write(w_text_0)
+                    else:
+                        _, l, y_out = sess.run([step_op, loss, y_], feed_dict)
+                    if self.accum_steps > 1 and ((i + 1) % self.accum_steps == 0 or i == num_train_batches - 1):
+                        sess.run(apply_op)
                     '''
                     y_out = np.round(self.preprocessing.inverse_transform(y_out[:, -1,...], index[:, -1]))
                     y = np.round(self.preprocessing.inverse_transform(y[:, -1,...], index[:, -1]))
@@ -213,10 +254,13 @@ class ModelSolver(object):
                     #print 'train batch time: %s' % (t3-t2)
                     train_l2_loss += l
                 pbar.finish()
+                # throughput, to compare feed_dtype/recompute/accum_steps settings
+                t_train = time.time() - t_start
                 # compute counts of all regions
                 t_count = num_train_batches*self.batch_size*train_loader.input_steps*np.prod(train_loader.d_data_shape)
                 train_loss = np.sqrt(train_l2_loss / t_count)
-                w_text_1 = 'at epoch %d, train l2 loss is %.6f \n' % (e, train_loss)
+                w_text_1 = 'at epoch %d, train l2 loss is %.6f, %.1f samples/s \n' % (
+                    e, train_loss, num_train_batches*self.batch_size/t_train)
                 o_file.write(w_text_1)
                 # save model
                 if (e + 1) % self.save_every == 0:
@@ -225,96 +269,24 @@ class ModelSolver(object):
                 # ============================ validate ===============================
                 if e % 1 == 0:
                     if val_loader is not None:
-                        #print('test for validate data...')
-                        val_l2_loss = 0
-                        #print('number of val_data batches: %d' % num_val_batches)
-                        widgets = ['Validate: ', Percentage(), ' ', Bar('*'), ' ', ETA()]
-                        pbar = ProgressBar(widgets=widgets, maxval=num_val_batches).start()
-                        val_prediction = []
-                        val_target = []
-                        for i in range(num_val_batches):
-                            pbar.update(i)
-                            x, f, y, _, padding_len = val_loader.next_batch_for_test(i * self.batch_size,(i + 1) * self.batch_size)
-                            feed_dict = {self.model.x: np.array(x),
-                                         self.model.f: np.array(f),
-                                         self.model.y: np.array(y)
-                                         }
-                            y_out, l = sess.run([y_test, loss_test], feed_dict)
-                            #
-                            y_out = self.preprocessing.inverse_transform(y_out[:, -1, ...])
-                            y = self.preprocessing.inverse_transform(y[:, -1, ...])
-                            y = np.clip(y, 0, None)
-                            y_out = np.clip(y_out, 0, None)
-                            #
-                            if padding_len > 0:
-                                y_out = y_out[:-padding_len]
-                                y = y[:-padding_len]
-                            #
-                            val_prediction.append(y_out)
-                            val_target.append(y)
-                            val_l2_loss += l
-                        pbar.finish()
-                        val_target = np.concatenate(np.array(val_target), axis=0)
-                        val_prediction = np.concatenate(np.array(val_prediction), axis=0)
-                        #print(val_target.shape)
+                        val_l2_loss, val_metrics, _, _ = self.evaluate(
+                            sess, val_loader, num_val_batches, eval_ops, name='Validate: ')
                         # compute counts of all regions
                         t_count = num_val_batches*self.batch_size*(val_loader.input_steps * np.prod(val_loader.d_data_shape))
                         val_loss = np.sqrt(val_l2_loss / t_count)
-                        val_rmse = np.sqrt(np.mean(np.square(val_target-val_prediction)))
-                        val_rmlse = np.sqrt(np.mean(np.square(np.log(val_target+1)-np.log(val_prediction+1))))
-                        val_mae = np.mean(np.abs(val_target-val_prediction))
-                        w_text_2 = 'at epoch %d, val loss is %.6f, validate prediction rmse/rmlse/mae is %.6f/%.6f/%.6f \n' % (e, val_loss, val_rmse, val_rmlse, val_mae)
+                        w_text_2 = 'at epoch %d, val loss is %.6f, validate prediction %s \n' % (e, val_loss, self.metric_text(val_metrics))
                         o_file.write(w_text_2)
                     else:
                         w_text_2 = ''
                     # ================================ test =====================================
                     # print('test for test data...')
-                    test_l2_loss = 0
-                    # if val_loader is not None:
-                    #     test_pre_index = train_loader.num_data + val_loader.num_data
-                    # else:
-                    #     test_pre_index = train_loader.num_data
-                    #
-                    # test_metric_loss = np.zeros(6)
-                    #print('number of test_data batches: %d' % num_test_batches)
-                    widgets = ['Test: ', Percentage(), ' ', Bar('*'), ' ', ETA()]
-                    pbar = ProgressBar(widgets=widgets, maxval=num_test_batches).start()
-                    test_prediction = []
-                    test_target = []
-                    for i in range(num_test_batches):
-                        pbar.update(i)
-                        x, f, y, _, padding_len = test_loader.next_batch_for_test(i * self.batch_size, (i + 1) * self.batch_size)
-                        feed_dict = {self.model.x: np.array(x),
-                                     self.model.f: np.array(f),
-                                     self.model.y: np.array(y)
-                                     }
-                        y_out, l = sess.run([y_test, loss_test], feed_dict)
-                        #
-                        y_out = self.preprocessing.inverse_transform(y_out[:,-1,...])
-                        y = self.preprocessing.inverse_transform(y[:,-1,...])
-                        y = np.clip(y, 0, None)
-                        y_out = np.clip(y_out, 0, None)
-                        #
-                        if padding_len > 0:
-                            y_out = y_out[:-padding_len]
-                            y = y[:-padding_len]
-                        #
-                        test_prediction.append(y_out)
-                        test_target.append(y)
-                        test_l2_loss += l
-                        #metric_loss = get_loss_by_batch(y, y_out)
-                        #test_metric_loss += metric_loss
-                    pbar.finish()
-                    test_target = np.concatenate(np.array(test_target), axis=0)
-                    test_prediction = np.concatenate(np.array(test_prediction), axis=0)
-                    #print(test_target.shape)
+                    # predictions are only pulled to the host for the returned last epoch
+                    test_l2_loss, test_metrics, test_target, test_prediction = self.evaluate(
+                        sess, test_loader, num_test_batches, eval_ops, keep_prediction=(e == self.n_epochs - 1))
                     # compute counts of all regions
                     t_count = num_test_batches * self.batch_size * (test_loader.input_steps * np.prod(test_loader.d_data_shape))
                     test_loss = np.sqrt(test_l2_loss / t_count)
-                    test_rmse = np.sqrt(np.mean(np.square(test_target - test_prediction)))
-                    test_rmlse = np.sqrt(np.mean(np.square(np.log(test_target+1) - np.log(test_prediction+1))))
-                    test_mae = np.mean(np.abs(test_target - test_prediction))
-                    w_text_3 = 'at epoch %d, test loss is %.6f, test prediction rmse/rmlse/mae is %.6f/%.6f/%.6f \n' % (e, test_loss, test_rmse, test_rmlse, test_mae)
+                    w_text_3 = 'at epoch %d, test loss is %.6f, test prediction %s \n' % (e, test_loss, self.metric_text(test_metrics))
                     o_file.write(w_text_3)
                     print(w_text_1)
                     print(w_text_2)
@@ -331,10 +303,95 @@ class ModelSolver(object):
             return np.array(test_target), np.array(test_prediction)
 
 
+    def build_eval_metrics(self, y_test):
+        """Denormalize, clip and reduce the last-step prediction in the graph.
+
+        :param y_test: normalized prediction, [batch_size, input_steps, ...]
+        :return: (y_true, y_pred, metric_sums), metric_sums holds the sums of one batch
+            for each location in the layout of metrics.metric_sums, [6, ...].
+        """
+        # rows padded to the last batch are masked out
+        self.num_valid = tf.placeholder(tf.int32, [])
+        y_true = self.preprocessing.tf_inverse_transform(tf.cast(self.model.y[:, -1, ...], tf.float32))
+        y_pred = self.preprocessing.tf_inverse_transform(y_test[:, -1, ...])
+        y_true = tf.maximum(y_true, 0.)
+        y_pred = tf.maximum(y_pred, 0.)
+        mask = tf.cast(tf.sequence_mask(self.num_valid, self.batch_size), tf.float32)
+        mask = tf.reshape(mask, [self.batch_size] + [1] * (y_pred.get_shape().ndims - 1))
+        abs_err = tf.abs(y_pred - y_true)
+        log_err = tf.log1p(y_pred) - tf.log1p(y_true)
+        terms = tf.stack([tf.square(abs_err), tf.square(log_err), abs_err, abs_err / (y_true + 1.),
+                          y_true, tf.ones_like(y_true)])
+        metric_sums = tf.reduce_sum(terms * mask, axis=1)
+        return y_true, y_pred, metric_sums
+
+    def evaluate(self, sess, loader, num_batches, eval_ops, keep_prediction=False, name='Test: '):
+        """Run the eval graph over all batches of a loader.
+
+        Only the loss and the metric sums are fetched per batch, the full target and
+        prediction are fetched when keep_prediction.
+        :return: l2 loss sum, MetricAccumulator with per-location sums, target,
+            prediction (None if not kept)
+        """
+        y_true, y_pred, metric_sums, loss_test = eval_ops
+        l2_loss = 0
+        metrics = MetricAccumulator()
+        target = []
+        prediction = []
+        widgets = [name, Percentage(), ' ', Bar('*'), ' ', ETA()]
+        pbar = ProgressBar(widgets=widgets, maxval=num_batches).start()
+        for i in range(num_batches):
+            pbar.update(i)
+            x, f, y, _, padding_len = loader.next_batch_for_test(i * self.batch_size, (i + 1) * self.batch_size)
+            num_valid = self.batch_size - padding_len
+            feed_dict = {self.model.x: np.array(x),
+                         self.model.f: np.array(f),
+                         self.model.y: np.array(y),
+                         self.num_valid: num_valid
+                         }
+            if keep_prediction:
+                l, batch_sums, y, y_out = sess.run([loss_test, metric_sums, y_true, y_pred], feed_dict)
+                target.append(y[:num_valid])
+                prediction.append(y_out[:num_valid])
+            else:
+                l, batch_sums = sess.run([loss_test, metric_sums], feed_dict)
+            l2_loss += l
+            metrics.update_sums(batch_sums)
+        pbar.finish()
+        if keep_prediction:
+            target = np.concatenate(target, axis=0)
+            prediction = np.concatenate(prediction, axis=0)
+        else:
+            target, prediction = None, None
+        return l2_loss, metrics, target, prediction
+
+    @staticmethod
+    def metric_text(metrics, reduce_axes=None):
+        # overall metrics by default, the kept axes give e.g. a per-channel breakdown
+        if reduce_axes is None:
+            reduce_axes = range(metrics.sums.ndim - 1)
+        m = metrics.result(reduce_axes)
+        return 'rmse/rmlse/mae/mape/er is ' + '/'.join(
+            np.array2string(np.asarray(m[name]), precision=6, separator=',') for name in METRIC_NAMES)
+
+    def peak_memory_text(self, run_metadata):
+        # largest bytes in use of each allocator during a traced sess.run
+        peak_bytes = {}
+        for dev_stats in run_metadata.step_stats.dev_stats:
+            for node_stats in dev_stats.node_stats:
+                for mem in node_stats.memory:
+                    peak_bytes[mem.allocator_name] = max(peak_bytes.get(mem.allocator_name, 0),
+                                                         mem.allocator_bytes_in_use, mem.peak_bytes)
+        w_text = ''
+        for name in sorted(peak_bytes):
+            w_text += 'peak memory of %s in one training batch is %.2f MB \n' % (name, peak_bytes[name] / 1024. / 1024.)
+        return w_text
+
     def test(self):
         test_loader = self.test_data
         # build graphs
         y_test, loss_test = self.model.build_easy_model()
+        eval_ops = self.build_eval_metrics(y_test) + (loss_test,)
 #         with tf.name_scope('Test'):
 #             with tf.variable_scope('DCRNN', reuse=tf.AUTO_REUSE):
 #                 y_test, loss_test = self.model.build_easy_model(is_training=False)
@@ -342,61 +399,23 @@ class ModelSolver(object):
         tf.get_variable_scope().reuse_variables()
         with tf.Session(config=tf.ConfigProto(gpu_options=gpu_options)) as sess:
             tf.global_variables_initializer().run()
+            # shared static supports are fed once instead of embedded as graph constants
+            sess.run(tf.local_variables_initializer(), feed_dict=getattr(self.model, 'init_feed_dict', None))
             saver = tf.train.Saver(tf.global_variables())
             if self.pretrained_model is not None:
                 print("Start training with pretrained model...")
                 saver.restore(sess, os.path.join(self.model_path, self.pretrained_model))
                 #
                 num_test_batches = test_loader._num_batches(self.batch_size, use_all_data=True)
-                test_l2_loss = 0
-                # if val_loader is not None:
-                #     test_pre_index = train_loader.num_data + val_loader.num_data
-                # else:
-                #     test_pre_index = train_loader.num_data
-                #
-                # test_metric_loss = np.zeros(6)
-                # print('number of test_data batches: %d' % num_test_batches)
-                widgets = ['Test: ', Percentage(), ' ', Bar('*'), ' ', ETA()]
-                pbar = ProgressBar(widgets=widgets, maxval=num_test_batches).start()
-                test_prediction = []
-                test_target = []
-                for i in range(num_test_batches):
-                    pbar.update(i)
-                    x, f, y, _, padding_len = test_loader.next_batch_for_test(i * self.batch_size,
-                                                                              (i + 1) * self.batch_size)
-                    feed_dict = {self.model.x: np.array(x),
-                                 self.model.f: np.array(f),
-                                 self.model.y: np.array(y)
-                                 }
-                    y_out, l = sess.run([y_test, loss_test], feed_dict)
-                    #
-                    y_out = self.preprocessing.inverse_transform(y_out[:, -1, ...])
-                    y = self.preprocessing.inverse_transform(y[:, -1, ...])
-                    y = np.clip(y, 0, None)
-                    y_out = np.clip(y_out, 0, None)
-                    #
-                    if padding_len > 0:
-                        y_out = y_out[:-padding_len]
-                        y = y[:-padding_len]
-                    #
-                    test_prediction.append(y_out)
-                    test_target.append(y)
-                    test_l2_loss += l
-                    # metric_loss = get_loss_by_batch(y, y_out)
-                    # test_metric_loss += metric_loss
-                pbar.finish()
-                test_target = np.concatenate(np.array(test_target), axis=0)
-                test_prediction = np.concatenate(np.array(test_prediction), axis=0)
-                # print(test_target.shape)
+                test_l2_loss, test_metrics, test_target, test_prediction = self.evaluate(
+                    sess, test_loader, num_test_batches, eval_ops, keep_prediction=True)
                 # compute counts of all regions
                 t_count = num_test_batches * self.batch_size * (test_loader.input_steps * np.prod(test_loader.d_data_shape))
                 test_loss = np.sqrt(test_l2_loss / t_count)
-                test_rmse = np.sqrt(np.mean(np.square(test_target - test_prediction)))
-                test_rmlse = np.sqrt(np.mean(np.square(np.log(test_target + 1) - np.log(test_prediction + 1))))
-                #test_mape = np.mean(np.abs((test_prediction - test_target)/(test_target + 1)))
-                test_mae = np.mean(np.abs(test_target-test_prediction))
-                w_text_3 = 'test loss is %.6f, test prediction rmse/rmlse/mae is %.6f/%.6f/%.6f \n' % (
-                test_loss, test_rmse, test_rmlse, test_mae)
+                w_text_3 = 'test loss is %.6f, test prediction %s \n' % (test_loss, self.metric_text(test_metrics))
+                # in/out (last axis) breakdown
+                w_text_3 += 'test in/out prediction %s \n' % self.metric_text(
+                    test_metrics, reduce_axes=range(test_metrics.sums.ndim - 2))
                 print(w_text_3)
                 return np.array(test_target), np.array(test_prediction)
 
@@ -11,6 +11,7 @@ import sys
 
 sys.path.append('./util/')
 from utils import *
+from metrics import get_metrics, METRIC_NAMES
 
 
 class ModelSolver(object):
@@ -59,6 +60,8 @@ class ModelSolver(object):
         tf.get_variable_scope().reuse_variables()
         with tf.Session(config=tf.ConfigProto(gpu_options=gpu_options)) as sess:
             tf.global_variables_initializer().run()
+            # shared static supports are fed once instead of embedded as graph constants
+            sess.run(tf.local_variables_initializer(), feed_dict=getattr(self.model, 'init_feed_dict', None))
             saver = tf.train.Saver(tf.global_variables())
             if self.pretrained_model is not None:
                 print('Start training with pretrained model...')
@@ -149,6 +152,8 @@ class ModelSolver(object):
         tf.get_variable_scope().reuse_variables()
         with tf.Session(config=tf.ConfigProto(gpu_options=gpu_options)) as sess:
             tf.global_variables_initializer().run()
+            # shared static supports are fed once instead of embedded as graph constants
+            sess.run(tf.local_variables_initializer(), feed_dict=getattr(self.model, 'init_feed_dict', None))
             saver = tf.train.Saver(tf.global_variables())
             #
             if self.pretrained_model is not None:
@@ -233,10 +238,9 @@ class ModelSolver(object):
                         # compute counts of all regions
                         t_count = num_val_batches*self.batch_size*(val_loader.input_steps * np.prod(val_loader.d_data_shape))
                         val_loss = np.sqrt(val_l2_loss / t_count)
-                        val_rmse = np.sqrt(np.mean(np.square(val_target-val_prediction)))
-                        val_rmlse = np.sqrt(np.mean(np.square(np.log(val_target+1)-np.log(val_prediction+1))))
-                        val_mae = np.mean(np.abs(val_target-val_prediction))
-                        w_text_2 = 'at epoch %d, val loss is %.6f, validate prediction rmse/rmlse/mae is %.6f/%.6f/%.6f \n' % (e, val_loss, val_rmse, val_rmlse, val_mae)
+                        val_m = get_metrics(val_target, val_prediction)
+                        w_text_2 = 'at epoch %d, val loss is %.6f, validate prediction rmse/rmlse/mae/mape/er is %.6f/%.6f/%.6f/%.6f/%.6f \n' % (
+                            (e, val_loss) + tuple(val_m[name] for name in METRIC_NAMES))
                         o_file.write(w_text_2)
                     else:
                         w_text_2 = ''
@@ -278,10 +282,9 @@ class ModelSolver(object):
                     # compute counts of all regions
                     t_count = num_test_batches * self.batch_size * (test_loader.input_steps * np.prod(test_loader.d_data_shape))
                     test_loss = np.sqrt(test_l2_loss / t_count)
-                    test_rmse = np.sqrt(np.mean(np.square(test_target - test_prediction)))
-                    test_rmlse = np.sqrt(np.mean(np.square(np.log(test_target+1) - np.log(test_prediction+1))))
-                    test_mae = np.mean(np.abs(test_target - test_prediction))
-                    w_text_3 = 'at epoch %d, test loss is %.6f, test prediction rmse/rmlse/mae is %.6f/%.6f/%.6f \n' % (e, test_loss, test_rmse, test_rmlse, test_mae)
+                    test_m = get_metrics(test_target, test_prediction)
+                    w_text_3 = 'at epoch %d, test loss is %.6f, test prediction rmse/rmlse/mae/mape/er is %.6f/%.6f/%.6f/%.6f/%.6f \n' % (
+                        (e, test_loss) + tuple(test_m[name] for name in METRIC_NAMES))
                     o_file.write(w_text_3)
                     print(w_text_1)
                     print(w_text_2)
@@ -301,6 +304,8 @@ class ModelSolver(object):
         tf.get_variable_scope().reuse_variables()
         with tf.Session(config=tf.ConfigProto(gpu_options=gpu_options)) as sess:
             tf.global_variables_initializer().run()
+            # shared static supports are fed once instead of embedded as graph constants
+            sess.run(tf.local_variables_initializer(), feed_dict=getattr(self.model, 'init_feed_dict', None))
             saver = tf.train.Saver(tf.global_variables())
             if self.pretrained_model is not None:
                 print("Start training with pretrained model...")
@@ -353,12 +358,12 @@ class ModelSolver(object):
                 # compute counts of all regions
                 t_count = num_test_batches * self.batch_size * (test_loader.input_steps * np.prod(test_loader.d_data_shape))
                 test_loss = np.sqrt(test_l2_loss / t_count)
-                test_rmse = np.sqrt(np.mean(np.square(test_target - test_prediction)))
-                test_rmlse = np.sqrt(np.mean(np.square(np.log(test_target + 1) - np.log(test_prediction + 1))))
-                #test_mape = np.mean(np.abs((test_prediction - test_target)/(test_target + 1)))
-                test_mae = np.mean(np.abs(test_target-test_prediction))
-                w_text_3 = 'test loss is %.6f, test prediction rmse/rmlse/mae is %.6f/%.6f/%.6f \n' % (
-                test_loss, test_rmse, test_rmlse, test_mae)
+                test_m = get_metrics(test_target, test_prediction)
+                w_text_3 = 'test loss is %.6f, test prediction rmse/rmlse/mae/mape/er is %.6f/%.6f/%.6f/%.6f/%.6f \n' % (
+                    (test_loss,) + tuple(test_m[name] for name in METRIC_NAMES))
+                # in/out (last axis) breakdown
+                test_m = get_metrics(test_target, test_prediction, keep_axes=(-1,))
+                w_text_3 += 'test in/out rmse is %s \n' % test_m['rmse']
                 print(w_text_3)
                 return np.array(test_target), np.array(test_prediction)
 
@@ -0,0 +1,69 @@
+import functools
+import numpy as np
+
+
+@functools.lru_cache(maxsize=32)
+def gen_slot_times(start, end, slot_minutes=60):
+    '''
+    Start time of every slot in [start, end), cached and read-only.
+    :param start: first slot, e.g. '2014-01-01' or '2016-11-01T00:00'.
+    :param end: end of the last slot (excluded).
+    :return: np.ndarray, [num_slots], datetime64[m].
+    '''
+    times = np.arange(np.datetime64(start, 'm'), np.datetime64(end, 'm'), np.timedelta64(slot_minutes, 'm'))
+    times.setflags(write=False)
+    return times
+
+def calendar_features(times, slot_minutes=60, period_slots=24*7, holidays=()):
+    '''
+    Calendar features of slot start times.
+    :param times: np.ndarray of datetime64, e.g. from gen_slot_times.
+    :param period_slots: number of slots in a period starting on Monday 00:00, 24*7 for
+        a week of hourly slots.
+    :param holidays: holiday dates, e.g. ['2015-01-01', '2015-12-25'].
+    :return: dict of np.ndarray [num_slots]: slot_index (from times[0]), day_of_week
+        (Monday 0), weekend, holiday, minute_of_day, period_index.
+    '''
+    minutes = np.asarray(times, dtype='datetime64[m]').astype(np.int64)
+    days = minutes // (24*60)
+    # 1970-01-01 is a Thursday, 1970-01-05 a Monday
+    monday_minutes = minutes - 4*24*60
+    return {'slot_index': (minutes - minutes[0]) // slot_minutes,
+            'day_of_week': (days + 3) % 7,
+            'weekend': ((days + 3) % 7 >= 5).astype(np.int32),
+            'holiday': np.isin(days, np.array(holidays, dtype='datetime64[D]').astype(np.int64)).astype(np.int32),
+            'minute_of_day': minutes % (24*60),
+            'period_index': (monday_minutes // slot_minutes) % period_slots}
+
+def external_features(times, holidays=None):
+    '''
+    One-hot day of week and a weekday flag (1 on weekdays), plus a holiday flag if holidays is given.
+    :return: np.ndarray, [num_slots, 8 or 9].
+    '''
+    features = calendar_features(times, holidays=holidays if holidays is not None else ())
+    ext = [np.eye(7, dtype=np.int64)[features['day_of_week']], 1 - features['weekend'][:, None]]
+    if holidays is not None:
+        ext.append(features['holiday'][:, None])
+    return np.concatenate(ext, axis=1)
+
+def timestamp_strings(times, unit):
+    '''
+    'YYYYMMDD', 'YYYYMMDDHH' or 'YYYYMMDDHHMM' strings of datetime64 times.
+    :param unit: 'D', 'h' or 'm'.
+    '''
+    strings = np.datetime_as_string(times, unit=unit)
+    for c in '-T:':
+        strings = np.char.replace(strings, c, '')
+    return strings
+
+def parse_timestamps(timestamps):
+    '''
+    The inverse of timestamp_strings, for 'YYYYMMDD', 'YYYYMMDDHH' or 'YYYYMMDDHHMM' strings.
+    :return: np.ndarray, [num_slots], datetime64[m].
+    '''
+    # YYYYMMDDHHMM as one integer, missing hours/minutes are 0
+    full = np.char.ljust(np.asarray(timestamps).astype('U12'), 12, '0').astype(np.int64)
+    ymd, hour, minute = full // 10000, full // 100 % 100, full % 100
+    days = (np.array(ymd // 10000 - 1970, dtype='datetime64[Y]') + np.array(ymd // 100 % 100 - 1, dtype='timedelta64[M]')
+            ).astype('datetime64[D]') + np.array(ymd % 100 - 1, dtype='timedelta64[D]')
+    return days.astype('datetime64[m]') + np.array(hour * 60 + minute, dtype='timedelta64[m]')
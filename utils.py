@@ -1,10 +1,15 @@
+import os
 import pickle
+import hashlib
 import numpy as np
 import scipy.io as sio
 import scipy.sparse as sp
 from scipy.sparse import linalg
 from sklearn import preprocessing
 from scipy.sparse.linalg import eigs
+from metrics import get_metrics
+from time_features import gen_slot_times, calendar_features, external_features, timestamp_strings
+from embedding_table import load_embedding_table
 
 class StrToBytes:
     def __init__(self, fileobj):
@@ -53,13 +58,15 @@ def load_pickle(file):
 
 
 
-def load_npy_data(filename, split):
+def load_npy_data(filename, split, mmap_mode=None):
+    # mmap_mode='c' maps a single file copy-on-write, so it can be normalized in place
+    # without reading it into memory twice
     if len(filename) == 2:
         d1 = np.load(filename[0])
         d2 = np.load(filename[1])
         data = np.concatenate((np.expand_dims(d1, axis=-1), np.expand_dims(d2, axis=-1)), axis=-1)
     elif len(filename) == 1:
-        data = np.load(filename[0])
+        data = np.load(filename[0], mmap_mode=mmap_mode)
     train = data[0:split[0]]
     if len(split) > 2:
         validate = data[split[0]:(split[0] + split[1])]
@@ -96,6 +103,89 @@ def load_pkl_data(filename, split):
         test = data[split[0]:(split[0]+split[1])]
     return data, train, validate, test
 
+class FlowLists(object):
+    '''
+    Per-slot sparse flows stored column-wise in a folder: rows.npy, cols.npy and values.npy
+    hold the entries of all slots one after another, offsets.npy [T+1] where each slot starts.
+    The files are memory-mapped and read lazily; f[t] gives (rows, cols, values) of slot t
+    (flow_format='coo' in the data loaders), f[a:b] a view of a slot range.
+    '''
+    def __init__(self, folder, start=0, end=None, mmap_mode='r'):
+        self.folder = folder
+        self.offsets = np.load(os.path.join(folder, 'offsets.npy'), mmap_mode=mmap_mode)
+        self.rows = np.load(os.path.join(folder, 'rows.npy'), mmap_mode=mmap_mode)
+        self.cols = np.load(os.path.join(folder, 'cols.npy'), mmap_mode=mmap_mode)
+        self.values = np.load(os.path.join(folder, 'values.npy'), mmap_mode=mmap_mode)
+        self.start = start
+        self.end = len(self.offsets) - 1 if end is None else end
+
+    def __len__(self):
+        return self.end - self.start
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, end, step = index.indices(len(self))
+            assert step == 1, 'only contiguous slot ranges are supported'
+            view = object.__new__(FlowLists)
+            view.__dict__.update(self.__dict__)
+            view.start, view.end = self.start + start, self.start + max(start, end)
+            return view
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('slot %d out of range' % index)
+        a, b = self.offsets[self.start + index], self.offsets[self.start + index + 1]
+        return np.array(self.rows[a:b]), np.array(self.cols[a:b]), np.array(self.values[a:b])
+
+def save_flow_lists(folder, flow_lists):
+    '''
+    Write per-slot (rows, cols, values) into the FlowLists format, slot by slot into
+    memmaps so that no concatenated copy is built in memory.
+    :param flow_lists: sequence of (rows, cols, values) per slot.
+    '''
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+    offsets = np.zeros(len(flow_lists) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(f[2]) for f in flow_lists])
+    np.save(os.path.join(folder, 'offsets.npy'), offsets)
+    columns = [np.lib.format.open_memmap(os.path.join(folder, name + '.npy'), mode='w+', dtype=dtype,
+                                         shape=(int(offsets[-1]),))
+               for name, dtype in (('rows', np.int32), ('cols', np.int32), ('values', np.float32))]
+    for t, f in enumerate(flow_lists):
+        for column, part in zip(columns, f):
+            column[offsets[t]:offsets[t + 1]] = part
+    for column in columns:
+        column.flush()
+
+def convert_flow_pickle(pkl_file, folder, flow_format='rowcol'):
+    '''
+    One-shot conversion of a pickled list of per-slot flows into the FlowLists format.
+    :param flow_format: 'rowcol', lists of (row, col, value), or 'index', (data, indices, indptr) csr.
+    '''
+    data = load_pickle(pkl_file)
+    def to_coo(f):
+        if flow_format == 'index':
+            values, indices, indptr = f
+            rows = np.repeat(np.arange(len(indptr) - 1), np.diff(indptr))
+            return rows, np.asarray(indices), np.asarray(values)
+        if len(f) == 0:
+            return np.zeros(0), np.zeros(0), np.zeros(0)
+        rows, cols, values = zip(*f)
+        return np.asarray(rows), np.asarray(cols), np.asarray(values)
+    save_flow_lists(folder, [to_coo(f) for f in data])
+
+def load_flow_data(folder, split):
+    # lazy counterpart of load_pkl_data for a FlowLists folder
+    data = FlowLists(folder)
+    train = data[0:split[0]]
+    if len(split) > 2:
+        validate = data[split[0]:(split[0] + split[1])]
+        test = data[(split[0]+split[1]):(split[0]+split[1]+split[2])]
+    else:
+        validate = None
+        test = data[split[0]:(split[0]+split[1])]
+    return data, train, validate, test
+
 def load_mat_data(filename, dataname, split):
     data = sio.loadmat(filename)[dataname]
     #
@@ -150,30 +240,90 @@ def calculate_scaled_laplacian(adj_mx, lambda_max=2, undirected=True):
     L = (2 / lambda_max * L) - I
     return L.astype(np.float32)
 
-def get_rescaled_W(w, delta=1e7, epsilon=0.8):
-    w2 = np.exp(-w / delta, dtype=np.float32)
-    zero_index = np.eye(len(w2)) + np.array(w2 < epsilon, np.int32)
-    W = w2 + zero_index * (-w2)
-    return W
+def calculate_supports(adj_mx, filter_type='dual_random_walk'):
+    '''
+    Static diffusion supports of a fixed adjacent matrix, computed once in numpy.
+    :param adj_mx: np.ndarray, [num_nodes, num_nodes].
+    :param filter_type: "laplacian", "random_walk", "dual_random_walk".
+    :return: np.ndarray, [num_supports, num_nodes, num_nodes], float32.
+    '''
+    adj_mx = np.asarray(adj_mx, dtype=np.float32)
+    supports = []
+    if filter_type == 'laplacian':
+        supports.append(adj_mx)
+    elif filter_type == 'random_walk':
+        supports.append(calculate_random_walk_matrix(adj_mx).T.toarray())
+    elif filter_type == 'dual_random_walk':
+        supports.append(calculate_random_walk_matrix(adj_mx).T.toarray())
+        supports.append(calculate_random_walk_matrix(adj_mx.T).T.toarray())
+    return np.array(supports, dtype=np.float32)
 
-def scaled_laplacian(W):
+def get_rescaled_W(w, delta=1e7, epsilon=0.8, knn=None, sparse=False):
+    '''
+    Weighted adjacency matrix from a distance matrix.
+    :param w: np.ndarray, [n_route, n_route], distances.
+    :param knn: if given, keep only the knn largest weights (nearest nodes) of each node,
+        symmetrized, instead of all weights above epsilon (epsilon is not applied);
+        at most n_route - 1.
+    :param sparse: return a scipy.sparse csr matrix instead of a dense np.ndarray.
+    '''
+    W = np.exp(-w / delta, dtype=np.float32)
+    if knn is None:
+        W[W < epsilon] = 0
+    np.fill_diagonal(W, 0)
+    if knn is not None:
+        n = len(W)
+        if knn < 1:
+            raise ValueError('knn must be at least 1, got %d' % knn)
+        knn = min(knn, n - 1)
+        cols = np.argpartition(-W, knn - 1, axis=1)[:, :knn].ravel()
+        rows = np.repeat(np.arange(n), knn)
+        W_knn = sp.csr_matrix((W[rows, cols], (rows, cols)), shape=W.shape)
+        W_knn.eliminate_zeros()
+        W_knn = W_knn.maximum(W_knn.T)
+        return W_knn if sparse else W_knn.toarray()
+    return sp.csr_matrix(W) if sparse else W
+
+def scaled_laplacian(W, lambda_max=None, cache_file=None):
     '''
     Normalized graph Laplacian function.
-    :param W: np.ndarray, [n_route, n_route], weighted adjacency matrix of G.
-    :return: np.matrix, [n_route, n_route].
+    :param W: np.ndarray or scipy.sparse matrix, [n_route, n_route], weighted adjacency matrix of G.
+    :param lambda_max: largest eigenvalue of L if known, computed with sparse eigsh otherwise.
+    :param cache_file: .npz file caching lambda_max, keyed by a checksum of L.
+    :return: np.matrix, [n_route, n_route], or scipy.sparse csr matrix for sparse W.
     '''
+    is_sparse = sp.issparse(W)
+    W = sp.coo_matrix(W)
     # d ->  diagonal degree matrix
-    n, d = np.shape(W)[0], np.sum(W, axis=1)
-    # L -> graph Laplacian
-    L = -W
-    L[np.diag_indices_from(L)] = d
-    for i in range(n):
-        for j in range(n):
-            if (d[i] > 0) and (d[j] > 0):
-                L[i, j] = L[i, j] / np.sqrt(d[i] * d[j])
+    n, d = W.shape[0], np.asarray(W.sum(axis=1)).ravel()
+    # L -> graph Laplacian, off-diagonal -W and diagonal d
+    off_diag = W.row != W.col
+    rows = np.concatenate([W.row[off_diag], np.arange(n)])
+    cols = np.concatenate([W.col[off_diag], np.arange(n)])
+    values = np.concatenate([-W.data[off_diag], d]).astype(W.dtype)
+    # L[i, j] / sqrt(d[i] * d[j]) where both degrees are positive
+    positive = d > 0
+    d_sqrt = np.sqrt(np.where(positive, d, 1.))
+    scale = np.where(positive[rows] & positive[cols], 1. / (d_sqrt[rows] * d_sqrt[cols]), 1.)
+    L = sp.csr_matrix((values * scale.astype(values.dtype), (rows, cols)), shape=(n, n))
     # lambda_max \approx 2.0, the largest eigenvalues of L.
-    lambda_max = eigs(L, k=1, which='LR')[0][0].real
-    return np.mat(2 * L / lambda_max - np.identity(n))
+    if lambda_max is None:
+        key = None
+        if cache_file is not None:
+            key = hashlib.sha1(L.data.tobytes() + L.indices.tobytes() + L.indptr.tobytes()).hexdigest()
+            if os.path.isfile(cache_file):
+                with np.load(cache_file) as cache:
+                    if str(cache['key']) == key:
+                        lambda_max = float(cache['lambda_max'])
+        if lambda_max is None:
+            if (L != L.T).nnz == 0:
+                lambda_max = linalg.eigsh(L, k=1, which='LA')[0][0]
+            else:
+                lambda_max = eigs(L, k=1, which='LR')[0][0].real
+            if cache_file is not None:
+                np.savez(cache_file, lambda_max=lambda_max, key=key)
+    L_scaled = 2 * L / lambda_max - sp.identity(n, dtype=L.dtype, format='csr')
+    return L_scaled if is_sparse else np.mat(L_scaled.toarray())
 
 
 def get_index_for_month(year, month):
@@ -184,86 +334,23 @@ def get_index_for_month(year, month):
     return np.sum(day_sum[:int(month)])
 
 def gen_timestamps_for_year_ymd(year):
-    month1 = ['0'+str(e) for e in range(1,10)]
-    month2 = [str(e) for e in range(10,13)]
-    month = month1+month2
-    day1 = ['0'+str(e) for e in range(1,10)]
-    day2 = [str(e) for e in range(10,32)]
-    day = day1+day2
-    if year=='2012' or year=='2016':
-        day_sum = [31, 29, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31]
-    else:
-        day_sum = [31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31]
-    timestamps = []
-    for m in range(len(month)):
-        for d in range(day_sum[m]):
-            t = [year+month[m]+day[d]]
-            t_d = t*24
-            timestamps.append(t_d[:])
-    timestamps = np.hstack(np.array(timestamps))
-    return timestamps
+    days = gen_slot_times(year + '-01-01', str(int(year) + 1) + '-01-01', 24*60)
+    return np.repeat(timestamp_strings(days, 'D'), 24)
 
 def gen_timestamps(years, gen_timestamps_for_year=gen_timestamps_for_year_ymd):
     timestamps = []
     for y in years:
         timestamps.append(gen_timestamps_for_year(y))
-    timestamps = np.hstack(np.array(timestamps))
+    timestamps = np.concatenate(timestamps)
     return timestamps
 
 def gen_timestamps_for_year_ymdh(year):
-    month1 = ['0'+str(e) for e in range(1,10)]
-    month2 = [str(e) for e in range(10,13)]
-    month = month1+month2
-    day1 = ['0'+str(e) for e in range(1,10)]
-    day2 = [str(e) for e in range(10,32)]
-    day = day1+day2
-    if year=='2012' or year=='2016':
-        day_sum = [31, 29, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31]
-    else:
-        day_sum = [31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31]
-    hour1 = ['0'+str(e) for e in range(0,10)]
-    hour2 = [str(e) for e in range(10,24)]
-    hour = hour1+hour2
-    timestamps = []
-    for m in range(len(month)):
-        for d in range(day_sum[m]):
-            #t = [year+month[m]+day[d]]
-            t_d = []
-            for h in range(24):
-                t_d.append(year+month[m]+day[d]+hour[h])
-            timestamps.append(t_d[:])
-    timestamps = np.hstack(np.array(timestamps))
-    return timestamps
+    hours = gen_slot_times(year + '-01-01', str(int(year) + 1) + '-01-01', 60)
+    return timestamp_strings(hours, 'h')
 
-def gen_timestamps_for_year_ymdhm(year):
-    month1 = ['0'+str(e) for e in range(1,10)]
-    month2 = [str(e) for e in range(10,13)]
-    month = month1+month2
-    day1 = ['0'+str(e) for e in range(1,10)]
-    day2 = [str(e) for e in range(10,32)]
-    day = day1+day2
-    if year=='2012' or year=='2016':
-        day_sum = [31, 29, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31]
-    else:
-        day_sum = [31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31]
-    hour1 = ['0'+str(e) for e in range(0,10)]
-    hour2 = [str(e) for e in range(10,24)]
-    hour = hour1+hour2
-    #minute = ['00', '10', '20', '30', '40', '50']
-    minute = ['00', '30']
-    timestamps = []
-    for m in range(len(month)):
-        for d in range(day_sum[m]):
-            #t = [year+month[m]+day[d]]
-            t_d = []
-            for h in range(24):
-                a = [year+month[m]+day[d]+hour[h]+e for e in minute]
-                #t_d = [t_d.append(year+month[m]+day[d]+hour[h]+e) for e in minute]
-                t_d.append(a)
-            t_d = np.hstack(np.array(t_d))
-            timestamps.append(t_d[:])
-    timestamps = np.hstack(np.array(timestamps))
-    return timestamps
+def gen_timestamps_for_year_ymdhm(year, slot_minutes=30):
+    slots = gen_slot_times(year + '-01-01', str(int(year) + 1) + '-01-01', slot_minutes)
+    return timestamp_strings(slots, 'm')
 
 
 def batch_data(d_data, f_data, batch_size=32, input_steps=10, output_steps=10):
@@ -293,52 +380,19 @@ def batch_data(d_data, f_data, batch_size=32, input_steps=10, output_steps=10):
     return x, y, f
 
 def get_embedding_from_file(file, num):
-    with open(file, 'r') as df:
-        lines = df.readlines()
-        _, dim = lines[0].split(' ', 1)
-        #num = int(num)
-        dim = int(dim)
-        embeddings = np.zeros((num, dim), dtype=np.float32)
-        for line in lines[1:]:
-            label, v_str = line.split(' ', 1)
-            v = [float(e) for e in v_str.split()]
-            embeddings[int(label)] = v
+    ids, vectors = load_embedding_table(file)
+    embeddings = np.zeros((num, vectors.shape[1]), dtype=np.float32)
+    embeddings[ids] = vectors
     return embeddings
 
 def get_loss(y, y_out):
     # y, y_out: [num_station, 2]
-    # check-in loss
-    # y = np.transpose(y)
-    # y_out = np.transpose(y_out)
-    y = np.clip(y, 0, None)
-    y_out = np.clip(y_out, 0, None)
-    in_rmse = np.sqrt(np.mean(np.square(y_out[:,0]-y[:,0])))
-    out_rmse = np.sqrt(np.mean(np.square(y_out[:,1]-y[:,1])))
-    in_rmlse = np.sqrt(np.mean(np.square(np.log(y_out[:,0] + 1)-np.log(y[:,0] + 1))))
-    out_rmlse = np.sqrt(np.mean(np.square(np.log(y_out[:,1] + 1)-np.log(y[:,1] + 1))))
-    in_sum = np.max((np.sum(y[:,0]), 1))
-    out_sum = np.max((np.sum(y[:,1]), 1))
-    #print in_sum.shape
-    in_er = np.sum(np.abs(y_out[:,0]-y[:,0]))/in_sum
-    out_er = np.sum(np.abs(y_out[:,1]-y[:,1]))/out_sum
-    #print in_sum
-    #print in_er
-    return [in_rmse, out_rmse, in_rmlse, out_rmlse, in_er, out_er]
+    # in_rmse, out_rmse, in_rmlse, out_rmlse, in_er, out_er
+    m = get_metrics(y, y_out, keep_axes=(1,))
+    return [v for name in ('rmse', 'rmlse', 'er') for v in m[name]]
 
 def get_loss_by_batch(y, y_out):
     # y, y_out: [batch_size, num_station, 2]
-    # check-in loss
-    y = np.clip(y, 0, None)
-    y_out = np.clip(y_out, 0, None)
-    in_rmse = np.sum(np.sqrt(np.mean(np.square(y_out[:,:,0]-y[:,:,0]), -1)))
-    out_rmse = np.sum(np.sqrt(np.mean(np.square(y_out[:,:,1]-y[:,:,1]), -1)))
-    in_rmlse = np.sum(np.sqrt(np.mean(np.square(np.log(y_out[:,:,0] + 1)-np.log(y[:,:,0] + 1)), -1)))
-    out_rmlse = np.sum(np.sqrt(np.mean(np.square(np.log(y_out[:,:,1] + 1)-np.log(y[:,:,1] + 1)), -1)))
-    in_sum = np.clip(np.sum(y[:,:,0], -1), 1, None)
-    out_sum = np.clip(np.sum(y[:,:,1], -1), 1, None)
-    #print in_sum.shape
-    in_er = np.sum(np.sum(np.abs(y_out[:,:,0]-y[:,:,0]), axis=-1)/in_sum)
-    out_er = np.sum(np.sum(np.abs(y_out[:,:,1]-y[:,:,1]), axis=-1)/out_sum)
-    #print in_sum
-    #print in_er
-    return [in_rmse, out_rmse, in_rmlse, out_rmlse, in_er, out_er]
+    # metrics of each sample, summed over the batch
+    m = get_metrics(y, y_out, keep_axes=(0, 2))
+    return [v for name in ('rmse', 'rmlse', 'er') for v in np.sum(m[name], axis=0)]